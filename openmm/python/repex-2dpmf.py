@@ -67,41 +67,43 @@ class UmbrellaSampling2D(ReplicaExchange):
 
     """
 
-    def _compute_torsion(self, coordinates, i, j, k, l):
+    def _compute_torsions(self, coordinates, i, j, k, l):
         """
-        Compute torsion angle defined by four atoms.
+        Compute torsion angle defined by four atoms for many configurations at once.
 
         ARGUMENTS
 
-        coordinates (simtk.unit.Quantity wrapping numpy natoms x 3) - atomic coordinates
+        coordinates (numpy nconfigurations x natoms x 3) - atomic coordinates (in nm)
         i, j, k, l - four atoms defining torsion angle
 
+        RETURNS
+
+        theta (numpy array of nconfigurations) - torsion angles (in radians), in [-pi, +pi]
+
         NOTES
 
-        Algorithm of Swope and Ferguson [1] is used.
+        Algorithm of Swope and Ferguson [1] is used, with the angle recovered by arctan2 rather than arccos for accuracy near 0 and pi.
 
         [1] Swope WC and Ferguson DM. Alternative expressions for energies and forces due to angle bending and torsional energy.
         J. Comput. Chem. 13:585, 1992.
 
         """
         # Swope and Ferguson, Eq. 26
-        rij = (coordinates[i,:] - coordinates[j,:]) / units.angstroms
-        rkj = (coordinates[k,:] - coordinates[j,:]) / units.angstroms
-        rlk = (coordinates[l,:] - coordinates[k,:]) / units.angstroms
-        rjk = (coordinates[j,:] - coordinates[k,:]) / units.angstroms # added
-        
+        rij = coordinates[:,i,:] - coordinates[:,j,:]
+        rkj = coordinates[:,k,:] - coordinates[:,j,:]
+        rlk = coordinates[:,l,:] - coordinates[:,k,:]
+
         # Swope and Ferguson, Eq. 27
         t = numpy.cross(rij, rkj)
-        u = numpy.cross(rjk, rlk) # fixed because this didn't seem to match diagram in equation in paper
+        u = numpy.cross(-rkj, rlk) # fixed because this didn't seem to match diagram in equation in paper
 
-        # Swope and Ferguson, Eq. 28
-        t_norm = numpy.sqrt(numpy.dot(t, t))
-        u_norm = numpy.sqrt(numpy.dot(u, u))    
-        cos_theta = numpy.dot(t, u) / (t_norm * u_norm)
-        theta = numpy.arccos(cos_theta) * numpy.sign(numpy.dot(rkj, numpy.cross(t, u))) * units.radians
+        # Swope and Ferguson, Eq. 28, with sign given by orientation of t x u along rkj.
+        cos_term = (t * u).sum(1)
+        sin_term = (numpy.cross(t, u) * rkj).sum(1) / numpy.sqrt((rkj * rkj).sum(1))
+        theta = numpy.arctan2(sin_term, cos_term)
 
         return theta
-                                                    
+
     def __init__(self, temperature, nbins, store_filename, protocol=None, mm=None):
         """
         Initialize a Hamiltonian exchange simulation object.
@@ -120,14 +122,14 @@ class UmbrellaSampling2D(ReplicaExchange):
 
         http://en.wikipedia.org/wiki/Von_Mises_distribution
 
+        All states share a single System, whose bias force has global parameters 'kappa', 'phi0', and 'psi0'.  Each state
+        is defined by the values of these parameters, with kappa = 0 for the unbiased state 0.
+
         """
 
         import simtk.pyopenmm.extras.testsystems as testsystems
         
-        # Create reference system and state.        
         [system, coordinates] = testsystems.AlanineDipeptideImplicit()
-        self.reference_system = system
-        self.reference_state = repex.ThermodynamicState(system=system, temperature=temperature)
 
         self.nbins = nbins
         self.kT = (repex.kB * temperature)
@@ -137,37 +139,46 @@ class UmbrellaSampling2D(ReplicaExchange):
         self.sigma = self.delta/3.0 # standard deviation (angular)
         self.kappa = (self.sigma / units.radians)**(-2) # kappa parameter (unitless)
 
+        # Umbrella centers along each torsion (in radians), at the centers of the bins.
+        self.theta0 = (numpy.arange(nbins) + 0.5) * (self.delta / units.radians) - numpy.pi
+        self.phi_atoms = (4, 6, 8, 14) # atoms defining phi torsion
+        self.psi_atoms = (6, 8, 14, 16) # atoms defining psi torsion
+
+        # Add biasing potentials, with the umbrella center of each torsion selected by the per-torsion parameter 'is_psi'.
+        force = openmm.CustomTorsionForce('-kT * kappa * cos(theta - theta0); theta0 = (1-is_psi)*phi0 + is_psi*psi0')
+        force.addGlobalParameter('kT', self.kT / units.kilojoules_per_mole)
+        force.addGlobalParameter('kappa', 0.0)
+        force.addGlobalParameter('phi0', 0.0)
+        force.addGlobalParameter('psi0', 0.0)
+        force.addPerTorsionParameter('is_psi')
+        force.addTorsion(self.phi_atoms[0], self.phi_atoms[1], self.phi_atoms[2], self.phi_atoms[3], [0.0])
+        force.addTorsion(self.psi_atoms[0], self.psi_atoms[1], self.psi_atoms[2], self.psi_atoms[3], [1.0])
+        system.addForce(force)
+
+        # Create reference state without a biasing potential.
+        self.reference_system = system
+        self.reference_state = repex.ThermodynamicState(system=system, temperature=temperature, parameters={'kappa' : 0.0, 'phi0' : 0.0, 'psi0' : 0.0})
+
         # Create list of thermodynamic states with different bias potentials.
-        states = list()
-        # Create a state without a biasing potential.
-        [system, coordinates] = testsystems.AlanineDipeptideImplicit()
-        state = repex.ThermodynamicState(system=system, temperature=temperature)
-        states.append(state)        
-        # Create states with biasing potentials.
+        states = [ self.reference_state ]
         for phi_index in range(nbins):
             for psi_index in range(nbins):
-                print "bin (%d,%d)" % (phi_index, psi_index)
-                # Create system.
-                [system, coordinates] = testsystems.AlanineDipeptideImplicit()                
-                # Add biasing potentials.
-                phi0 = (float(phi_index) + 0.5) * self.delta - 180.0 * units.degrees 
-                psi0 = (float(psi_index) + 0.5) * self.delta - 180.0 * units.degrees 
-                force = openmm.CustomTorsionForce('-kT * kappa * cos(theta - theta0)')
-                force.addGlobalParameter('kT', self.kT / units.kilojoules_per_mole)
-                force.addPerTorsionParameter('kappa')  
-                force.addPerTorsionParameter('theta0')
-                force.addTorsion(4, 6, 8, 14, [self.kappa, phi0 / units.radians])
-                force.addTorsion(6, 8, 14, 16, [self.kappa, psi0 / units.radians])            
-                system.addForce(force)
-                # Add state.
-                state = repex.ThermodynamicState(system=system, temperature=temperature)
-                states.append(state)
+                parameters = {'kappa' : self.kappa, 'phi0' : self.theta0[phi_index], 'psi0' : self.theta0[psi_index]}
+                states.append(repex.ThermodynamicState(system=system, temperature=temperature, parameters=parameters))
 
         # Initialize replica-exchange simlulation.
         ReplicaExchange.__init__(self, states, coordinates, store_filename, protocol=protocol, mm=mm)
 
         # Override title.
         self.title = '2D umbrella sampling replica-exchange simulation created on %s' % time.asctime(time.localtime())
+
+        # State graph for 'swap-graph' mixing: the unbiased state 0 is connected to all biased states, which form a periodic 2D grid.
+        if self.state_graph is None:
+            (indptr, indices) = repex.grid_state_graph((nbins, nbins), periodic=True)
+            grid_istates = numpy.repeat(numpy.arange(nbins*nbins), numpy.diff(indptr)) + 1
+            grid_jstates = indices + 1
+            hub_jstates = numpy.arange(1, nbins*nbins+1)
+            self.state_graph = repex.state_graph_from_edges(nbins*nbins+1, numpy.concatenate([grid_istates, numpy.zeros(hub_jstates.shape, numpy.int64)]), numpy.concatenate([grid_jstates, hub_jstates]))
         
         return
 
@@ -175,78 +186,36 @@ class UmbrellaSampling2D(ReplicaExchange):
         """
         Compute energies of all replicas at all states.
 
-        """
+        NOTES
 
-        from scipy import weave
+        The reduced potential of state 1 + phi_index*nbins + psi_index is that of the unbiased state 0 plus the von Mises biases
+        -kappa cos(phi - phi0) - kappa cos(psi - psi0), since the bias force -kT kappa cos(theta - theta0) is divided by kT.  The
+        unbiased reduced potentials are evaluated for all replicas with one Context, the torsions of all replicas are computed in
+        one batched call, and the biases are broadcast over the (phi0, psi0) grid, so no per-state energy evaluations are needed.
+
+        """
 
         start_time = time.time()
 
-        # Temporary storage for computed phi and psi angles.
-        phi = units.Quantity(numpy.zeros([self.nstates], numpy.float64), units.radians)
-        psi = units.Quantity(numpy.zeros([self.nstates], numpy.float64), units.radians)
-
-        # Compute reference energies.
-        for replica_index in range(self.nstates):
-            # Compute reference energy once.
-            reference_energy = self.reference_state.reduced_potential(self.replica_coordinates[replica_index], platform=self.energy_platform)
-            self.u_kl[replica_index,:] = reference_energy
-
-        # Compute torsion angles.
-        for replica_index in range(self.nstates):        
-            # Compute torsion angles.
-            phi[replica_index] = self._compute_torsion(self.replica_coordinates[replica_index], 4, 6, 8, 14) 
-            psi[replica_index] = self._compute_torsion(self.replica_coordinates[replica_index], 6, 8, 14, 16)
-
-
-        # Compute torsion energies.
-        code = """
-        for(int replica_index = 0; replica_index < nstates; replica_index++) {
-           double phi = PHI1(replica_index);
-           double psi = PSI1(replica_index);
-           long state_index = 1;
-           for(int phi_index = 0; phi_index < nbins; phi_index++) {
-              for(int psi_index = 0; psi_index < nbins; psi_index++) {            
-                 // Compute torsion angles
-                 double phi0 = phi_index * delta;
-                 double psi0 = psi_index * delta;
-
-                 // Compute torsion energies.
-                 U_KL2(replica_index,state_index) += kappa*cos(phi-phi0) + kappa*cos(psi-psi0);
-                 state_index += 1;
-               }
-            }
-        }
-        """
+        # Compute reference energies of all replicas.
+        coordinates_list = [ units.Quantity(self.replica_coordinates[replica_index], units.nanometers) for replica_index in range(self.nreplicas) ]
+        reference_energies = self.reference_state.reduced_potentials(coordinates_list, platform=self.energy_platform)
+
+        # Compute torsion angles of all replicas.
+        phi = self._compute_torsions(self.replica_coordinates, *self.phi_atoms)
+        psi = self._compute_torsions(self.replica_coordinates, *self.psi_atoms)
+
+        # Compute biases of all replicas for all umbrella centers along each torsion.
+        phi_bias = - self.kappa * numpy.cos(phi[:,numpy.newaxis] - self.theta0[numpy.newaxis,:]) # phi_bias[replica,phi_index]
+        psi_bias = - self.kappa * numpy.cos(psi[:,numpy.newaxis] - self.theta0[numpy.newaxis,:]) # psi_bias[replica,psi_index]
+
+        # Assemble reduced potentials over the (phi0, psi0) grid.
+        self.u_kl[:,0] = reference_energies
+        self.u_kl[:,1:] = reference_energies[:,numpy.newaxis] + (phi_bias[:,:,numpy.newaxis] + psi_bias[:,numpy.newaxis,:]).reshape([self.nreplicas, self.nbins*self.nbins])
 
-        # Stage input temporarily.
-        nstates = self.nstates
-        nbins = self.nbins
-        delta = self.delta / units.radians
-        kappa = self.kappa
-        phi = phi / units.radians
-        psi = psi / units.radians
-        u_kl = self.u_kl
-        try:
-            # Execute inline C code with weave.
-            info = weave.inline(code, ['nstates', 'nbins', 'delta', 'kappa', 'phi', 'psi', 'u_kl'], headers=['<math.h>', '<stdlib.h>'], verbose=2)
-            self.u_kl = u_kl
-        except:
-            for replica_index in range(self.nstates):                    
-               # Compute torsion restraint energies for all states.            
-               state_index = 1            
-               for phi_index in range(self.nbins):
-                   phi0 = float(phi_index) * self.delta / units.radians                   
-                   for psi_index in range(self.nbins):
-                       psi0 = float(psi_index) * self.delta / units.radians
-                       # Compute torsion energies.
-                       self.u_kl[replica_index,state_index] += (self.kappa)*math.cos(phi[replica_index]-phi0) + (self.kappa)*math.cos(psi[replica_index]-psi0)
-                       #print "(%6d,%6d) : %16s %16s : %16.1f %16.1f" % (phi_index, psi_index, str(phi), str(psi), self.u_kl[replica_index,state_index], self.states[state_index].reduced_potential(self.replica_coordinates[replica_index]))
-                       # Increment state index.
-                       state_index += 1
-                
         end_time = time.time()
         elapsed_time = end_time - start_time
-        time_per_energy = elapsed_time / float(self.nstates)**2 
+        time_per_energy = elapsed_time / float(self.nreplicas * self.nstates)
         if self.verbose: print "Time to compute all energies %.3f s (%.3f per energy calculation).\n" % (elapsed_time, time_per_energy)
 
         return    
@@ -263,11 +232,8 @@ class UmbrellaSampling2D(ReplicaExchange):
         istate = 0
         for jstate in range(1, self.nstates):
             # Determine which replicas these states correspond to.
-            i = None
-            j = None
-            for index in range(self.nstates):
-                if self.replica_states[index] == istate: i = index
-                if self.replica_states[index] == jstate: j = index                
+            i = self.state_replicas[istate]
+            j = self.state_replicas[jstate]
 
             # Reject swap attempt if any energies are nan.
             if (numpy.isnan(self.u_kl[i,jstate]) or numpy.isnan(self.u_kl[j,istate]) or numpy.isnan(self.u_kl[i,istate]) or numpy.isnan(self.u_kl[j,jstate])):
@@ -284,6 +250,7 @@ class UmbrellaSampling2D(ReplicaExchange):
             if (log_P_accept >= 0.0 or (numpy.random.rand() < math.exp(log_P_accept))):
                 # Swap states in replica slots i and j.
                 (self.replica_states[i], self.replica_states[j]) = (self.replica_states[j], self.replica_states[i])
+                (self.state_replicas[istate], self.state_replicas[jstate]) = (j, i)
                 # Accumulate statistics
                 self.Nij_accepted[istate,jstate] += 1
                 self.Nij_accepted[jstate,istate] += 1
@@ -312,11 +279,8 @@ class UmbrellaSampling2D(ReplicaExchange):
             jstate = 1 + phi_index*self.nbins + psi_index
                 
             # Determine which replicas these states correspond to.
-            i = None
-            j = None
-            for index in range(self.nstates):
-                if self.replica_states[index] == istate: i = index
-                if self.replica_states[index] == jstate: j = index                
+            i = self.state_replicas[istate]
+            j = self.state_replicas[jstate]
 
             # Reject swap attempt if any energies are nan.
             if (numpy.isnan(self.u_kl[i,jstate]) or numpy.isnan(self.u_kl[j,istate]) or numpy.isnan(self.u_kl[i,istate]) or numpy.isnan(self.u_kl[j,jstate])):
@@ -333,6 +297,7 @@ class UmbrellaSampling2D(ReplicaExchange):
             if (log_P_accept >= 0.0 or (numpy.random.rand() < math.exp(log_P_accept))):
                 # Swap states in replica slots i and j.
                 (self.replica_states[i], self.replica_states[j]) = (self.replica_states[j], self.replica_states[i])
+                (self.state_replicas[istate], self.state_replicas[jstate]) = (j, i)
                 # Accumulate statistics
                 self.Nij_accepted[istate,jstate] += 1
                 self.Nij_accepted[jstate,istate] += 1
@@ -353,6 +318,9 @@ if __name__ == "__main__":
     elif sys.argv[1] == 'allswap':
         store_filename  = 'data/repex-2dpmf-allswap.nc' # output netCDF filename
         replica_mixing_scheme = 'swap-all'
+    elif sys.argv[1] == 'graphswap':
+        store_filename  = 'data/repex-2dpmf-graphswap.nc' # output netCDF filename
+        replica_mixing_scheme = 'swap-graph'
     else:
         print "Unrecognized command line arguments."
         stop
@@ -386,7 +354,7 @@ if __name__ == "__main__":
     simulation.number_of_iterations = niterations # number of iterations (exchange attempts)
     simulation.timestep = timestep # timestep
     simulation.nsteps_per_iteration = nsteps # number of timesteps per iteration
-    simulation.replica_mixing_scheme = replica_mixing_scheme # 'swap-neighbors' or 'swap-all'    
+    simulation.replica_mixing_scheme = replica_mixing_scheme # 'swap-neighbors', 'swap-graph', or 'swap-all'    
     simulation.minimize = False
     simulation.show_energies = False
     simulation.show_mixing_statistics = False
@@ -59,6 +59,9 @@ import os
 import math
 import copy
 import time
+import itertools
+import collections
+import multiprocessing
 
 import numpy
 import numpy.linalg
@@ -82,6 +85,56 @@ __version__ = "$Revision: $"
 
 kB = units.BOLTZMANN_CONSTANT_kB * units.AVOGADRO_CONSTANT_NA # Boltzmann constant
 
+#=============================================================================================
+# Process-pool workers
+#=============================================================================================
+
+# These are inherited by worker processes when the process pool is forked (see ReplicaExchange 'backend' option).
+_worker_simulation = None  # the ReplicaExchange object that created the pool
+_worker_coordinates = None # shared-memory numpy view of replica coordinates (in nm), _worker_coordinates[replica,atom,spatial]
+
+def _propagate_replica_worker(task):
+    """
+    Propagate one replica in a worker process, updating its coordinates in shared memory.
+
+    ARGUMENTS
+
+    task (tuple) - (replica_index, state_index) of the replica to propagate and the thermodynamic state it is assigned to
+
+    RETURNS
+
+    potential_energy (float) - potential energy (in kJ/mol) of the final configuration, or NaN if not captured
+
+    """
+
+    [replica_index, state_index] = task
+
+    return _worker_simulation._propagate_replica(_worker_coordinates[replica_index,:,:], state_index)
+
+def _compute_energies_worker(task):
+    """
+    Compute reduced potentials of several replicas at one thermodynamic state in a worker process.
+
+    ARGUMENTS
+
+    task (tuple) - (state_index, replica_indices) of the state to evaluate and the replicas to evaluate it for, optionally
+       followed by a bitmask of the force groups to evaluate
+
+    RETURNS
+
+    u (numpy.array of float64) - u[n] is the reduced potential of replica replica_indices[n] at state state_index
+
+    """
+
+    [state_index, replica_indices] = task[0:2]
+    groups = None
+    if len(task) > 2:
+        groups = task[2]
+    coordinates_list = [ units.Quantity(_worker_coordinates[replica_index,:,:], units.nanometers) for replica_index in replica_indices ]
+    state = _worker_simulation.states[state_index]
+
+    return state.reduced_potentials(coordinates_list, platform=_worker_simulation.energy_platform, groups=groups)
+
 #=============================================================================================
 # Exceptions
 #=============================================================================================
@@ -100,6 +153,186 @@ class ParameterException(Exception):
     """
     pass
     
+#=============================================================================================
+# Context cache
+#=============================================================================================
+
+class ContextCache(object):
+    """
+    Bounded least-recently-used cache of OpenMM Context objects.
+
+    DESCRIPTION
+
+    Creating a Context can be more expensive than the dynamics or energy evaluation that follows it, especially on
+    GPU platforms, where kernels must be compiled and device memory allocated.  This cache keeps one Context (and its
+    LangevinIntegrator) alive for each (System, Platform) pair, so that the temperature, collision rate, and timestep
+    can be changed in place instead of building a new Context.  When more than 'capacity' Contexts are held, the
+    least recently used one is destroyed.
+
+    Contexts are keyed by System identity, so a System that is modified in place after a Context has been created
+    for it must be explicitly invalidated with invalidate(system).  States that share a System and differ only in the
+    values of global parameters share one Context, and the parameters are changed in place with setParameter().
+
+    EXAMPLES
+
+    >>> import simtk.unit as units
+    >>> import simtk.pyopenmm.extras.testsystems as testsystems
+    >>> [system, coordinates] = testsystems.AlanineDipeptideImplicit()
+    >>> cache = ContextCache(capacity=2)
+    >>> [context, integrator] = cache.get_context(system, temperature=298.0*units.kelvin)
+    >>> [context2, integrator2] = cache.get_context(system, temperature=350.0*units.kelvin)
+    >>> context2 is context
+    True
+    >>> cache.invalidate(system)
+    >>> len(cache)
+    0
+
+    """
+
+    def __init__(self, capacity=None, mm=None):
+        """
+        Initialize an empty Context cache.
+
+        OPTIONAL ARGUMENTS
+
+        capacity (int) - maximum number of Context objects to keep alive, or None if unbounded (default: None)
+        mm (implementation of simtk.openmm) - OpenMM API implementation to use (default: simtk.openmm)
+
+        """
+
+        self.mm = mm
+        if mm is None: self.mm = simtk.openmm
+
+        self.capacity = capacity
+        self._entries = collections.OrderedDict() # _entries[key] is (system, context, integrator, parameters), most recently used last
+
+        return
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, system, platform):
+        """
+        Return the cache key for the given System and Platform.
+
+        """
+        platform_name = None
+        if platform is not None:
+            platform_name = platform.getName()
+        return (id(system), platform_name)
+
+    def get_context(self, system, platform=None, temperature=None, collision_rate=None, timestep=None, parameters=None):
+        """
+        Retrieve a Context for the given System, creating one only if none is cached.
+
+        ARGUMENTS
+
+        system (simtk.openmm.System) - the System the Context is to be bound to
+
+        OPTIONAL ARGUMENTS
+
+        platform (simtk.openmm.Platform) - the Platform to create the Context on, or None for the default Platform (default: None)
+        temperature (simtk.unit.Quantity with units compatible with kelvin) - if specified, integrator temperature is set to this value (default: None)
+        collision_rate (simtk.unit.Quantity with units compatible with 1/picoseconds) - if specified, integrator collision rate is set to this value (default: None)
+        timestep (simtk.unit.Quantity with units compatible with femtoseconds) - if specified, integrator timestep is set to this value (default: None)
+        parameters (dict) - if specified, each global parameter of the Context named by a key is set to its value; global
+           parameters not listed are reset to their default values in the System (default: None)
+
+        RETURNS
+
+        context (simtk.openmm.Context) - the cached Context
+        integrator (simtk.openmm.LangevinIntegrator) - the integrator bound to the Context
+
+        """
+
+        key = self._key(system, platform)
+        if key in self._entries:
+            # Mark entry as most recently used.
+            entry = self._entries.pop(key)
+            self._entries[key] = entry
+            [system, context, integrator, context_parameters] = entry
+        else:
+            # Create integrator and context, using defaults for any parameters not specified.
+            integrator = self.mm.LangevinIntegrator(300.0 * units.kelvin, 91.0 / units.picosecond, 1.0 * units.femtosecond)
+            if platform is not None:
+                context = self.mm.Context(system, integrator, platform)
+            else:
+                context = self.mm.Context(system, integrator)
+            # Record default values of global parameters, which the Context starts with.
+            context_parameters = self._default_parameters(system)
+            # We hold a reference to the System so that its id() cannot be reused while it is cached.
+            self._entries[key] = (system, context, integrator, context_parameters)
+            # Evict least recently used contexts.
+            while (self.capacity is not None) and (len(self._entries) > self.capacity):
+                self._entries.popitem(last=False)
+
+        # Update integrator parameters in place.
+        if temperature is not None:
+            integrator.setTemperature(temperature)
+        if collision_rate is not None:
+            integrator.setFriction(collision_rate)
+        if timestep is not None:
+            integrator.setStepSize(timestep)
+
+        # Update global parameters in place, resetting any not specified to their defaults so no values leak between states.
+        if (parameters is not None) or (context_parameters['modified']):
+            requested_parameters = dict(context_parameters['defaults'])
+            requested_parameters.update(parameters or dict())
+            for (name, value) in requested_parameters.items():
+                if context_parameters['values'].get(name) != value:
+                    context.setParameter(name, value)
+                    context_parameters['values'][name] = value
+            context_parameters['modified'] = (context_parameters['values'] != context_parameters['defaults'])
+
+        return [context, integrator]
+
+    def _default_parameters(self, system):
+        """
+        Collect the default values of global parameters of all Forces in a System.
+
+        ARGUMENTS
+
+        system (simtk.openmm.System) - the System
+
+        RETURNS
+
+        context_parameters (dict) - 'defaults' and 'values' map each global parameter name to its default value, and
+           'modified' is False, as for a newly created Context
+
+        """
+
+        defaults = dict()
+        for force_index in range(system.getNumForces()):
+            force = system.getForce(force_index)
+            if hasattr(force, 'getNumGlobalParameters'):
+                for parameter_index in range(force.getNumGlobalParameters()):
+                    defaults[force.getGlobalParameterName(parameter_index)] = force.getGlobalParameterDefaultValue(parameter_index)
+
+        return { 'defaults' : defaults, 'values' : dict(defaults), 'modified' : False }
+
+    def invalidate(self, system=None):
+        """
+        Destroy cached Contexts for the given System, or all cached Contexts if no System is specified.
+
+        OPTIONAL ARGUMENTS
+
+        system (simtk.openmm.System) - System whose Contexts are to be destroyed, or None to destroy all Contexts (default: None)
+
+        NOTES
+
+        This must be called if a System is modified after a Context has been created for it.
+
+        """
+
+        if system is None:
+            self._entries.clear()
+        else:
+            for key in self._entries.keys():
+                if key[0] == id(system):
+                    del self._entries[key]
+
+        return
+
 #=============================================================================================
 # Thermodynamic state description
 #=============================================================================================
@@ -123,10 +356,27 @@ class ThermodynamicState(object):
 
     Note that the pressure is only relevant for periodic systems.
 
+    Specify a state by the values of global parameters of a shared System, such as the strength of a restraint.
+
+    >>> force = simtk.openmm.CustomExternalForce('K * (x^2 + y^2 + z^2)')
+    >>> force.addGlobalParameter('K', 0.0)
+    >>> force.addParticle(0, [])
+    >>> force_index = system.addForce(force)
+    >>> states = [ ThermodynamicState(system=system, temperature=298.0*units.kelvin, parameters={'K' : K}) for K in [0.0, 10.0, 100.0] ]
+
     NOTES
 
     This state object cannot describe states obeying non-Boltzamnn statistics, such as Tsallis statistics.
 
+    Context objects used to compute reduced potentials are cached in a bounded least-recently-used cache shared by all
+    ThermodynamicState objects and keyed by System identity and Platform, so that states sharing a System also share
+    a Context.  If a System is modified after its reduced potential has been computed, the cache must be invalidated
+    with ThermodynamicState.invalidate_context_cache(system).
+
+    States can share one System and differ only in the values of global parameters of its Forces.  The parameters are set
+    in the shared Context with setParameter() whenever the state is used, so a ladder of many such states needs neither a
+    System nor a Context per state.
+
     TODO
 
     Implement a more fundamental ProbabilityState as a base class?
@@ -137,8 +387,12 @@ class ThermodynamicState(object):
     temperature = None     # the temperature
     pressure = None        # the pressure, or None if not isobaric
     pH = None              # the pH, or None if not constant-pH
+    parameters = None      # dict of values of global parameters of the System, or None
 
-    def __init__(self, system=None, temperature=None, pressure=None, pH=None):
+    context_cache_capacity = 8 # maximum number of Context objects cached for energy evaluation
+    _context_caches = dict()   # _context_caches[mm] is the ContextCache used for energy evaluation with OpenMM implementation mm
+
+    def __init__(self, system=None, temperature=None, pressure=None, pH=None, parameters=None):
         """
         Initialize the thermodynamic state.
 
@@ -148,6 +402,7 @@ class ThermodynamicState(object):
         temperature (simtk.unit.Quantity compatible with 'kelvin') - the temperature for a system with constant temperature (default: None)
         pressure (simtk.unit.Quantity compatible with 'atmospheres') - the pressure for constant-pressure systems (default: None)
         pH (float) - the pH for systems under constant pH conditions
+        parameters (dict) - values of global parameters of the System's Forces that define this state, keyed by parameter name (default: None)
 
         NOTES
 
@@ -166,6 +421,8 @@ class ThermodynamicState(object):
             self.pressure = pressure
         if pH is not None:
             raise NotImplementedException("Constant pH simulation not implemented yet.")
+        if parameters is not None:
+            self.parameters = dict(parameters)
 
         return
 
@@ -227,44 +484,139 @@ class ThermodynamicState(object):
         
         """
 
+        # Evaluate as a batch of one configuration.
+        box_vectors_list = None
+        if box_vectors is not None:
+            box_vectors_list = [box_vectors]
+        reduced_potential = self.reduced_potentials([coordinates], box_vectors_list, mm=mm, platform=platform)[0]
+
+        return reduced_potential
+
+    def reduced_potentials(self, coordinates_list, box_vectors_list=None, mm=None, platform=None, groups=None):
+        """
+        Compute the reduced potentials for many configurations in this thermodynamic state.
+
+        ARGUMENTS
+
+        coordinates_list (list of simtk.unit.Quantity of Nx3 numpy.array) - coordinates_list[i][n,k] is kth coordinate of particle n of configuration i
+
+        OPTIONAL ARGUMENTS
+
+        box_vectors_list (list) - box_vectors_list[i] are the periodic box vectors of configuration i (default: None)
+        groups (int) - if specified, only the potential energy of force groups in this bitmask is included (default: None)
+
+        RETURNS
+
+        u (numpy.array of float64) - u[i] is the unitless reduced potential of configuration i (in units of kT)
+
+        EXAMPLES
+
+        Compute the reduced potentials of several configurations of a Lennard-Jones cluster.
+
+        >>> import simtk.unit as units
+        >>> import simtk.pyopenmm.extras.testsystems as testsystems
+        >>> [system, coordinates] = testsystems.LennardJonesCluster()
+        >>> state = ThermodynamicState(system=system, temperature=298.0*units.kelvin)
+        >>> potentials = state.reduced_potentials([coordinates, coordinates])
+
+        NOTES
+
+        A single cached Context is used for all configurations, and the unit conversions needed to form the reduced
+        potential are carried out once for the whole array rather than once per configuration.
+        See reduced_potential() for the definition of the reduced potential.  If 'groups' is specified, the pV term is still
+        included in full.
+
+        """
+
         # Select OpenMM implementation if not specified.
         if mm is None: mm = simtk.openmm
 
         # If pressure is specified, ensure box vectors have been provided.
-        if (self.pressure is not None) and (box_vectors is None):
+        if (self.pressure is not None) and (box_vectors_list is None):
             raise ParameterException("box_vectors must be specified if constant-pressure ensemble.")
 
-        # Set up a dummy integrator -- parameters are irrelevant since we're not doing dynamics.
-        collision_rate = 90.0 / units.picosecond
-        timestep = 1.0 * units.femtosecond
-        integrator = mm.LangevinIntegrator(self.temperature, collision_rate, timestep)
-        
-        # Create an OpenMM Context.
-        if platform is not None:
-            context = mm.Context(self.system, integrator, platform)
-        else:
-            context = mm.Context(self.system, integrator)
-
-        # Set coordinates.
-        context.setPositions(coordinates)
+        # Retrieve a cached OpenMM Context.
+        context = self._get_context(mm, platform)
 
-        # Set periodic box vectors.
-        if box_vectors is not None:
-            context.setPeriodicBoxVectors(*box_vectors)
+        # Compute potential energies (in kJ/mol) and box volumes (in nm^3) of all configurations.
+        nconfigurations = len(coordinates_list)
+        potential_energies = numpy.zeros([nconfigurations], numpy.float64)
+        volumes = numpy.zeros([nconfigurations], numpy.float64)
+        for index in range(nconfigurations):
+            # Set coordinates.
+            context.setPositions(coordinates_list[index])
+            # Set periodic box vectors.
+            if box_vectors_list is not None:
+                context.setPeriodicBoxVectors(*box_vectors_list[index])
+                volumes[index] = self._volume(box_vectors_list[index]) / units.nanometers**3
+            # Retrieve potential energy.
+            if groups is None:
+                openmm_state = context.getState(getEnergy=True)
+            else:
+                openmm_state = context.getState(getEnergy=True, groups=groups)
+            potential_energies[index] = openmm_state.getPotentialEnergy() / units.kilojoules_per_mole
 
-        # Retrieve potential energy.
-        openmm_state = context.getState(getEnergy=True)
-        potential_energy = openmm_state.getPotentialEnergy()
-        
-        # Compute inverse temperature.
-        beta = 1.0 / (kB * self.temperature)
+        # Compute inverse temperature (in mol/kJ).
+        beta = 1.0 / (kB * self.temperature / units.kilojoules_per_mole)
 
-        # Compute reduced potential.
-        reduced_potential = beta * potential_energy
+        # Compute reduced potentials.
+        reduced_potentials = beta * potential_energies
         if self.pressure is not None:
-            reduced_potential += beta * self.pressure * self._volume(box_vectors) * units.AVOGADRO_CONSTANT_NA
+            pressure = self.pressure * units.nanometers**3 * units.AVOGADRO_CONSTANT_NA / units.kilojoules_per_mole # pressure (in kJ/mol/nm^3)
+            reduced_potentials += beta * pressure * volumes
 
-        return reduced_potential
+        return reduced_potentials
+
+    def _get_context(self, mm, platform):
+        """
+        Retrieve a cached Context for energy evaluation of this state's System, creating one only if necessary.
+
+        ARGUMENTS
+
+        mm (implementation of simtk.openmm) - OpenMM API implementation to use
+        platform (simtk.openmm.Platform) - Platform to use, or None for the default Platform
+
+        RETURNS
+
+        context (simtk.openmm.Context) - a Context bound to this state's System, with global parameters set to this state's values
+
+        """
+
+        if mm not in ThermodynamicState._context_caches:
+            ThermodynamicState._context_caches[mm] = ContextCache(capacity=ThermodynamicState.context_cache_capacity, mm=mm)
+        [context, integrator] = ThermodynamicState._context_caches[mm].get_context(self.system, platform, parameters=self.parameters)
+
+        return context
+
+    @classmethod
+    def invalidate_context_cache(cls, system=None):
+        """
+        Destroy cached Contexts used for energy evaluation.
+
+        OPTIONAL ARGUMENTS
+
+        system (simtk.openmm.System) - System whose Contexts are to be destroyed, or None to destroy all cached Contexts (default: None)
+
+        NOTES
+
+        This must be called if a System is modified after a reduced potential has been computed for it.
+
+        EXAMPLES
+
+        >>> import simtk.unit as units
+        >>> import simtk.pyopenmm.extras.testsystems as testsystems
+        >>> [system, coordinates] = testsystems.LennardJonesCluster()
+        >>> state = ThermodynamicState(system=system, temperature=298.0*units.kelvin)
+        >>> potential = state.reduced_potential(coordinates)
+        >>> system.getForce(0).setParticleParameters(0, 0.0, 1.0, 1.0)
+        >>> ThermodynamicState.invalidate_context_cache(system)
+
+        """
+
+        for cache in cls._context_caches.values():
+            cache.invalidate(system)
+
+        return
 
     def is_compatible_with(self, state):
         """
@@ -300,6 +652,8 @@ class ThermodynamicState(object):
             r += ", temperature = %s" % str(self.temperature)
         if self.pressure is not None:
             r += ", pressure = %s" % str(self.pressure)
+        if self.parameters is not None:
+            r += ", parameters = %s" % str(self.parameters)
         r += ">"
 
         return r
@@ -325,6 +679,95 @@ class ThermodynamicState(object):
         volume = numpy.linalg.det(A) * a.unit**3
         return volume
     
+#=============================================================================================
+# State graphs
+#=============================================================================================
+
+def state_graph_from_edges(nstates, istates, jstates):
+    """
+    Build a symmetric state adjacency graph in compressed sparse row (CSR) form from a list of edges.
+
+    ARGUMENTS
+
+    nstates (int) - number of states
+    istates, jstates (lists or numpy arrays of int) - edge k connects states istates[k] and jstates[k]
+
+    RETURNS
+
+    state_graph (tuple of numpy arrays) - (indptr, indices), where the neighbors of state k are indices[indptr[k]:indptr[k+1]]
+
+    EXAMPLES
+
+    A chain of four states.
+
+    >>> (indptr, indices) = state_graph_from_edges(4, [0, 1, 2], [1, 2, 3])
+    >>> indptr
+    array([0, 1, 3, 5, 6])
+    >>> indices
+    array([1, 0, 2, 1, 3, 2])
+
+    """
+
+    istates = numpy.array(istates, numpy.int64)
+    jstates = numpy.array(jstates, numpy.int64)
+
+    # Symmetrize and remove self-loops and duplicate edges.
+    rows = numpy.concatenate([istates, jstates])
+    columns = numpy.concatenate([jstates, istates])
+    keys = numpy.unique((rows * nstates + columns)[rows != columns]) # sorted by row, then column
+    (rows, indices) = (keys // nstates, keys % nstates)
+
+    # Compress.
+    indptr = numpy.zeros([nstates+1], numpy.int64)
+    indptr[1:] = numpy.cumsum(numpy.bincount(rows, minlength=nstates))
+
+    return (indptr, indices)
+
+def grid_state_graph(shape, periodic=False):
+    """
+    Build the state adjacency graph of a multidimensional grid of states, connecting nearest neighbors along each axis.
+
+    ARGUMENTS
+
+    shape (tuple of int) - number of grid points along each axis; state indices enumerate the grid in C (row-major) order
+
+    OPTIONAL ARGUMENTS
+
+    periodic (boolean) - if True, the grid wraps around along each axis (default: False)
+
+    RETURNS
+
+    state_graph (tuple of numpy arrays) - (indptr, indices) in compressed sparse row form, as for state_graph_from_edges()
+
+    EXAMPLES
+
+    A temperature x Hamiltonian ladder of 3 x 2 states.
+
+    >>> (indptr, indices) = grid_state_graph((3, 2))
+    >>> indices[indptr[2]:indptr[3]]
+    array([0, 3, 4])
+
+    """
+
+    nstates = int(numpy.prod(shape))
+    grid = numpy.arange(nstates).reshape(shape)
+
+    istates = list()
+    jstates = list()
+    for axis in range(len(shape)):
+        neighbors = numpy.roll(grid, -1, axis=axis)
+        if periodic:
+            istates.append(grid.ravel())
+            jstates.append(neighbors.ravel())
+        else:
+            # Exclude the wrapped-around last slice along this axis.
+            interior = [slice(None)] * len(shape)
+            interior[axis] = slice(0, shape[axis]-1)
+            istates.append(grid[tuple(interior)].ravel())
+            jstates.append(neighbors[tuple(interior)].ravel())
+
+    return state_graph_from_edges(nstates, numpy.concatenate(istates), numpy.concatenate(jstates))
+
 #=============================================================================================
 # Replica-exchange simulation
 #=============================================================================================
@@ -361,15 +804,30 @@ class ReplicaExchange(object):
     * number_of_equilibration_iterations (dimensionless) - number of equilibration iterations before begininng exhanges (default: 25)
     * equilibration_timestep (units: time) - timestep for use in equilibration (default: 2 fs)
     * verbose (boolean) - show information on run progress (default: False)
-    * replica_mixing_scheme (string) - scheme used to swap replicas: 'swap-all' or 'swap-neighbors' (default: 'swap-all')
+    * debug (boolean) - perform internal consistency checks, such as of the state-to-replica index after mixing (default: False)
+    * replica_mixing_scheme (string) - scheme used to swap replicas: 'swap-all', 'swap-neighbors', 'swap-graph', 'swap-candidates', or
+      'gibbs-blocks' (default: 'swap-all')
+    * state_graph (tuple of numpy arrays) - (indptr, indices) state adjacency graph in compressed sparse row form for the 'swap-graph'
+      scheme (see state_graph_from_edges() and grid_state_graph()), or None for a chain of states (default: None)
+    * mixing_block_size (dimensionless) - number of neighboring states per block for the 'gibbs-blocks' scheme, at most 8 (default: 6)
+    * candidate_list_size (dimensionless) - number of likely swap partners listed per state for the 'swap-candidates' scheme,
+      or None to use about log2 of the number of states (default: None)
+    * candidate_list_interval (dimensionless) - candidate lists are rebuilt from current energies every this many iterations (default: 10)
+    * max_contexts (dimensionless) - maximum number of OpenMM Context objects kept alive for propagation, or None if unbounded (default: 16)
+    * backend (string) - execution backend for propagation and energy evaluation: 'serial' or 'multiprocessing' (default: 'serial').
+      Worker processes are forked during initialization, so with 'multiprocessing' the integrator parameters and thermodynamic states
+      are frozen once the simulation is initialized, and changing them afterwards raises an exception.
+    * nworkers (dimensionless) - number of worker processes for the 'multiprocessing' backend, or None to use all cores (default: None)
+    * full_energy_interval (dimensionless) - the full energy matrix is computed every this many iterations; on other iterations, only the
+      entries read by the replica mixing scheme are computed and the rest are stored as NaN (default: 1)
+    * positions_storage_interval (dimensionless) - replica positions are written to the store file every this many iterations (default: 1)
+    * mixing_statistics_interval (dimensionless) - state mixing statistics are shown every this many iterations when verbose (default: 10)
     
     TODO
 
     * Replace hard-coded Langevin dynamics with general MCMC moves.
-    * Allow parallel resource to be used, if available (likely via Parallel Python).
     * Add support for and autodetection of other NetCDF4 interfaces.
     * Add HDF5 support.
-    * Cache Context objects to avoid overhead?
 
     EXAMPLES
 
@@ -463,12 +921,26 @@ class ReplicaExchange(object):
         self.platform = None
         self.energy_platform = None        
         self.replica_mixing_scheme = 'swap-all' # mix all replicas thoroughly
+        self.mixing_block_size = 6 # number of states per block for 'gibbs-blocks' mixing
+        self.candidate_list_size = None # number of swap partners per state for 'swap-candidates' mixing, or None for ~log2(nstates)
+        self.candidate_list_interval = 10 # rebuild candidate lists every 10 iterations
+        self.state_graph = None # state adjacency graph for 'swap-graph' mixing, or None for a chain
+        self.max_contexts = 16 # maximum number of Context objects kept alive for propagation
+        self.backend = 'serial' # execution backend for propagation and energy evaluation
+        self.nworkers = None # number of worker processes for 'multiprocessing' backend
+        self.full_energy_interval = 1 # compute the full energy matrix every iteration
+        self.positions_storage_interval = 1 # write positions to the store file every iteration
+        self.mixing_statistics_interval = 10 # show state mixing statistics every 10 iterations
 
         # To allow for parameters to be modified after object creation, class is not initialized until a call to self._initialize().
         self._initialized = False
 
+        # Subclasses whose reduced potentials only depend on the potential energy can capture it at the end of propagation.
+        self._capture_potential_energies = False
+
         # Set verbosity.
         self.verbose = False
+        self.debug = False
         self.show_energies = True
         self.show_mixing_statistics = True
         
@@ -524,44 +996,51 @@ class ReplicaExchange(object):
 
         Any parameter changes (via object attributes) that were made between object creation and calling this method become locked in
         at this point, and the object will create and bind to the store file.  If the store file already exists, the run will be resumed
-        if possible; otherwise, an exception will be raised.
+        if possible; otherwise, an exception will be raised.  The store file is closed and any worker processes are shut down when
+        this method returns, including when an exception is raised.
 
         """
 
         # Make sure we've initialized everything and bound to a storage file before we begin execution.
-        if not self._initialized:
-            self._initialize()
+        success = False
+        try:
+            if not self._initialized:
+                self._initialize()
 
-        # Main loop
-        while (self.iteration < self.number_of_iterations):
-            if self.verbose: print "\nIteration %d / %d" % (self.iteration+1, self.number_of_iterations)
+            # Main loop
+            while (self.iteration < self.number_of_iterations):
+                if self.verbose: print "\nIteration %d / %d" % (self.iteration+1, self.number_of_iterations)
 
-            # Attempt replica swaps to sample from equilibrium permuation of states associated with replicas.
-            self._mix_replicas()
+                # Attempt replica swaps to sample from equilibrium permuation of states associated with replicas.
+                self._mix_replicas()
 
-            # Propagate replicas.
-            self._propagate_replicas()
+                # Propagate replicas.
+                self._propagate_replicas()
 
-            # Compute energies of all replicas at all states.
-            self._compute_energies()
+                # Compute energies of all replicas at all states.
+                self._compute_energies()
 
-            # Show energies.
-            if self.verbose and self.show_energies:
-                self._show_energies()
+                # Show energies.
+                if self.verbose and self.show_energies:
+                    self._show_energies()
 
-            # Write to storage file.
-            self._write_iteration_netcdf()
-            
-            # Increment iteration counter.
-            self.iteration += 1
+                # Accumulate state transition statistics.
+                self._accumulate_state_transitions()
 
-            # Show mixing statistics.
-            if self.verbose:
-                self._show_mixing_statistics()
+                # Write to storage file.
+                self._write_iteration_netcdf()
+            
+                # Increment iteration counter.
+                self.iteration += 1
 
+                # Show mixing statistics.
+                if self.verbose and (self.iteration % self.mixing_statistics_interval == 0):
+                    self._show_mixing_statistics()
 
-        # Clean up and close storage files.
-        self._finalize()
+            success = True
+        finally:
+            # Clean up and close storage files, terminating worker processes if the run failed.
+            self._finalize(terminate=(not success))
 
         return
 
@@ -575,7 +1054,6 @@ class ReplicaExchange(object):
             raise Error
 
         # Select OpenMM Platform.
-        # TODO: Store contexts persistently?        
         if self.platform is None:
             # Find fastest platform.
             fastest_speed = 0.0
@@ -592,27 +1070,48 @@ class ReplicaExchange(object):
         if self.energy_platform is None:
             self.energy_platform = simtk.openmm.Platform.getPlatformByName("Reference")                        
 
+        # Create persistent Context cache for propagation, bounded to avoid exhausting device memory.
+        self._context_cache = ContextCache(capacity=self.max_contexts, mm=self.mm)
+
         # Determine number of alchemical states.
         self.nstates = len(self.states)
 
         # Determine number of atoms in systems.
         self.natoms = self.states[0].system.getNumParticles()
+
+        # Start worker processes, if requested.
+        self._start_workers()
   
         # Allocate storage.
-        self.replica_coordinates = list() # self.replica_coordinates[i] is the configuration currently held in replica i
-        self.replica_states     = numpy.zeros([self.nstates], numpy.int32) # replica_states[i] is the state that replica i is currently at
-        self.u_kl               = numpy.zeros([self.nstates, self.nstates], numpy.float32)        
-        self.swap_Pij_accepted  = numpy.zeros([self.nstates, self.nstates], numpy.float32)
+        # replica_coordinates[i,:,:] is the configuration (in nm) currently held in replica i, and is shared with worker processes if there are any.
+        if self._pool is not None:
+            self.replica_coordinates = self._shared_coordinates
+        else:
+            self.replica_coordinates = numpy.zeros([self.nreplicas, self.natoms, 3], numpy.float64)
+        self.replica_states     = numpy.zeros([self.nreplicas], numpy.int32) # replica_states[i] is the state that replica i is currently at
+        self.state_replicas     = numpy.zeros([self.nstates], numpy.int32) # state_replicas[k] is the replica currently at state k (inverse of replica_states, if there is one replica per state)
+        self.u_kl               = numpy.zeros([self.nreplicas, self.nstates], numpy.float32) # u_kl[i,k] is the reduced potential of replica i at state k
+        self.replica_potential_energies = numpy.nan * numpy.ones([self.nreplicas], numpy.float64) # replica_potential_energies[i] is the potential energy (in kJ/mol) of replica i captured at the end of propagation, or NaN
+        self.swap_Pij_accepted  = numpy.zeros([self.nstates, self.nstates], numpy.float64) # swap_Pij_accepted[i][j] is the cumulative estimate of the probability of a swap from state i to state j
         self.Nij_proposed       = numpy.zeros([self.nstates,self.nstates], numpy.int64) # Nij_proposed[i][j] is the number of swaps proposed between states i and j, prior of 1
         self.Nij_accepted       = numpy.zeros([self.nstates,self.nstates], numpy.int64) # Nij_proposed[i][j] is the number of swaps proposed between states i and j, prior of 1
+        self.Nij_proposed_cumulative = numpy.zeros([self.nstates,self.nstates], numpy.int64) # Nij_proposed_cumulative[i][j] is the number of swaps proposed between states i and j over all iterations
+        self.Nij_accepted_cumulative = numpy.zeros([self.nstates,self.nstates], numpy.int64) # Nij_accepted_cumulative[i][j] is the number of swaps accepted between states i and j over all iterations
+        self.Nij_transitions    = numpy.zeros([self.nstates,self.nstates], numpy.int64) # Nij_transitions[i][j] is the number of times a replica in state i was found in state j on the next iteration
+        self._previous_replica_states = None # replica states at the previous stored iteration
+        self._block_permutations = dict() # _block_permutations[b] is an array of all permutations of b states, for 'gibbs-blocks' mixing
+        self._candidate_pairs = None # candidate state pairs for 'swap-candidates' mixing
+        self._candidate_pairs_iteration = None # iteration at which candidate pairs were last rebuilt
+        self._state_graph_colors = None # state graph edges partitioned into classes of disjoint pairs, for 'swap-graph' mixing
 
         # Distribute coordinate information to replicas in a round-robin fashion.
-        self.replica_coordinates = [ copy.deepcopy(self.provided_coordinates[replica_index % len(self.provided_coordinates)]) for replica_index in range(self.nstates) ]
-        #self.replica_coordinates = [ self.provided_coordinates[replica_index % len(self.provided_coordinates)] for replica_index in range(self.nstates) ]
+        for replica_index in range(self.nreplicas):
+            self.replica_coordinates[replica_index,:,:] = self.provided_coordinates[replica_index % len(self.provided_coordinates)] / units.nanometers
         
         # Assign initial replica states.
-        for replica_index in range(self.nstates):
+        for replica_index in range(self.nreplicas):
             self.replica_states[replica_index] = replica_index
+        self.state_replicas[self.replica_states] = numpy.arange(self.nreplicas)
 
         # Check if netcdf file extists.
         if os.path.exists(self.store_filename) and (os.path.getsize(self.store_filename) > 0):
@@ -642,6 +1141,7 @@ class ReplicaExchange(object):
             self._initialize_netcdf()
 
             # Store initial state.
+            self._accumulate_state_transitions()
             self._write_iteration_netcdf()
   
         # Signal that the class has been initialized.
@@ -649,60 +1149,176 @@ class ReplicaExchange(object):
 
         return
 
-    def _finalize(self):
+    def _finalize(self, terminate=False):
         """
         Do anything necessary to clean up.
 
+        OPTIONAL ARGUMENTS
+
+        terminate (boolean) - if True, worker processes are stopped without waiting for outstanding tasks, as after an error (default: False)
+
+        NOTES
+
+        This may be called after initialization failed part way, so only resources that were created are released.
+
         """
 
-        self.ncfile.close()
+        # Close the store file.
+        if getattr(self, 'ncfile', None) is not None:
+            self.ncfile.close()
+            self.ncfile = None
+
+        # Release cached Context objects.
+        if getattr(self, '_context_cache', None) is not None:
+            self._context_cache.invalidate()
+
+        # Shut down worker processes.
+        if getattr(self, '_pool', None) is not None:
+            if terminate:
+                self._pool.terminate()
+            else:
+                self._pool.close()
+            self._pool.join()
+            self._pool = None
 
         return
 
-    def _propagate_replicas(self):
+    def _start_workers(self):
         """
-        Propagate all replicas.
+        Start the process pool used by the 'multiprocessing' backend.
 
-        TODO
+        NOTES
 
-        * Parallel implementation
+        Worker processes are forked from this process, and so inherit the thermodynamic states and simulation parameters as
+        they are at this point.  Later changes made here are not seen by the workers, so the attributes they read are recorded
+        (see _worker_protocol()) and checked before each batch of tasks by _map_workers().
+        Each worker keeps its own cached Contexts, so the pool must be started before any Context is created here.
+        Replica coordinates are exchanged with workers through a shared-memory buffer, and only indices and energies are
+        passed through the pool.  This backend is intended for the CPU and Reference platforms on a single node.
 
         """
 
-        start_time = time.time()
-
-        # Propagate all replicas.
-        if self.verbose: print "Propagating all replicas for %.3f ps..." % (self.nsteps_per_iteration * self.timestep / units.picoseconds)
-        for replica_index in range(self.nstates):
-            #if self.verbose: print "replica %d / %d" % (replica_index, self.nstates)
-            # Retrieve state.
-            state_index = self.replica_states[replica_index] # index of thermodynamic state that current replica is assigned to
-            state = self.states[state_index] # thermodynamic state
-            # Create integrator and context.
-            integrator = self.mm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
-            context = self.mm.Context(state.system, integrator, self.platform)                        
-            # Set coordinates.
-            coordinates = self.replica_coordinates[replica_index]            
-            context.setPositions(coordinates)
-            # Assign Maxwell-Boltzmann velocities.
-            context.setVelocitiesToTemperature(state.temperature)
-            # Run dynamics.
-            integrator.step(self.nsteps_per_iteration)
-            # Store final coordinates
-            openmm_state = context.getState(getPositions=True)
-            self.replica_coordinates[replica_index] = openmm_state.getPositions(asNumpy=True)
-            # Clean up.
-            del context
-            del integrator
+        global _worker_simulation, _worker_coordinates
 
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        time_per_replica = elapsed_time / float(self.nstates)
-        ns_per_day = self.timestep * self.nsteps_per_iteration / time_per_replica * 24*60*60 / units.nanoseconds
-        if self.verbose: print "Time to propagate all replicas %.3f s (%.3f per replica, %.3f ns/day).\n" % (elapsed_time, time_per_replica, ns_per_day)
+        self._pool = None
+        if self.backend == 'serial':
+            return
+        elif self.backend != 'multiprocessing':
+            raise ParameterException("Execution backend '%s' unknown.  Choose valid 'backend' parameter." % self.backend)
+
+        # Allocate shared-memory coordinate buffer, which will also hold replica_coordinates in this process.
+        buffer = multiprocessing.RawArray('d', self.nreplicas * self.natoms * 3)
+        self._shared_coordinates = numpy.frombuffer(buffer, dtype=numpy.float64).reshape([self.nreplicas, self.natoms, 3])
+
+        # Fork worker processes.
+        _worker_simulation = self
+        _worker_coordinates = self._shared_coordinates
+        nworkers = self.nworkers
+        if nworkers is None: nworkers = multiprocessing.cpu_count()
+        if self.verbose: print "Starting %d worker processes..." % nworkers
+        self._pool = multiprocessing.Pool(nworkers)
+        self._frozen_worker_protocol = self._worker_protocol()
 
         return
 
+    def _worker_protocol(self):
+        """
+        Return the simulation parameters and thermodynamic states read by worker processes, as plain values that can be compared.
+
+        NOTES
+
+        Linear-basis data of HamiltonianExchange is not included, since energies are formed from it in this process only.
+
+        """
+
+        states = [ (id(state.system), state.temperature / units.kelvin, (state.pressure / units.atmospheres) if (state.pressure is not None) else None,
+                    tuple(sorted((state.parameters or dict()).items()))) for state in self.states ]
+        protocol = (self.nsteps_per_iteration, self.timestep / units.picoseconds, self.collision_rate * units.picoseconds, self._capture_potential_energies,
+                    self.platform.getName(), self.energy_platform.getName(), states)
+
+        return protocol
+
+    def _map_workers(self, function, tasks):
+        """
+        Run tasks on the worker processes, after checking that the parameters the workers were forked with are still current.
+
+        ARGUMENTS
+
+        function (function) - module-level worker function to apply to each task
+        tasks (list) - tasks to run
+
+        RETURNS
+
+        results (list) - results of the tasks, in order
+
+        """
+
+        if self._worker_protocol() != self._frozen_worker_protocol:
+            raise ParameterException("Simulation parameters or thermodynamic states were changed after worker processes were started with the 'multiprocessing' backend; set them before the simulation is initialized.")
+
+        return self._pool.map(function, tasks)
+
+    def _propagate_replicas(self):
+        """
+        Propagate all replicas.
+
+        """
+
+        start_time = time.time()
+
+        # Propagate all replicas.
+        if self.verbose: print "Propagating all replicas for %.3f ps..." % (self.nsteps_per_iteration * self.timestep / units.picoseconds)
+        if self._pool is None:
+            for replica_index in range(self.nreplicas):
+                #if self.verbose: print "replica %d / %d" % (replica_index, self.nreplicas)
+                state_index = self.replica_states[replica_index] # index of thermodynamic state that current replica is assigned to
+                self.replica_potential_energies[replica_index] = self._propagate_replica(self.replica_coordinates[replica_index], state_index)
+        else:
+            # Propagate replicas on worker processes, which update coordinates in shared memory.
+            tasks = [ (replica_index, self.replica_states[replica_index]) for replica_index in range(self.nreplicas) ]
+            self.replica_potential_energies[:] = self._map_workers(_propagate_replica_worker, tasks)
+
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        time_per_replica = elapsed_time / float(self.nreplicas)
+        ns_per_day = self.timestep * self.nsteps_per_iteration / time_per_replica * 24*60*60 / units.nanoseconds
+        if self.verbose: print "Time to propagate all replicas %.3f s (%.3f per replica, %.3f ns/day).\n" % (elapsed_time, time_per_replica, ns_per_day)
+
+        return
+
+    def _propagate_replica(self, coordinates, state_index):
+        """
+        Propagate a single replica at the specified thermodynamic state.
+
+        ARGUMENTS
+
+        coordinates (natoms x 3 numpy.array) - coordinates of the replica (in nm), which are updated in place
+        state_index (int) - index of thermodynamic state the replica is assigned to
+
+        RETURNS
+
+        potential_energy (float) - potential energy (in kJ/mol) of the final configuration if '_capture_potential_energies' is set, or NaN
+
+        """
+
+        # Retrieve state.
+        state = self.states[state_index] # thermodynamic state
+        # Retrieve persistent context, updating integrator parameters in place.
+        [context, integrator] = self._context_cache.get_context(state.system, self.platform, parameters=state.parameters, temperature=state.temperature, collision_rate=self.collision_rate, timestep=self.timestep)
+        # Set coordinates.
+        context.setPositions(units.Quantity(coordinates, units.nanometers))
+        # Assign Maxwell-Boltzmann velocities.
+        context.setVelocitiesToTemperature(state.temperature)
+        # Run dynamics.
+        integrator.step(self.nsteps_per_iteration)
+        # Store final coordinates, and potential energy if requested.
+        openmm_state = context.getState(getPositions=True, getEnergy=self._capture_potential_energies)
+        coordinates[:,:] = openmm_state.getPositions(asNumpy=True) / units.nanometers
+        if self._capture_potential_energies:
+            return openmm_state.getPotentialEnergy() / units.kilojoules_per_mole
+
+        return numpy.nan
+
     def _minimize_and_equilibrate(self):
         """
         Minimize and equilibrate all replicas.
@@ -716,53 +1332,44 @@ class ReplicaExchange(object):
         # Minimize
         if self.minimize:
             if self.verbose: print "Minimizing all replicas..."
-            for replica_index in range(self.nstates):
+            for replica_index in range(self.nreplicas):
                 # Retrieve thermodynamic state.
                 state_index = self.replica_states[replica_index] # index of thermodynamic state that current replica is assigned to
                 state = self.states[state_index] # thermodynamic state
-                # Retrieve coordinates.
-                coordinates = self.replica_coordinates[replica_index]
-                # Create integrator and context.
-                integrator = self.mm.VerletIntegrator(self.equilibration_timestep)
-                context = self.mm.Context(state.system, integrator, self.platform)                        
+                # Retrieve persistent context.
+                [context, integrator] = self._context_cache.get_context(state.system, self.platform, parameters=state.parameters)
                 # Set coordinates.
-                coordinates = self.replica_coordinates[replica_index]            
-                context.setPositions(coordinates)
+                context.setPositions(units.Quantity(self.replica_coordinates[replica_index], units.nanometers))
                 # Minimize.
                 tolerance = 1.0 * units.kilocalories_per_mole / units.nanometer
                 maximum_evaluations = 1000
-                openmm.LocalEnergyMinimizer.minimize(context, tolerance, maximum_evaluations)
+                self.mm.LocalEnergyMinimizer.minimize(context, tolerance, maximum_evaluations)
                 # Store final coordinates
                 openmm_state = context.getState(getPositions=True)
-                self.replica_coordinates[replica_index] = openmm_state.getPositions(asNumpy=True)
-                # Clean up.
-                del context
-                del integrator
+                self.replica_coordinates[replica_index,:,:] = openmm_state.getPositions(asNumpy=True) / units.nanometers
 
         # Equilibrate    
         for iteration in range(self.number_of_equilibration_iterations):
             if self.verbose: print "equilibration iteration %d / %d" % (iteration, self.number_of_equilibration_iterations)
-            for replica_index in range(self.nstates):
-                if self.verbose: print "replica %d / %d" % (replica_index, self.nstates)
+            for replica_index in range(self.nreplicas):
+                if self.verbose: print "replica %d / %d" % (replica_index, self.nreplicas)
                 # Retrieve thermodynamic state.
                 state_index = self.replica_states[replica_index] # index of thermodynamic state that current replica is assigned to
                 state = self.states[state_index] # thermodynamic state
-                # Create integrator and context.
-                integrator = self.mm.LangevinIntegrator(state.temperature, self.collision_rate, self.equilibration_timestep)
-                context = self.mm.Context(state.system, integrator, self.platform)                        
+                # Retrieve persistent context, updating integrator parameters in place.
+                [context, integrator] = self._context_cache.get_context(state.system, self.platform, parameters=state.parameters, temperature=state.temperature, collision_rate=self.collision_rate, timestep=self.equilibration_timestep)
                 # Set coordinates.
-                coordinates = self.replica_coordinates[replica_index]            
-                context.setPositions(coordinates)
+                context.setPositions(units.Quantity(self.replica_coordinates[replica_index], units.nanometers))
                 # Assign Maxwell-Boltzmann velocities.
                 context.setVelocitiesToTemperature(state.temperature)
                 # Run dynamics.
                 integrator.step(self.nsteps_per_iteration)
                 # Store final coordinates
                 openmm_state = context.getState(getPositions=True)
-                self.replica_coordinates[replica_index] = openmm_state.getPositions(asNumpy=True)
-                # Clean up.
-                del context
-                del integrator
+                self.replica_coordinates[replica_index,:,:] = openmm_state.getPositions(asNumpy=True) / units.nanometers
+
+        # Potential energies captured during propagation no longer correspond to the replica coordinates.
+        self.replica_potential_energies[:] = numpy.nan
 
         return
 
@@ -770,24 +1377,147 @@ class ReplicaExchange(object):
         """
         Compute energies of all replicas at all states.
 
+        NOTES
+
+        Unless this is an iteration on which the full energy matrix is requested (see 'full_energy_interval'), only the
+        entries that will be read by the replica mixing scheme are computed, and all other entries are set to NaN.
+
         TODO
 
         * We have to re-order Context initialization if we have variable box volume
-        * Parallel implementation
         
         """
 
         start_time = time.time()
         
+        # Determine which energies need to be computed.
+        required = None
+        if (self.full_energy_interval is not None) and (self.iteration % self.full_energy_interval != 0):
+            required = self._required_energies()
+
+        # Determine which replicas are to be evaluated at each state; each state fills one column of u_kl.
+        if required is None:
+            nenergies = self.nreplicas * self.nstates
+            tasks = [ (state_index, numpy.arange(self.nreplicas)) for state_index in range(self.nstates) ]
+        else:
+            nenergies = required.sum()
+            self.u_kl[:,:] = numpy.nan
+            tasks = [ (state_index, numpy.where(required[:,state_index])[0]) for state_index in range(self.nstates) ]
+            tasks = [ (state_index, replica_indices) for (state_index, replica_indices) in tasks if len(replica_indices) > 0 ]
+
         if self.verbose: print "Computing energies..."
-        for state_index in range(self.nstates):
-            for replica_index in range(self.nstates):
-                self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_coordinates[replica_index], platform=self.energy_platform)
-                
+        if self._pool is None:
+            for (state_index, replica_indices) in tasks:
+                coordinates_list = [ units.Quantity(self.replica_coordinates[replica_index], units.nanometers) for replica_index in replica_indices ]
+                self.u_kl[replica_indices,state_index] = self.states[state_index].reduced_potentials(coordinates_list, platform=self.energy_platform)
+        else:
+            # Evaluate states on worker processes, which read coordinates from shared memory.
+            results = self._map_workers(_compute_energies_worker, tasks)
+            for ((state_index, replica_indices), u) in zip(tasks, results):
+                self.u_kl[replica_indices,state_index] = u
+
         end_time = time.time()
         elapsed_time = end_time - start_time
-        time_per_energy= elapsed_time / float(self.nstates)**2 
-        if self.verbose: print "Time to compute all energies %.3f s (%.3f per energy calculation).\n" % (elapsed_time, time_per_energy)
+        time_per_energy= elapsed_time / float(nenergies)
+        if self.verbose: print "Time to compute %d energies %.3f s (%.3f per energy calculation).\n" % (nenergies, elapsed_time, time_per_energy)
+
+        return
+
+    def _required_energies(self):
+        """
+        Determine which entries of the energy matrix will be read by the replica mixing scheme.
+
+        RETURNS
+
+        required (numpy.array of bool, or None) - required[i,j] is True if the reduced potential of replica i at state j
+           will be read by the next mixing step, or None if all entries are needed
+
+        NOTES
+
+        For 'swap-neighbors', each replica needs only its own state and the two states adjacent to it, so roughly 3N
+        energies are required instead of N^2.  For 'gibbs-blocks', a replica can move up to b-1 states in each of the two
+        sweeps, so states within 2(b-1) of its own are required.  All other schemes require the full matrix.
+
+        """
+
+        if self.replica_mixing_scheme in ['swap-neighbors', 'gibbs-blocks']:
+            if self.replica_mixing_scheme == 'swap-neighbors':
+                max_offset = 1
+            else:
+                max_offset = 2 * (self.mixing_block_size - 1)
+            required = numpy.zeros([self.nreplicas, self.nstates], numpy.bool_)
+            replica_indices = numpy.arange(self.nreplicas)
+            for offset in range(-max_offset, max_offset+1):
+                state_indices = self.replica_states + offset
+                valid = (state_indices >= 0) & (state_indices < self.nstates)
+                required[replica_indices[valid], state_indices[valid]] = True
+            return required
+
+        return None
+
+    def _attempt_swaps(self, istates, jstates, u_kl, uniforms=None):
+        """
+        Attempt simultaneous Metropolis swaps between disjoint pairs of states.
+
+        ARGUMENTS
+
+        istates (numpy int array) - first state of each pair
+        jstates (numpy int array) - second state of each pair
+        u_kl (numpy float64 array) - u_kl[replica,state] is the reduced potential of the configuration of replica in state
+
+        OPTIONAL ARGUMENTS
+
+        uniforms (numpy float64 array) - uniform random numbers on [0,1) to use for acceptance, one per pair (default: drawn here)
+
+        RETURNS
+
+        proposed (numpy bool array) - proposed[k] is True if pair k was proposed (swaps involving NaN energies are not)
+        accepted (numpy bool array) - accepted[k] is True if the swap of pair k was accepted
+
+        NOTES
+
+        No state may appear more than once in istates and jstates combined.  Swaps of disjoint pairs commute, so attempting
+        them all at once is equivalent to attempting them one after another.  Both replica_states and state_replicas are updated.
+
+        """
+
+        # Determine which replicas these states correspond to.
+        i = self.state_replicas[istates]
+        j = self.state_replicas[jstates]
+
+        # Compute log probability of swap, rejecting swap attempts if any energies are nan.
+        log_P_accept = - (u_kl[i,jstates] + u_kl[j,istates]) + (u_kl[i,istates] + u_kl[j,jstates])
+        proposed = ~numpy.isnan(log_P_accept)
+        log_P_accept[~proposed] = -numpy.inf
+
+        # Accept or reject.
+        if uniforms is None:
+            uniforms = numpy.random.rand(len(istates))
+        accepted = (uniforms < numpy.exp(numpy.minimum(log_P_accept, 0.0)))
+
+        # Swap states in accepted replica slots.
+        (i, j, istates, jstates) = (i[accepted], j[accepted], istates[accepted], jstates[accepted])
+        self.replica_states[i] = jstates
+        self.replica_states[j] = istates
+        self.state_replicas[istates] = j
+        self.state_replicas[jstates] = i
+
+        return (proposed, accepted)
+
+    def _record_swaps(self, istates, jstates, proposed, accepted):
+        """
+        Accumulate statistics of proposed and accepted swaps into Nij_proposed and Nij_accepted.
+
+        ARGUMENTS
+
+        istates, jstates (numpy int arrays) - states of each pair for which a swap was attempted
+        proposed, accepted (numpy bool arrays) - whether each swap was proposed and accepted, as returned by _attempt_swaps()
+
+        """
+
+        for (Nij, mask) in [(self.Nij_proposed, proposed), (self.Nij_accepted, accepted)]:
+            numpy.add.at(Nij, (istates[mask], jstates[mask]), 1)
+            numpy.add.at(Nij, (jstates[mask], istates[mask]), 1)
 
         return
 
@@ -795,6 +1525,12 @@ class ReplicaExchange(object):
         """
         Attempt exchanges between all replicas to enhance mixing.
 
+        NOTES
+
+        Swaps are attempted in rounds.  Each round pairs up all states by a random permutation and attempts the resulting
+        disjoint swaps at once with _attempt_swaps(), so every attempt is a Metropolis swap between a uniformly chosen pair
+        of states, as if attempted one at a time.  Random permutations and uniforms are drawn in bulk for blocks of rounds.
+
         TODO
 
         * Adjust nswap_attempts based on how many we can afford to do and not have mixing take a substantial fraction of iteration time.
@@ -803,115 +1539,303 @@ class ReplicaExchange(object):
 
         # Determine number of swaps to attempt to ensure thorough mixing.
         # TODO: Replace this with analytical result computed to guarantee sufficient mixing.
-        nswap_attempts = self.nstates**5 # number of swaps to attempt (ideal, but too slow!)
-        nswap_attempts = self.nstates**3 # best compromise for pure Python?
+        nswap_attempts = self.nstates**3 # number of swaps to attempt
+        npairs = self.nstates / 2 # number of disjoint pairs attempted per round
+        if npairs == 0:
+            return
+        nrounds = (nswap_attempts + npairs - 1) / npairs # number of rounds of swap attempts
         
-        if self.verbose: print "Will attempt to swap all pairs of replicas, using a total of %d attempts." % nswap_attempts
+        if self.verbose: print "Will attempt to swap all pairs of replicas, using a total of %d attempts." % (nrounds * npairs)
 
-        # Attempt swaps to mix replicas.
-        for swap_attempt in range(nswap_attempts):
-            # Choose replicas to attempt to swap.
-            i = numpy.random.randint(self.nstates) # Choose replica i uniformly from set of replicas.
-            j = numpy.random.randint(self.nstates) # Choose replica j uniformly from set of replicas.
+        # Stage energies.
+        u_kl = numpy.array(self.u_kl, numpy.float64)
 
-            # Determine which states these resplicas correspond to.
-            istate = self.replica_states[i] # state in replica slot i
-            jstate = self.replica_states[j] # state in replica slot j
+        # Attempt swaps to mix replicas, drawing random numbers for blocks of rounds at a time to bound memory use.
+        start_time = time.time()
+        nrounds_per_block = max(1, 2**20 / self.nstates)
+        for first_round in range(0, nrounds, nrounds_per_block):
+            nblock = min(nrounds_per_block, nrounds - first_round)
 
-            # Reject swap attempt if any energies are nan.
-            if (numpy.isnan(self.u_kl[i,jstate]) or numpy.isnan(self.u_kl[j,istate]) or numpy.isnan(self.u_kl[i,istate]) or numpy.isnan(self.u_kl[j,jstate])):
-                continue
+            # Choose pairs of states to attempt to swap from random permutations of all states.
+            pairings = numpy.argsort(numpy.random.rand(nblock, self.nstates), axis=1)
+            istates = pairings[:,0:2*npairs:2]
+            jstates = pairings[:,1:2*npairs:2]
+            uniforms = numpy.random.rand(nblock, npairs)
 
-            # Compute log probability of swap.
-            log_P_accept = - (self.u_kl[i,jstate] + self.u_kl[j,istate]) + (self.u_kl[i,istate] + self.u_kl[j,jstate])
+            # Attempt swaps.
+            proposed = numpy.zeros([nblock, npairs], numpy.bool_)
+            accepted = numpy.zeros([nblock, npairs], numpy.bool_)
+            for round_index in range(nblock):
+                (proposed[round_index,:], accepted[round_index,:]) = self._attempt_swaps(istates[round_index,:], jstates[round_index,:], u_kl, uniforms[round_index,:])
 
-            #print "replica (%3d,%3d) states (%3d,%3d) energies (%8.1f,%8.1f) %8.1f -> (%8.1f,%8.1f) %8.1f : log_P_accept %8.1f" % (i,j,istate,jstate,self.u_kl[i,istate],self.u_kl[j,jstate],self.u_kl[i,istate]+self.u_kl[j,jstate],self.u_kl[i,jstate],self.u_kl[j,istate],self.u_kl[i,jstate]+self.u_kl[j,istate],log_P_accept)
+            # Accumulate statistics.
+            self._record_swaps(istates, jstates, proposed, accepted)
+        elapsed_time = time.time() - start_time
 
-            # Record that this move has been proposed.
-            self.Nij_proposed[istate,jstate] += 1
-            self.Nij_proposed[jstate,istate] += 1
+        if self.verbose: print "%d swap attempts in %.3f s (%.0f attempts/s)" % (nrounds * npairs, elapsed_time, (nrounds * npairs) / max(elapsed_time, 1.0e-6))
 
-            # Accept or reject.
-            if (log_P_accept >= 0.0 or (numpy.random.rand() < math.exp(log_P_accept))):
-                # Swap states in replica slots i and j.
-                (self.replica_states[i], self.replica_states[j]) = (self.replica_states[j], self.replica_states[i])
-                # Accumulate statistics
-                self.Nij_accepted[istate,jstate] += 1
-                self.Nij_accepted[jstate,istate] += 1
+        return
+
+    def _build_candidate_pairs(self, u_kl):
+        """
+        Build the symmetric set of candidate state pairs for 'swap-candidates' mixing from the current energies.
+
+        ARGUMENTS
+
+        u_kl (numpy float64 array) - u_kl[replica,state] is the reduced potential of the configuration of replica in state, with no NaN entries
+
+        RETURNS
+
+        istates, jstates (numpy int arrays) - candidate pairs, with istates[k] < jstates[k]
+
+        NOTES
+
+        Each state lists the 'candidate_list_size' other states (default: about log2 of the number of states) with the best
+        estimated phase-space overlap, plus its two neighbors in state index so that the candidate graph stays connected.  A
+        pair is a candidate if either state lists the other.
+
+        Overlap between states k and l is ranked by the variance of u_l(x) - u_k(x) over all current configurations, which is
+        small when swaps between k and l are likely to be accepted.  This depends only on the set of rows of u_kl, and not on
+        which replica holds which state, so the candidate pairs do not depend on the current state assignment.
+
+        To avoid forming all N^2 pairwise variances for N states, each state is only compared with the 2m states nearest in
+        state index and m further states drawn at random, where m is the number of candidates per state.  The random draws do
+        not depend on the state assignment either.  A rebuild therefore costs O(N^2 m) operations, proportional to the size of
+        u_kl, and O(N m) memory beyond u_kl itself.
+
+        """
+
+        # Determine number of candidates per state.
+        ncandidates = self.candidate_list_size
+        if ncandidates is None:
+            ncandidates = int(math.ceil(math.log(self.nstates, 2)))
+        ncandidates = max(1, min(ncandidates, self.nstates - 1))
+
+        # Choose the partners each state is compared with: a window of neighbors in state index, and random states.
+        states = numpy.arange(self.nstates)
+        offsets = numpy.concatenate([numpy.arange(-ncandidates, 0), numpy.arange(1, ncandidates+1)])
+        partners = states[:,numpy.newaxis] + offsets[numpy.newaxis,:]
+        partners[(partners < 0) | (partners >= self.nstates)] = -1
+        partners = numpy.concatenate([partners, numpy.random.randint(0, self.nstates, size=[self.nstates, ncandidates])], axis=1)
+        partners[partners == states[:,numpy.newaxis]] = -1
+        partners.sort(axis=1)
+        partners[:,1:][partners[:,1:] == partners[:,:-1]] = -1
+
+        # Compute variances of reduced potential differences to each partner over all configurations, one column of partners at a time.
+        du_kl = u_kl - u_kl.mean(0)[numpy.newaxis,:]
+        difference_variance = numpy.inf * numpy.ones(partners.shape, numpy.float64)
+        for column in range(partners.shape[1]):
+            valid = (partners[:,column] >= 0)
+            difference = du_kl[:,partners[valid,column]] - du_kl[:,valid]
+            difference_variance[valid,column] = (difference**2).mean(0)
+
+        # Select partners of each state with the best overlap, and neighbors in state index.
+        selected = numpy.argpartition(difference_variance, ncandidates-1, axis=1)[:,0:ncandidates]
+        candidates = partners[states[:,numpy.newaxis],selected]
+        istates = numpy.concatenate([numpy.repeat(states, ncandidates), states[0:-1]])
+        jstates = numpy.concatenate([candidates.ravel(), states[1:]])
+        keep = (jstates >= 0)
+        (istates, jstates) = (istates[keep], jstates[keep])
+
+        # Symmetrize, and remove duplicate pairs.
+        keys = numpy.unique(numpy.minimum(istates, jstates) * self.nstates + numpy.maximum(istates, jstates))
+        (istates, jstates) = (keys // self.nstates, keys % self.nstates)
+
+        return (istates, jstates)
+
+    def _mix_candidate_replicas(self):
+        """
+        Attempt exchanges between pairs of states drawn from sparse candidate lists of likely swap partners.
+
+        NOTES
+
+        The candidate pairs are rebuilt by _build_candidate_pairs() every 'candidate_list_interval' iterations and are fixed in
+        between.  They are only rebuilt when the full energy matrix is available, and until then neighboring states are used.
+        Each round picks a random set of disjoint candidate pairs (a pair is picked if its random priority is the lowest of all
+        candidate pairs touching either of its states) and attempts those swaps with _attempt_swaps().
+
+        Neither the candidate pairs nor the pairs picked depend on which replicas hold which states.  The proposal is therefore
+        symmetric in the state assignment, including on iterations when the candidates are rebuilt, and Metropolis acceptance
+        preserves detailed balance.
+
+        About four swaps are attempted per candidate pair, so mixing itself costs O(N log N) for N states.  Each rebuild of the
+        candidate pairs costs O(N^2 log N), proportional to the size of the energy matrix, amortized over 'candidate_list_interval'
+        iterations.
+
+        """
+
+        if self.nstates < 2:
+            return
+
+        # Stage energies.
+        u_kl = numpy.array(self.u_kl, numpy.float64)
+
+        # Refresh candidate pairs periodically, from full energy matrices only, since which entries are computed otherwise depends on the state assignment.
+        if (self._candidate_pairs is None) or (self.iteration - self._candidate_pairs_iteration >= self.candidate_list_interval):
+            if not numpy.isnan(u_kl).any():
+                self._candidate_pairs = self._build_candidate_pairs(u_kl)
+                self._candidate_pairs_iteration = self.iteration
+        if self._candidate_pairs is not None:
+            (istates, jstates) = self._candidate_pairs
+        else:
+            (istates, jstates) = (numpy.arange(self.nstates-1), numpy.arange(1, self.nstates))
+        npairs = len(istates)
+
+        # Determine number of swaps to attempt.
+        nswap_attempts = 4 * npairs
+
+        if self.verbose: print "Will attempt to swap %d candidate pairs of states, using a total of %d attempts." % (npairs, nswap_attempts)
+
+        # Attempt swaps, drawing random priorities for blocks of rounds at a time to bound memory use.
+        start_time = time.time()
+        nattempted = 0
+        nrounds_per_block = max(1, min(64, 2**20 / npairs))
+        while nattempted < nswap_attempts:
+            # Pick disjoint pairs in each round: a pair is picked if its priority is the lowest of any pair touching either of its states.
+            priorities = numpy.random.rand(nrounds_per_block, npairs)
+            round_offsets = (self.nstates * numpy.arange(nrounds_per_block))[:,numpy.newaxis]
+            state_priorities = 2.0 * numpy.ones([nrounds_per_block * self.nstates], numpy.float64)
+            numpy.minimum.at(state_priorities, (round_offsets + istates).ravel(), priorities.ravel())
+            numpy.minimum.at(state_priorities, (round_offsets + jstates).ravel(), priorities.ravel())
+            state_priorities = state_priorities.reshape([nrounds_per_block, self.nstates])
+            picked = (priorities == state_priorities[:,istates]) & (priorities == state_priorities[:,jstates])
+
+            for round_index in range(nrounds_per_block):
+                if nattempted >= nswap_attempts:
+                    break
+                (round_istates, round_jstates) = (istates[picked[round_index,:]], jstates[picked[round_index,:]])
+                (proposed, accepted) = self._attempt_swaps(round_istates, round_jstates, u_kl)
+                self._record_swaps(round_istates, round_jstates, proposed, accepted)
+                nattempted += len(round_istates)
+        elapsed_time = time.time() - start_time
+
+        if self.verbose: print "%d swap attempts in %.3f s (%.0f attempts/s)" % (nattempted, elapsed_time, nattempted / max(elapsed_time, 1.0e-6))
 
         return
 
-    def _mix_all_replicas_weave(self):
+    def _mix_replica_blocks(self):
         """
-        Attempt exchanges between all replicas to enhance mixing.
-        Acceleration by 'weave' from scipy is used to speed up mixing by ~ 400x.
-        
+        Sample exactly from the distribution of state permutations within blocks of neighboring states (block Gibbs sampling).
+
+        NOTES
+
+        States are partitioned into contiguous blocks of up to 'mixing_block_size' states.  Within each block, all b!
+        assignments of the block's replicas to the block's states are enumerated and one is drawn from its exact Boltzmann
+        probability using log-sum-exp.  Two sweeps are made per call, the second with blocks offset by half a block, so that
+        replicas can cross block boundaries.
+
         """
 
-        # Determine number of swaps to attempt to ensure thorough mixing.
-        # TODO: Replace this with analytical result computed to guarantee sufficient mixing.
-        nswap_attempts = self.nstates**3 # number of swaps to attempt (ideal, but too slow!)
-        # Handled in C code below.
-        
-        if self.verbose: print "Will attempt to swap all pairs of replicas using weave-accelerated code, using a total of %d attempts." % nswap_attempts
-
-        from scipy import weave
-
-        # TODO: Replace drand48 with numpy random generator.
-        code = """
-        // Determine number of swap attempts.
-        // TODO: Replace this with analytical result computed to guarantee sufficient mixing.        
-        long nswap_attempts = nstates*nstates*nstates; 
-
-        // Attempt swaps.
-        for(long swap_attempt = 0; swap_attempt < nswap_attempts; swap_attempt++) {
-            // Choose replicas to attempt to swap.
-            int i = (long)(drand48() * nstates); 
-            int j = (long)(drand48() * nstates);
-
-            // Determine which states these resplicas correspond to.            
-            int istate = REPLICA_STATES1(i); // state in replica slot i
-            int jstate = REPLICA_STATES1(j); // state in replica slot j
-
-            // Reject swap attempt if any energies are nan.
-            if ((std::isnan(U_KL2(i,jstate)) || std::isnan(U_KL2(j,istate)) || std::isnan(U_KL2(i,istate)) || std::isnan(U_KL2(j,jstate))))
-               continue;
-
-            // Compute log probability of swap.
-            double log_P_accept = - (U_KL2(i,jstate) + U_KL2(j,istate)) + (U_KL2(i,istate) + U_KL2(j,jstate));
-
-            // Record that this move has been proposed.
-            NIJ_PROPOSED2(istate,jstate) += 1;
-            NIJ_PROPOSED2(jstate,istate) += 1;
-
-            // Accept or reject.
-            if (log_P_accept >= 0.0 || (drand48() < exp(log_P_accept))) {
-                // Swap states in replica slots i and j.
-                int tmp = REPLICA_STATES1(i);
-                REPLICA_STATES1(i) = REPLICA_STATES1(j);
-                REPLICA_STATES1(j) = tmp;
-                // Accumulate statistics
-                NIJ_ACCEPTED2(istate,jstate) += 1;
-                NIJ_ACCEPTED2(jstate,istate) += 1;
-            }
-
-        }
-        """
-
-        # Stage input temporarily.
-        nstates = self.nstates
-        replica_states = self.replica_states
-        u_kl = self.u_kl
-        Nij_proposed = self.Nij_proposed
-        Nij_accepted = self.Nij_accepted
-
-        # Execute inline C code with weave.
-        info = weave.inline(code, ['nstates', 'replica_states', 'u_kl', 'Nij_proposed', 'Nij_accepted'], headers=['<math.h>', '<stdlib.h>'], verbose=2)
-
-        # Store results.
-        self.replica_states = replica_states
-        self.Nij_proposed = Nij_proposed
-        self.Nij_accepted = Nij_accepted
+        block_size = self.mixing_block_size
+        if (block_size < 2) or (block_size > 8):
+            raise ParameterException("'mixing_block_size' must be between 2 and 8 (got %d)." % block_size)
+
+        if self.verbose: print "Will sample state permutations exactly within blocks of %d states." % block_size
+
+        # Stage energies.
+        u_kl = numpy.array(self.u_kl, numpy.float64)
+
+        for offset in [0, block_size / 2]:
+            # Partition states into blocks; the first and last blocks may be smaller.
+            boundaries = [0] + range(offset if offset > 0 else block_size, self.nstates, block_size) + [self.nstates]
+            for (first_state, last_state) in zip(boundaries[:-1], boundaries[1:]):
+                nblock = last_state - first_state
+                if nblock < 2:
+                    continue
+
+                # Enumerate all permutations of this block size, reusing them for later blocks.
+                if nblock not in self._block_permutations:
+                    self._block_permutations[nblock] = numpy.array(list(itertools.permutations(range(nblock))), numpy.int32)
+                permutations = self._block_permutations[nblock]
+
+                # Compute log weight of each assignment of the block's replicas to the block's states.
+                states = numpy.arange(first_state, last_state)
+                replicas = self.state_replicas[states]
+                u_block = u_kl[numpy.ix_(replicas, states)] # u_block[k,l] is the reduced potential of replica k of the block in state l of the block
+                log_weights = - u_block[numpy.arange(nblock), permutations].sum(1)
+                log_weights[numpy.isnan(log_weights)] = -numpy.inf
+                if not numpy.isfinite(log_weights.max()):
+                    continue
+
+                # Draw a permutation from its exact probability.
+                weights = numpy.exp(log_weights - log_weights.max())
+                cumulative_weights = numpy.cumsum(weights)
+                index = numpy.searchsorted(cumulative_weights, numpy.random.rand() * cumulative_weights[-1], side='right')
+                new_states = states[permutations[min(index, len(permutations)-1),:]]
+
+                # Accumulate statistics, counting each replica's move from its old to its new state.
+                moved = (new_states != states)
+                numpy.add.at(self.Nij_proposed, (states, new_states), 1)
+                numpy.add.at(self.Nij_accepted, (states[moved], new_states[moved]), 1)
+
+                # Assign states to replicas.
+                self.replica_states[replicas] = new_states
+                self.state_replicas[new_states] = replicas
+
+        return
+
+    def _color_state_graph(self):
+        """
+        Partition the edges of the state adjacency graph into classes of disjoint state pairs by greedy edge coloring.
+
+        RETURNS
+
+        color_classes (list of tuples of numpy int arrays) - (istates, jstates) of the edges of each color; no state appears
+           more than once within a color
+
+        """
+
+        (indptr, indices) = self.state_graph
+        if len(indptr) != self.nstates + 1:
+            raise ParameterException("'state_graph' has %d rows, but there are %d states." % (len(indptr) - 1, self.nstates))
+
+        # Extract each undirected edge once.
+        rows = numpy.repeat(numpy.arange(self.nstates), numpy.diff(indptr))
+        upper = (rows < indices)
+        (istates, jstates) = (rows[upper], numpy.array(indices)[upper])
+
+        # Assign each edge the lowest color not yet used by an edge touching either of its states.
+        state_colors = [ set() for state in range(self.nstates) ]
+        colors = numpy.zeros([len(istates)], numpy.int32)
+        for (edge, (istate, jstate)) in enumerate(zip(istates, jstates)):
+            color = 0
+            while (color in state_colors[istate]) or (color in state_colors[jstate]):
+                color += 1
+            colors[edge] = color
+            state_colors[istate].add(color)
+            state_colors[jstate].add(color)
+
+        color_classes = [ (istates[colors == color], jstates[colors == color]) for color in range(colors.max() + 1) ] if len(colors) > 0 else []
+
+        return color_classes
+
+    def _mix_graph_replicas(self):
+        """
+        Attempt exchanges between states adjacent in the state graph.
+
+        NOTES
+
+        The edges of 'state_graph' are colored once so that edges of the same color share no state.  Each call visits all
+        color classes in random order and attempts all swaps of a class at once with _attempt_swaps(), so every edge is
+        attempted once per iteration.  If 'state_graph' is None, a chain of states is used, as for 'swap-neighbors'.
+
+        """
+
+        if self.state_graph is None:
+            self.state_graph = state_graph_from_edges(self.nstates, numpy.arange(self.nstates-1), numpy.arange(1,self.nstates))
+        if self._state_graph_colors is None:
+            self._state_graph_colors = self._color_state_graph()
+
+        if self.verbose: print "Will attempt to swap replicas along %d edges of the state graph in %d color classes." % (sum([ len(istates) for (istates, jstates) in self._state_graph_colors ]), len(self._state_graph_colors))
+
+        # Stage energies.
+        u_kl = numpy.array(self.u_kl, numpy.float64)
+
+        # Attempt swaps for each color class in random order.
+        for color in numpy.random.permutation(len(self._state_graph_colors)):
+            (istates, jstates) = self._state_graph_colors[color]
+            (proposed, accepted) = self._attempt_swaps(istates, jstates, u_kl)
+            self._record_swaps(istates, jstates, proposed, accepted)
 
         return
 
@@ -929,11 +1853,8 @@ class ReplicaExchange(object):
             jstate = istate + 1 # second state to attempt to swap with i
 
             # Determine which replicas these states correspond to.
-            i = None
-            j = None
-            for index in range(self.nstates):
-                if self.replica_states[index] == istate: i = index
-                if self.replica_states[index] == jstate: j = index                
+            i = self.state_replicas[istate]
+            j = self.state_replicas[jstate]
 
             # Reject swap attempt if any energies are nan.
             if (numpy.isnan(self.u_kl[i,jstate]) or numpy.isnan(self.u_kl[j,istate]) or numpy.isnan(self.u_kl[i,istate]) or numpy.isnan(self.u_kl[j,jstate])):
@@ -952,6 +1873,7 @@ class ReplicaExchange(object):
             if (log_P_accept >= 0.0 or (numpy.random.rand() < math.exp(log_P_accept))):
                 # Swap states in replica slots i and j.
                 (self.replica_states[i], self.replica_states[j]) = (self.replica_states[j], self.replica_states[i])
+                (self.state_replicas[istate], self.state_replicas[jstate]) = (j, i)
                 # Accumulate statistics
                 self.Nij_accepted[istate,jstate] += 1
                 self.Nij_accepted[jstate,istate] += 1
@@ -975,45 +1897,92 @@ class ReplicaExchange(object):
         if self.replica_mixing_scheme == 'swap-neighbors':
             self._mix_neighboring_replicas()        
         elif self.replica_mixing_scheme == 'swap-all':
-            # Try to use weave-accelerated mixing code if possible, otherwise fall back to Python-accelerated code.            
-            try:
-                self._mix_all_replicas_weave()            
-            except:
-                self._mix_all_replicas()
+            self._mix_all_replicas()
+        elif self.replica_mixing_scheme == 'swap-graph':
+            self._mix_graph_replicas()
+        elif self.replica_mixing_scheme == 'swap-candidates':
+            self._mix_candidate_replicas()
+        elif self.replica_mixing_scheme == 'gibbs-blocks':
+            self._mix_replica_blocks()
         else:
             raise ParameterException("Replica mixing scheme '%s' unknown.  Choose valid 'replica_mixing_scheme' parameter." % self.replica_mixing_scheme)
         end_time = time.time()
 
+        # Check that the state-to-replica index is still the inverse of replica_states.
+        if self.debug:
+            self._check_state_replicas()
+
+        # Update swap statistics.
+        self._update_swap_statistics()
+
+        # Report on mixing.
+        if self.verbose:
+            print "Mixing of replicas took %.3f s" % (end_time - start_time)
+                
+        return
+
+    def _update_swap_statistics(self):
+        """
+        Report swaps accepted this iteration, and update cumulative swap statistics and swap_Pij_accepted.
+
+        """
+
         # Determine fraction of swaps accepted this iteration.        
         nswaps_attempted = self.Nij_proposed.sum()
         nswaps_accepted = self.Nij_accepted.sum()
-        swap_fraction_accepted = float(nswaps_accepted) / float(nswaps_attempted);
+        swap_fraction_accepted = float(nswaps_accepted) / float(max(nswaps_attempted, 1))
         if self.verbose: print "Accepted %d / %d attempted swaps (%.1f %%)" % (nswaps_accepted, nswaps_attempted, swap_fraction_accepted * 100.0)
 
+        # Accumulate swap statistics over all iterations.
+        self.Nij_proposed_cumulative += self.Nij_proposed
+        self.Nij_accepted_cumulative += self.Nij_accepted
+
         # Estimate cumulative transition probabilities between all states.
-        Nij_accepted = self.ncfile.variables['accepted'][:,:,:].sum(0) + self.Nij_accepted
-        Nij_proposed = self.ncfile.variables['proposed'][:,:,:].sum(0) + self.Nij_proposed
-        swap_Pij_accepted = numpy.zeros([self.nstates,self.nstates], numpy.float64)
-        for istate in range(self.nstates):
-            Ni = Nij_proposed[istate,:].sum()
-            if (Ni == 0):
-                swap_Pij_accepted[istate,istate] = 1.0
-            else:
-                swap_Pij_accepted[istate,istate] = 1.0 - float(Nij_accepted[istate,:].sum() - Nij_accepted[istate,istate]) / float(Ni)
-                for jstate in range(self.nstates):
-                    if istate != jstate:
-                        swap_Pij_accepted[istate,jstate] = float(Nij_accepted[istate,jstate]) / float(Ni)
+        Ni = self.Nij_proposed_cumulative.sum(1).astype(numpy.float64) # Ni[i] is the number of swaps proposed from state i
+        proposed = (Ni > 0)
+        self.swap_Pij_accepted[:,:] = 0.0
+        self.swap_Pij_accepted[proposed,:] = self.Nij_accepted_cumulative[proposed,:] / Ni[proposed,numpy.newaxis]
+        diagonal = numpy.ones([self.nstates], numpy.float64)
+        Nii_accepted = numpy.diag(self.Nij_accepted_cumulative)
+        diagonal[proposed] = 1.0 - (self.Nij_accepted_cumulative[proposed,:].sum(1) - Nii_accepted[proposed]) / Ni[proposed]
+        self.swap_Pij_accepted[numpy.arange(self.nstates),numpy.arange(self.nstates)] = diagonal
+
+        return
+
+    def _check_state_replicas(self):
+        """
+        Check that replica_states is a permutation of states and state_replicas is its inverse.
+
+        """
+
+        if not numpy.all(numpy.sort(self.replica_states) == numpy.arange(self.nstates)):
+            raise Exception("replica_states is not a permutation of states: %s" % str(self.replica_states))
+        if not numpy.all(self.replica_states[self.state_replicas] == numpy.arange(self.nstates)):
+            raise Exception("state_replicas is not the inverse of replica_states: %s vs %s" % (str(self.state_replicas), str(self.replica_states)))
+
+        return
+
+    def _accumulate_state_transitions(self):
+        """
+        Accumulate the state transitions made by all replicas since the previous iteration into Nij_transitions.
+
+        """
+
+        if self._previous_replica_states is not None:
+            numpy.add.at(self.Nij_transitions, (self._previous_replica_states, self.replica_states), 1)
+        self._previous_replica_states = self.replica_states.copy()
 
-        # Report on mixing.
-        if self.verbose:
-            print "Mixing of replicas took %.3f s" % (end_time - start_time)
-                
         return
 
     def _show_mixing_statistics(self):
         """
         Print summary of mixing statistics.
 
+        NOTES
+
+        Transition counts are accumulated every iteration by _accumulate_state_transitions(), so this can be called on demand;
+        the run loop calls it every 'mixing_statistics_interval' iterations since the eigenvalue estimate costs O(nstates^3).
+
         """
 
         # Don't print anything until we've accumulated some statistics.
@@ -1021,16 +1990,10 @@ class ReplicaExchange(object):
             return
         
         # Compute statistics of transitions.
-        Nij = numpy.zeros([self.nstates,self.nstates], numpy.float64)
-        for iteration in range(self.iteration - 1):
-            for ireplica in range(self.nstates):
-                istate = self.ncfile.variables['states'][iteration,ireplica]
-                jstate = self.ncfile.variables['states'][iteration+1,ireplica]
-                Nij[istate,jstate] += 0.5
-                Nij[jstate,istate] += 0.5
-        Tij = numpy.zeros([self.nstates,self.nstates], numpy.float64)
-        for istate in range(self.nstates):
-            Tij[istate,:] = Nij[istate,:] / Nij[istate,:].sum()
+        Nij = 0.5 * (self.Nij_transitions + self.Nij_transitions.T).astype(numpy.float64)
+        Ni = Nij.sum(1)
+        Tij = numpy.eye(self.nstates) # states never visited are left as absorbing
+        Tij[Ni > 0,:] = Nij[Ni > 0,:] / Ni[Ni > 0,numpy.newaxis]
 
         if self.show_mixing_statistics:
             # Print observed transition probabilities.
@@ -1073,6 +2036,7 @@ class ReplicaExchange(object):
         # Create dimensions.
         ncfile.createDimension('iteration', 0) # unlimited number of iterations
         ncfile.createDimension('replica', self.nreplicas) # number of replicas
+        ncfile.createDimension('state', self.nstates) # number of thermodynamic states
         ncfile.createDimension('atom', self.natoms) # number of atoms in system
         ncfile.createDimension('spatial', 3) # number of spatial dimensions
 
@@ -1087,9 +2051,9 @@ class ReplicaExchange(object):
         # Create variables.
         ncvar_positions = ncfile.createVariable('positions', 'f', ('iteration','replica','atom','spatial'))
         ncvar_states    = ncfile.createVariable('states', 'i', ('iteration','replica'))
-        ncvar_energies  = ncfile.createVariable('energies', 'f', ('iteration','replica','replica'))
-        ncvar_proposed  = ncfile.createVariable('proposed', 'l', ('iteration','replica','replica'))
-        ncvar_accepted  = ncfile.createVariable('accepted', 'l', ('iteration','replica','replica'))                
+        ncvar_energies  = ncfile.createVariable('energies', 'f', ('iteration','replica','state'))
+        ncvar_proposed  = ncfile.createVariable('proposed', 'l', ('iteration','state','state'))
+        ncvar_accepted  = ncfile.createVariable('accepted', 'l', ('iteration','state','state'))                
         
         # Define units for variables.
         setattr(ncvar_positions, 'units', 'nm')
@@ -1101,7 +2065,7 @@ class ReplicaExchange(object):
         # Define long (human-readable) names for variables.
         setattr(ncvar_positions, "long_name", "positions[iteration][replica][atom][spatial] is position of coordinate 'spatial' of atom 'atom' from replica 'replica' for iteration 'iteration'.")
         setattr(ncvar_states,    "long_name", "states[iteration][replica] is the state index (0..nstates-1) of replica 'replica' of iteration 'iteration'.")
-        setattr(ncvar_energies,  "long_name", "energies[iteration][replica][state] is the reduced (unitless) energy of replica 'replica' from iteration 'iteration' evaluated at state 'state'.")
+        setattr(ncvar_energies,  "long_name", "energies[iteration][replica][state] is the reduced (unitless) energy of replica 'replica' from iteration 'iteration' evaluated at state 'state', or NaN if not computed.")
         setattr(ncvar_proposed,  "long_name", "proposed[iteration][i][j] is the number of proposed transitions between states i and j from iteration 'iteration-1'.")
         setattr(ncvar_accepted,  "long_name", "accepted[iteration][i][j] is the number of proposed transitions between states i and j from iteration 'iteration-1'.")
 
@@ -1122,10 +2086,8 @@ class ReplicaExchange(object):
         start_time = time.time()
         
         # Store replica positions.
-        for replica_index in range(self.nstates):
-            coordinates = self.replica_coordinates[replica_index]
-            x = coordinates / units.nanometers
-            self.ncfile.variables['positions'][self.iteration,replica_index,:,:] = x[:,:]
+        if (self.iteration % self.positions_storage_interval == 0):
+            self.ncfile.variables['positions'][self.iteration,:,:,:] = self.replica_coordinates
             
         # TODO: Store box vectors
 
@@ -1162,22 +2124,35 @@ class ReplicaExchange(object):
 
         # Get current dimensions.
         self.iteration = ncfile.variables['energies'].shape[0] - 1
-        self.nstates = ncfile.variables['energies'].shape[1]
-        self.natoms = ncfile.variables['energies'].shape[2]
+        self.nreplicas = ncfile.variables['energies'].shape[1]
+        self.nstates = ncfile.variables['energies'].shape[2]
+        self.natoms = ncfile.variables['positions'].shape[2]
+
+        # Resume from the last iteration for which positions were stored (see 'positions_storage_interval').
+        # Later iterations will be overwritten.
+        while (self.iteration > 0) and not self._positions_stored(ncfile, self.iteration):
+            self.iteration -= 1
 
         # Restore positions.
-        self.replica_coordinates = list()
-        for replica_index in range(self.nstates):
-            x = ncfile.variables['positions'][self.iteration,replica_index,:,:].astype(numpy.float64).copy()
-            coordinates = units.Quantity(x, units.nanometers)
-            self.replica_coordinates.append(coordinates)
+        self.replica_coordinates[:,:,:] = ncfile.variables['positions'][self.iteration,:,:,:]
 
         # Restore state information.
         self.replica_states = ncfile.variables['states'][self.iteration,:].copy()
+        self.state_replicas[self.replica_states] = numpy.arange(self.nreplicas)
 
         # Restore energies.
         self.u_kl = ncfile.variables['energies'][self.iteration,:,:].copy()
 
+        # Restore cumulative swap statistics.
+        self.Nij_proposed_cumulative[:,:] = ncfile.variables['proposed'][0:self.iteration+1,:,:].sum(0)
+        self.Nij_accepted_cumulative[:,:] = ncfile.variables['accepted'][0:self.iteration+1,:,:].sum(0)
+
+        # Restore state transition statistics.
+        states = numpy.array(ncfile.variables['states'][0:self.iteration+1,:], numpy.int32)
+        self.Nij_transitions[:,:] = 0
+        numpy.add.at(self.Nij_transitions, (states[:-1,:].ravel(), states[1:,:].ravel()), 1)
+        self._previous_replica_states = self.replica_states.copy()
+
         # Close NetCDF file.
         ncfile.close()        
 
@@ -1190,6 +2165,27 @@ class ReplicaExchange(object):
         
         return
 
+    def _positions_stored(self, ncfile, iteration):
+        """
+        Determine whether replica positions were written to the NetCDF file for the given iteration.
+
+        ARGUMENTS
+
+        ncfile (netCDF4.Dataset) - the NetCDF file handle
+        iteration (int) - the iteration to check
+
+        RETURNS
+
+        stored (boolean) - True if positions were stored for this iteration
+
+        """
+
+        x = ncfile.variables['positions'][iteration,0,0,0]
+        if numpy.ma.is_masked(x) or (x == netcdf.default_fillvals['f4']):
+            return False
+
+        return True
+
     def _show_energies(self):
         """
         Show energies (in units of kT) for all replicas at all states.
@@ -1203,7 +2199,7 @@ class ReplicaExchange(object):
         print ""
 
         # print energies in kT
-        for replica_index in range(self.nstates):
+        for replica_index in range(self.nreplicas):
             print "replica %-16d %16d" % (replica_index, self.replica_states[replica_index]),
             for state_index in range(self.nstates):
                 print "%10.1f" % (self.u_kl[replica_index,state_index]),
@@ -1281,11 +2277,17 @@ class ParallelTempering(ReplicaExchange):
         else:
             raise ValueError("Either 'temperatures' or 'Tmin', 'Tmax', and 'ntemps' must be provided.")
         
-        states = [ ThermodynamicState(system=system, temperature=self.temperatures[i]) for i in range(ntemps) ]
+        states = [ ThermodynamicState(system=system, temperature=self.temperatures[i]) for i in range(len(self.temperatures)) ]
 
         # Initialize replica-exchange simlulation.
         ReplicaExchange.__init__(self, states, coordinates, store_filename, protocol=protocol, mm=mm)
 
+        # Reduced potentials are beta_k * U(x), so capture U(x) at the end of propagation.
+        self._capture_potential_energies = True
+
+        # Inverse temperatures beta_k (in mol/kJ).
+        self._betas = numpy.array([ units.kilojoules_per_mole / (kB * temperature) for temperature in self.temperatures ], numpy.float64)
+
         # Override title.
         self.title = 'Parallel tempering simulation created using ParallelTempering class of repex.py on %s' % time.asctime(time.localtime())
         
@@ -1298,37 +2300,25 @@ class ParallelTempering(ReplicaExchange):
         NOTES
 
         Because only the temperatures differ among replicas, we replace the generic O(N^2) replica-exchange implementation with an O(N) implementation.
-
-        TODO
-
-        * Parallel implementation of energy calculation.
+        The potential energy of each replica is captured at the end of propagation, so normally no further energy evaluations are
+        needed, and the whole energy matrix is the outer product u_kl = U_k beta_l.  Potential energies that were not captured (after
+        minimization, equilibration, or resuming) are evaluated with a cached Context.
         
         """
 
         start_time = time.time()
         if self.verbose: print "Computing energies..."
 
-        # Create an integrator and context.
-        state = self.states[0]
-        integrator = self.mm.VerletIntegrator(self.timestep)
-        context = self.mm.Context(state.system, integrator, self.platform)
-        
-        # Compute reduced potentials for all configurations in all states.
-        for replica_index in range(self.nstates):
-            # Set coordinates.
-            context.setPositions(self.replica_coordinates[replica_index])
-            # Compute potential energy.
-            openmm_state = context.getState(getEnergy=True)            
-            potential_energy = openmm_state.getPotentialEnergy()           
-            # Compute energies at this state for all replicas.
-            for state_index in range(self.nstates):
-                # Compute reduced potential
-                beta = 1.0 / (kB * self.states[state_index].temperature)
-                self.u_kl[replica_index,state_index] = beta * potential_energy
+        # Evaluate any potential energies not captured during propagation.
+        for replica_index in numpy.nonzero(numpy.isnan(self.replica_potential_energies))[0]:
+            state = self.states[self.replica_states[replica_index]]
+            [context, integrator] = self._context_cache.get_context(state.system, self.platform, parameters=state.parameters)
+            context.setPositions(units.Quantity(self.replica_coordinates[replica_index], units.nanometers))
+            openmm_state = context.getState(getEnergy=True)
+            self.replica_potential_energies[replica_index] = openmm_state.getPotentialEnergy() / units.kilojoules_per_mole
 
-        # Clean up.
-        del context
-        del integrator
+        # Compute reduced potentials for all configurations in all states.
+        self.u_kl[:,:] = numpy.outer(self.replica_potential_energies, self._betas)
 
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -1350,7 +2340,26 @@ class HamiltonianExchange(ReplicaExchange):
     This class provides an implementation of a Hamiltonian exchange simulation based on the ReplicaExchange facility.
     It provides several convenience classes and efficiency improvements, and should be preferentially used for Hamiltonian
     exchange simulations over ReplicaExchange when possible.
-    
+
+    States usually differ in only a few Forces (such as an added restraint or alchemical terms).  States can be given as
+    one System per state, or as a single System together with the values of its global parameters for each state, in
+    which case all states share one Context for propagation and one for energy evaluation.  The Forces that differ
+    between states are detected automatically, and the energy matrix is computed by evaluating the shared Forces once per
+    replica and only the differing Forces once per replica and state.
+
+    ATTRIBUTES
+
+    In addition to the attributes of ReplicaExchange, the following can be set before the simulation is initialized:
+
+    * decompose_energies (boolean) - if True, evaluate Forces shared by all states only once per replica, which may reassign
+      force groups of the provided Systems (default: True)
+
+    Many Hamiltonian ladders are linear in a few parameters, with reduced potentials u_l(x) = beta sum_k C[l,k] U_k(x).  For
+    these, a 'basis_system' whose force group k holds the energy component U_k(x), and the (nstates x K) coefficient matrix C,
+    can be provided.  The energy matrix is then computed from K component evaluations per replica as a single matrix product,
+    instead of an evaluation of every state.  Constant terms are represented by a component whose coefficient is 1 for all
+    states.  The provided 'systems' are still used for dynamics, so must be consistent with the basis.
+    
     EXAMPLES
     
     >>> # Create reference system
@@ -1370,10 +2379,28 @@ class HamiltonianExchange(ReplicaExchange):
     >>> simulation.nsteps_per_iteration = 500 # run 500 timesteps per iteration
     >>> # Run simulation.
     >>> simulation.run() # run the simulation
+
+    Hamiltonian exchange along a linear ladder that scales a positional restraint on the first atom.
+
+    >>> def restrained_system(scale, group):
+    ...     restrained_system = simtk.openmm.XmlSerializer.deserialize(simtk.openmm.XmlSerializer.serialize(reference_system))
+    ...     force = simtk.openmm.CustomExternalForce('scale * ((x-x0)^2 + (y-y0)^2 + (z-z0)^2)')
+    ...     force.addGlobalParameter('scale', scale * 1000.0)
+    ...     for parameter in ['x0', 'y0', 'z0']: force.addPerParticleParameter(parameter)
+    ...     force.addParticle(0, list(coordinates[0,:] / units.nanometers))
+    ...     force.setForceGroup(group)
+    ...     restrained_system.addForce(force)
+    ...     return restrained_system
+    >>> scales = [0.0, 0.25, 0.5, 1.0]
+    >>> systems = [ restrained_system(scale, 0) for scale in scales ]
+    >>> coefficients = numpy.array([ [1.0, scale] for scale in scales ])
+    >>> file = tempfile.NamedTemporaryFile() # temporary file for testing
+    >>> simulation = HamiltonianExchange(reference_state, systems, coordinates, file.name, basis_system=restrained_system(1.0, 1), coefficients=coefficients)
+    >>> simulation.run() # run the simulation
     
     """
 
-    def __init__(self, reference_state, systems, coordinates, store_filename, protocol=None, mm=None):
+    def __init__(self, reference_state, systems, coordinates, store_filename, protocol=None, mm=None, basis_system=None, coefficients=None, parameters=None):
         """
         Initialize a Hamiltonian exchange simulation object.
 
@@ -1387,25 +2414,992 @@ class HamiltonianExchange(ReplicaExchange):
         OPTIONAL ARGUMENTS
 
         protocol (dict) - Optional protocol to use for specifying simulation protocol as a dict. Provided keywords will be matched to object variables to replace defaults.
+        basis_system (simtk.openmm.System) - System whose force group k computes energy component k of a linear basis (default: None)
+        coefficients (numpy array of nstates x K) - coefficients[l,k] is the coefficient of energy component k in state l, if 'basis_system' is given (default: None)
+        parameters (list of dict) - parameters[l] are the values of global parameters defining state l; if specified, 'systems' may be a single System shared by all states (default: None)
 
         """
-        # Create thermodynamic states from systems.        
+        # A single System may be shared by states that differ only in global parameters.
+        if (parameters is not None) and (type(systems) not in [type(list()), type(tuple())]):
+            systems = [ systems for state_parameters in parameters ]
+        if parameters is None:
+            parameters = [ None for system in systems ]
+        if len(parameters) != len(systems):
+            raise ParameterException("'parameters' must have one entry per System.")
+
+        # Create thermodynamic states from systems, each with the thermodynamic parameters of the reference state.
         states = list()
-        for system in systems:
-            #state = copy.deepcopy(reference_state) # TODO: Use deep copy once this works
-            state = reference_state
+        for (system, state_parameters) in zip(systems, parameters):
             #state.system = copy.deepcopy(system) # TODO: Use deep copy once this works
-            state.system = system
+            state = ThermodynamicState(system=system, temperature=reference_state.temperature, pressure=reference_state.pressure, parameters=state_parameters)
             states.append(state)
 
+        # Set Hamiltonian exchange defaults first so that they can be replaced by 'protocol'.
+        self.decompose_energies = True # evaluate Forces shared by all states once per replica
+
         # Initialize replica-exchange simlulation.
         ReplicaExchange.__init__(self, states, coordinates, store_filename, protocol=protocol, mm=mm)
 
+        # Store linear basis.
+        self.basis_system = basis_system
+        self.coefficients = None
+        if basis_system is not None:
+            if coefficients is None:
+                raise ParameterException("'coefficients' must be specified with 'basis_system'.")
+            self.coefficients = numpy.array(coefficients, numpy.float64)
+            if (self.coefficients.ndim != 2) or (self.coefficients.shape[0] != len(states)):
+                raise ParameterException("'coefficients' must have one row per state.")
+            self.ncomponents = self.coefficients.shape[1]
+            if self.ncomponents > 32:
+                raise ParameterException("At most 32 basis components (force groups) are supported, but 'coefficients' has %d." % self.ncomponents)
+            if reference_state.pressure is not None:
+                raise ParameterException("A linear basis cannot be used for constant-pressure states.")
+            self._basis_state = ThermodynamicState(system=basis_system, temperature=reference_state.temperature)
+
         # Override title.
         self.title = 'Hamiltonian exchange simulation created using HamiltonianExchange class of repex.py on %s' % time.asctime(time.localtime())
         
         return
 
+    def _decompose_forces(self):
+        """
+        Separate the Forces shared by all states from those that differ between states into disjoint sets of force groups.
+
+        RETURNS
+
+        shared_groups (int) - bitmask of force groups containing only Forces identical in all states
+        differing_groups (int) - bitmask of force groups containing the Forces that differ between states
+
+        or None if the decomposition cannot be used.
+
+        NOTES
+
+        Forces are compared by their position in each System and their XmlSerializer representation; a Force is shared if
+        every System has an identical Force at the same position, and it does not depend on a global parameter whose value
+        differs between states (see ThermodynamicState 'parameters').  If existing force group assignments already keep shared
+        and differing Forces in separate groups, they are kept.  Otherwise, shared Forces are moved to group 0 and differing
+        Forces to group 1 in every System, which does not affect dynamics.
+
+        """
+
+        # The shared part of the reduced potential must be the same for all states.
+        if not hasattr(self.mm, 'XmlSerializer'):
+            return None
+        for state in self.states:
+            if (state.temperature != self.states[0].temperature) or (state.pressure is not None):
+                return None
+
+        # Find global parameters whose values differ between states.
+        parameter_names = set()
+        for state in self.states:
+            parameter_names.update((state.parameters or dict()).keys())
+        varying_parameters = set()
+        for name in parameter_names:
+            if len(set([ (state.parameters or dict()).get(name) for state in self.states ])) > 1:
+                varying_parameters.add(name)
+
+        # Find Forces shared by all distinct Systems that do not depend on varying global parameters.
+        systems = list()
+        for state in self.states:
+            if not any([ state.system is system for system in systems ]):
+                systems.append(state.system)
+        nforces = max([ system.getNumForces() for system in systems ])
+        shared = list()
+        for force_index in range(nforces):
+            serializations = set()
+            depends_on_varying_parameters = False
+            for system in systems:
+                if force_index < system.getNumForces():
+                    force = system.getForce(force_index)
+                    serializations.add(self.mm.XmlSerializer.serialize(force))
+                    if hasattr(force, 'getNumGlobalParameters'):
+                        for parameter_index in range(force.getNumGlobalParameters()):
+                            if force.getGlobalParameterName(parameter_index) in varying_parameters:
+                                depends_on_varying_parameters = True
+                else:
+                    serializations.add(None)
+            shared.append((len(serializations) == 1) and not depends_on_varying_parameters)
+
+        if all(shared) or not any(shared):
+            return None
+
+        # Determine which force groups hold shared and differing Forces.
+        shared_groups = 0
+        differing_groups = 0
+        for system in systems:
+            for force_index in range(system.getNumForces()):
+                group_bit = 1 << system.getForce(force_index).getForceGroup()
+                if shared[force_index]:
+                    shared_groups |= group_bit
+                else:
+                    differing_groups |= group_bit
+
+        # Reassign force groups if shared and differing Forces are mixed in the same group.
+        if (shared_groups & differing_groups) != 0:
+            if self.verbose: print "Reassigning force groups to separate Forces shared by all states from those that differ."
+            for system in systems:
+                for force_index in range(system.getNumForces()):
+                    if shared[force_index]:
+                        system.getForce(force_index).setForceGroup(0)
+                    else:
+                        system.getForce(force_index).setForceGroup(1)
+                ThermodynamicState.invalidate_context_cache(system)
+            shared_groups = 1 << 0
+            differing_groups = 1 << 1
+
+        if self.verbose: print "%d of %d Forces are shared by all %d distinct Systems." % (sum(shared), nforces, len(systems))
+
+        return (shared_groups, differing_groups)
+
+    def _initialize(self):
+        """
+        Initialize the simulation, and bind to a storage file.
+
+        """
+
+        # Force groups must be assigned before any Context is created for propagation.
+        self._force_groups = None
+        if self.decompose_energies and (self.basis_system is None):
+            self._force_groups = self._decompose_forces()
+
+        ReplicaExchange._initialize(self)
+
+        return
+
+    def _compute_energies(self):
+        """
+        Compute energies of all replicas at all states.
+
+        NOTES
+
+        If 'decompose_energies' is set and the states differ only in some of their Forces, the energy of the Forces shared by
+        all states is evaluated once per replica, and only the differing force groups are evaluated for each state.  States
+        sharing the same System and global parameters are evaluated only once.  If a linear basis was provided, the energy matrix is computed from
+        it instead (see _compute_basis_energies()).  Otherwise, the generic ReplicaExchange implementation is used.
+
+        """
+
+        if self.basis_system is not None:
+            return self._compute_basis_energies()
+
+        if self._force_groups is None:
+            return ReplicaExchange._compute_energies(self)
+
+        [shared_groups, differing_groups] = self._force_groups
+
+        start_time = time.time()
+
+        # Determine which energies need to be computed.
+        required = None
+        if (self.full_energy_interval is not None) and (self.iteration % self.full_energy_interval != 0):
+            required = self._required_energies()
+        if required is None:
+            required = numpy.ones([self.nreplicas, self.nstates], numpy.bool_)
+        else:
+            self.u_kl[:,:] = numpy.nan
+
+        # Determine which replicas are to be evaluated for each distinct Hamiltonian; each fills the columns of its states.
+        hamiltonian_states = collections.OrderedDict() # hamiltonian_states[key] is the list of indices of states with the same System and global parameters
+        for state_index in range(self.nstates):
+            hamiltonian_states.setdefault(self._hamiltonian_key(self.states[state_index]), list()).append(state_index)
+        tasks = list()
+        for state_indices in hamiltonian_states.values():
+            replica_indices = numpy.where(required[:,state_indices].any(1))[0]
+            if len(replica_indices) > 0:
+                tasks.append((state_indices[0], replica_indices, differing_groups))
+        replica_indices = numpy.where(required.any(1))[0]
+        tasks.append((0, replica_indices, shared_groups))
+        nenergies = sum([ len(task[1]) for task in tasks ])
+
+        if self.verbose: print "Computing energies..."
+        if self._pool is None:
+            results = list()
+            for (state_index, replica_indices, groups) in tasks:
+                coordinates_list = [ units.Quantity(self.replica_coordinates[replica_index], units.nanometers) for replica_index in replica_indices ]
+                results.append(self.states[state_index].reduced_potentials(coordinates_list, platform=self.energy_platform, groups=groups))
+        else:
+            # Evaluate states on worker processes, which read coordinates from shared memory.
+            results = self._map_workers(_compute_energies_worker, tasks)
+
+        # Add the shared energy of each replica to the differing energy of each state.
+        u_shared = numpy.zeros([self.nreplicas], numpy.float64)
+        u_shared[tasks[-1][1]] = results[-1]
+        for ((state_index, replica_indices, groups), u) in zip(tasks[:-1], results[:-1]):
+            for column in hamiltonian_states[self._hamiltonian_key(self.states[state_index])]:
+                self.u_kl[replica_indices,column] = u_shared[replica_indices] + u
+
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        time_per_energy = elapsed_time / float(max(nenergies, 1))
+        if self.verbose: print "Time to compute %d partial energies %.3f s (%.3f per energy calculation).\n" % (nenergies, elapsed_time, time_per_energy)
+
+        return
+
+    def _hamiltonian_key(self, state):
+        """
+        Return a key that is equal for states with the same System and global parameter values.
+
+        """
+
+        return (id(state.system), tuple(sorted((state.parameters or dict()).items())))
+
+    def _compute_basis_energies(self):
+        """
+        Compute energies of all replicas at all states from the energy components of the linear basis.
+
+        NOTES
+
+        The reduced potential of each replica is evaluated for each of the K force groups of 'basis_system' with one cached
+        Context, and the whole energy matrix is formed as the product u_kl = E C^T of the (nreplicas x K) matrix of reduced
+        component energies E and the (nstates x K) coefficient matrix C.  If 'debug' is set, the result is checked against
+        direct evaluation of every state.
+
+        """
+
+        start_time = time.time()
+        if self.verbose: print "Computing energies from %d basis components..." % self.ncomponents
+
+        # Compute reduced energy components of all replicas.
+        coordinates_list = [ units.Quantity(self.replica_coordinates[replica_index], units.nanometers) for replica_index in range(self.nreplicas) ]
+        E = numpy.zeros([self.nreplicas, self.ncomponents], numpy.float64)
+        for component in range(self.ncomponents):
+            E[:,component] = self._basis_state.reduced_potentials(coordinates_list, platform=self.energy_platform, groups=(1 << component))
+
+        # Form energy matrix.
+        self.u_kl[:,:] = numpy.dot(E, self.coefficients.T)
+
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        if self.verbose: print "Time to compute %d component energies %.3f s (%.3f per energy calculation).\n" % (E.size, elapsed_time, elapsed_time / float(E.size))
+
+        if self.debug:
+            self._check_basis_energies()
+
+        return
+
+    def _check_basis_energies(self):
+        """
+        Check that the energy matrix computed from the linear basis agrees with direct evaluation of all states.
+
+        """
+
+        # Evaluate all states directly, bypassing the sparse evaluation of 'full_energy_interval'.
+        u_kl = self.u_kl.copy()
+        full_energy_interval = self.full_energy_interval
+        self.full_energy_interval = 1
+        try:
+            ReplicaExchange._compute_energies(self)
+        finally:
+            self.full_energy_interval = full_energy_interval
+
+        # Compare energies; NaN in either matrix (from failed evaluations) must not hide a mismatch.
+        if numpy.isnan(u_kl).any() or numpy.isnan(self.u_kl).any():
+            raise Exception("Energies from the linear basis or direct evaluation contain NaN; check 'basis_system' and 'coefficients'.")
+        deviation = numpy.abs(u_kl - self.u_kl).max()
+        if deviation > 1.0e-3 * max(1.0, numpy.abs(self.u_kl).max()):
+            raise Exception("Energies from the linear basis deviate from direct evaluation by up to %f kT; check 'basis_system' and 'coefficients'." % deviation)
+        self.u_kl[:,:] = u_kl
+
+        return
+#=============================================================================================
+# Expanded ensemble
+#=============================================================================================
+
+class ExpandedEnsemble(ReplicaExchange):
+    """
+    Expanded-ensemble simulation facility.
+
+    DESCRIPTION
+
+    This class provides an expanded-ensemble simulation based on the ReplicaExchange facility.  A single replica visits all
+    thermodynamic states: after each iteration of dynamics, the reduced potential of its configuration x is computed at
+    every state, and a new state k is sampled from p(k|x) proportional to exp[g_k - u_k(x)], where g_k are the per-state log
+    weights.  Simulated tempering is the special case in which states differ only in temperature.  Many cheap independent
+    expanded-ensemble walkers can be run in place of one expensive replica-exchange simulation.
+
+    The store file has the same layout as for ReplicaExchange, with a 'replica' dimension of length one.
+
+    The kernel used for state moves is selected by 'state_move_scheme', following the GROMACS 'lmc-move' options:
+
+    * 'metropolis' - propose state k-1 or k+1 with equal probability, and accept with the Metropolis criterion
+    * 'barker' - propose state k-1 or k+1 with equal probability, and accept with the Barker criterion
+    * 'gibbs' - draw the new state from p(k|x) directly
+    * 'metropolized-gibbs' - propose state j != i from p(j|x) / [1 - p(i|x)], and accept with probability min{1, [1 - p(i|x)] / [1 - p(j|x)]}
+
+    ATTRIBUTES
+
+    In addition to the attributes of ReplicaExchange, the following can be set before the simulation is initialized:
+
+    * state_move_scheme (string) - kernel used for state moves: 'metropolis', 'barker', 'gibbs', or 'metropolized-gibbs' (default: 'gibbs')
+    * log_weights (numpy array of nstates) - log weights g_k of the states, or None for all zero (default: None)
+    * nstate_moves (dimensionless) - number of state moves attempted per iteration (default: 1)
+    * integrator_state_moves (boolean) - if True, Gibbs state moves are made inside a CustomIntegrator on the device during
+      dynamics, with no return to Python; all states must share one System and global parameters, and differ only in temperature (default: False)
+    * nsteps_per_state_move (dimensionless) - number of timesteps between on-device state moves (default: 10)
+    * weight_update_scheme (string) - online adaptation of log weights toward uniform sampling of states: 'wang-landau', 'sams',
+      or None to keep log weights fixed (default: None)
+    * histogram_flatness (dimensionless) - the histogram of state visits is flat when its minimum exceeds this fraction of its mean (default: 0.8)
+    * wang_landau_initial_gain (dimensionless) - initial Wang-Landau log weight increment (default: 1.0)
+    * wang_landau_gain_factor (dimensionless) - factor by which the Wang-Landau gain is reduced when the histogram is flat (default: 0.5)
+    * sams_beta (dimensionless) - exponent of the initial-stage SAMS gain t^-beta, between 0.5 and 1 (default: 0.8)
+    * weight_update_minimum_gain (dimensionless) - log weights are frozen once the gain falls below this value (default: 1.0e-4)
+    * weights_frozen (boolean) - True once adaptation of log weights has stopped (read-only)
+
+    The log weights, gain, and histogram used by the adaptation are stored at each iteration in the 'log_weights', 'weight_gain',
+    and 'weight_histogram' variables of the store file, and are restored when a simulation is resumed.
+
+    EXAMPLES
+
+    Simulated tempering of alanine dipeptide in implicit solvent.
+
+    >>> # Create alanine dipeptide test system.
+    >>> import simtk.pyopenmm.extras.testsystems as testsystems
+    >>> [system, coordinates] = testsystems.AlanineDipeptideImplicit()
+    >>> # Create temporary file for storing output.
+    >>> import tempfile
+    >>> file = tempfile.NamedTemporaryFile() # temporary file for testing
+    >>> store_filename = file.name
+    >>> # Create thermodynamic states at several temperatures, all sharing one System.
+    >>> states = [ ThermodynamicState(system, temperature=T*units.kelvin) for T in [298.0, 350.0, 400.0] ]
+    >>> simulation = ExpandedEnsemble(states, coordinates, store_filename)
+    >>> simulation.state_move_scheme = 'metropolized-gibbs'
+    >>> simulation.number_of_iterations = 2 # set the simulation to only run 2 iterations
+    >>> simulation.nsteps_per_iteration = 500 # run 500 timesteps per iteration
+    >>> # Run simulation.
+    >>> simulation.run() # run the simulation
+
+    Simulated tempering with log weights adapted by self-adjusted mixture sampling.
+
+    >>> file = tempfile.NamedTemporaryFile() # temporary file for testing
+    >>> simulation = ExpandedEnsemble(states, coordinates, file.name, protocol={'weight_update_scheme' : 'sams', 'number_of_iterations' : 10})
+    >>> simulation.run()
+    >>> simulation.log_weights[0]
+    0.0
+
+    """
+
+    def __init__(self, states, coordinates, store_filename, protocol=None, mm=None):
+        """
+        Initialize an expanded-ensemble simulation object.
+
+        ARGUMENTS
+
+        states (list of ThermodynamicState) - thermodynamic states the replica can visit
+        coordinates (simtk.unit.Quantity of numpy natoms x 3 with units length) - initial coordinates for the replica (if a list, the first is used)
+        store_filename (string) - name of NetCDF file to bind to for simulation output and checkpointing
+
+        OPTIONAL ARGUMENTS
+
+        protocol (dict) - Optional protocol to use for specifying simulation protocol as a dict. Provided keywords will be matched to object variables to replace defaults.
+
+        """
+
+        # Set expanded-ensemble defaults first so that they can be replaced by 'protocol'.
+        self.state_move_scheme = 'gibbs' # kernel used for state moves
+        self.log_weights = None # log weights of states, or None for all zero
+        self.nstate_moves = 1 # number of state moves per iteration
+        self.integrator_state_moves = False # make state moves on the device inside the integrator
+        self.nsteps_per_state_move = 10 # number of timesteps between on-device state moves
+        self.weight_update_scheme = None # online adaptation of log weights, or None
+        self.histogram_flatness = 0.8 # histogram is flat when its minimum exceeds this fraction of its mean
+        self.wang_landau_initial_gain = 1.0 # initial Wang-Landau log weight increment
+        self.wang_landau_gain_factor = 0.5 # Wang-Landau gain reduction factor when the histogram is flat
+        self.sams_beta = 0.8 # exponent of initial-stage SAMS gain
+        self.weight_update_minimum_gain = 1.0e-4 # log weights are frozen below this gain
+        self.weights_frozen = False # True once adaptation of log weights has stopped
+
+        # Initialize replica-exchange simlulation.
+        ReplicaExchange.__init__(self, states, coordinates, store_filename, protocol=protocol, mm=mm)
+
+        # A single replica visits all states.
+        self.nreplicas = 1
+
+        # Override title.
+        self.title = 'Expanded-ensemble simulation created using ExpandedEnsemble class of repex.py on %s' % time.asctime(time.localtime())
+
+        return
+
+    def _initialize(self):
+        """
+        Initialize the simulation, and bind to a storage file.
+
+        """
+
+        if self.state_move_scheme not in ['metropolis', 'barker', 'gibbs', 'metropolized-gibbs']:
+            raise ParameterException("State move scheme '%s' unknown.  Choose valid 'state_move_scheme' parameter." % self.state_move_scheme)
+
+        # Set up log weights.
+        if self.log_weights is None:
+            self.log_weights = numpy.zeros([len(self.states)], numpy.float64)
+        self.log_weights = numpy.array(self.log_weights, numpy.float64)
+        if len(self.log_weights) != len(self.states):
+            raise ParameterException("'log_weights' has %d entries, but there are %d states." % (len(self.log_weights), len(self.states)))
+
+        # Set up adaptation of log weights.
+        if self.weight_update_scheme not in [None, 'wang-landau', 'sams']:
+            raise ParameterException("Weight update scheme '%s' unknown.  Choose valid 'weight_update_scheme' parameter." % self.weight_update_scheme)
+        if self.weight_update_scheme == 'wang-landau':
+            self._weight_gain = self.wang_landau_initial_gain # current log weight update gain
+        else:
+            self._weight_gain = 0.0
+        self._weight_histogram = numpy.zeros([len(self.states)], numpy.int64) # visits counted for the flat-histogram criterion
+        self._weight_stage_iteration = None # iteration at which SAMS entered its asymptotic stage
+
+        # On-device state moves use one System at several temperatures.
+        if self.integrator_state_moves:
+            if self.state_move_scheme != 'gibbs':
+                raise ParameterException("On-device state moves only support the 'gibbs' state move scheme.")
+            for state in self.states:
+                if (state.system is not self.states[0].system) or (state.pressure is not None) or (state.parameters != self.states[0].parameters):
+                    raise ParameterException("On-device state moves require all states to share one System and global parameters at constant volume.")
+
+        # The replica keeps one persistent Context for as long as it stays with the same System.
+        self._replica_context = None
+        self._replica_integrator = None
+        self._replica_state_index = None
+
+        ReplicaExchange._initialize(self)
+
+        # Only the current state holds the replica.
+        self._set_replica_state(self.replica_states[0])
+
+        return
+
+    def _propagate_replicas(self):
+        """
+        Propagate the replica in its current state.
+
+        NOTES
+
+        Positions and velocities are kept in the persistent Context between iterations.  They are only set from the stored
+        coordinates when the Context changes, and velocities are only redrawn when the state changes.  With
+        'integrator_state_moves', state moves are also made during propagation (see _create_state_move_integrator()).
+
+        """
+
+        start_time = time.time()
+
+        if self.verbose: print "Propagating replica for %.3f ps..." % (self.nsteps_per_iteration * self.timestep / units.picoseconds)
+
+        if self.integrator_state_moves:
+            self._propagate_replica_with_state_moves()
+        else:
+            # Retrieve state.
+            state_index = self.replica_states[0]
+            state = self.states[state_index]
+            # Retrieve persistent context, updating integrator parameters in place.
+            [context, integrator] = self._context_cache.get_context(state.system, self.platform, parameters=state.parameters, temperature=state.temperature, collision_rate=self.collision_rate, timestep=self.timestep)
+            # Set coordinates if they are not already held by this context.
+            if context is not self._replica_context:
+                context.setPositions(units.Quantity(self.replica_coordinates[0], units.nanometers))
+                self._replica_context = context
+                self._replica_state_index = None
+            # Assign Maxwell-Boltzmann velocities if the state has changed.
+            if state_index != self._replica_state_index:
+                context.setVelocitiesToTemperature(state.temperature)
+                self._replica_state_index = state_index
+            # Run dynamics.
+            integrator.step(self.nsteps_per_iteration)
+            # Store final coordinates.
+            openmm_state = context.getState(getPositions=True)
+            self.replica_coordinates[0,:,:] = openmm_state.getPositions(asNumpy=True) / units.nanometers
+
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        ns_per_day = self.timestep * self.nsteps_per_iteration / elapsed_time * 24*60*60 / units.nanoseconds
+        if self.verbose: print "Time to propagate replica %.3f s (%.3f ns/day).\n" % (elapsed_time, ns_per_day)
+
+        return
+
+    def _required_energies(self):
+        """
+        Determine which entries of the energy matrix will be read by the state moves.
+
+        RETURNS
+
+        required (numpy.array of bool, or None) - required[0,k] is True if the reduced potential at state k will be read by the
+           next state moves, or None if all entries are needed
+
+        NOTES
+
+        The 'metropolis' and 'barker' kernels only propose neighboring states, so only states within 'nstate_moves' of the
+        current state are required.  The Gibbs kernels need all states.
+
+        """
+
+        if self.state_move_scheme in ['metropolis', 'barker']:
+            state_index = self.replica_states[0]
+            required = numpy.zeros([self.nreplicas, self.nstates], numpy.bool_)
+            required[0,max(0, state_index - self.nstate_moves):min(self.nstates, state_index + self.nstate_moves + 1)] = True
+            return required
+
+        return None
+
+    def _state_probabilities(self, log_P_k):
+        """
+        Compute normalized state probabilities from unnormalized log probabilities.
+
+        ARGUMENTS
+
+        log_P_k (numpy float64 array) - log_P_k[k] is the unnormalized log probability of state k, or NaN if not computed
+
+        RETURNS
+
+        P_k (numpy float64 array) - P_k[k] is the normalized probability of state k (zero where log_P_k is NaN)
+
+        """
+
+        log_P_k = numpy.where(numpy.isnan(log_P_k), -numpy.inf, log_P_k)
+        P_k = numpy.exp(log_P_k - log_P_k.max())
+        P_k /= P_k.sum()
+
+        return P_k
+
+    def _sample_state(self, state_index, log_P_k):
+        """
+        Propose a new state for the replica and accept or reject it with the kernel selected by 'state_move_scheme'.
+
+        ARGUMENTS
+
+        state_index (int) - the current state of the replica
+        log_P_k (numpy float64 array) - log_P_k[k] = g_k - u_k(x) is the unnormalized log probability of state k, or NaN if not computed
+
+        RETURNS
+
+        proposed_state_index (int) - the proposed state
+        accepted (boolean) - True if the proposed state was accepted
+
+        """
+
+        if self.state_move_scheme in ['metropolis', 'barker']:
+            # Propose a neighboring state; proposals outside the range of states, or to states without energies, are rejected.
+            proposed_state_index = state_index + 2 * numpy.random.randint(2) - 1
+            if (proposed_state_index < 0) or (proposed_state_index >= self.nstates) or numpy.isnan(log_P_k[proposed_state_index]):
+                return (state_index, False)
+            log_P_accept = log_P_k[proposed_state_index] - log_P_k[state_index]
+            if self.state_move_scheme == 'metropolis':
+                accepted = (log_P_accept >= 0.0) or (numpy.random.rand() < math.exp(log_P_accept))
+            else:
+                # Barker acceptance probability 1 / (1 + exp(-log_P_accept)), evaluated without overflow.
+                if log_P_accept >= 0.0:
+                    P_accept = 1.0 / (1.0 + math.exp(-log_P_accept))
+                else:
+                    P_accept = math.exp(log_P_accept) / (1.0 + math.exp(log_P_accept))
+                accepted = (numpy.random.rand() < P_accept)
+            return (proposed_state_index, accepted)
+
+        P_k = self._state_probabilities(log_P_k)
+
+        if self.state_move_scheme == 'gibbs':
+            # Draw the new state from its conditional distribution; this move is always accepted.
+            cumulative_P_k = numpy.cumsum(P_k)
+            proposed_state_index = min(numpy.searchsorted(cumulative_P_k, numpy.random.rand() * cumulative_P_k[-1], side='right'), self.nstates-1)
+            return (proposed_state_index, True)
+
+        if self.state_move_scheme == 'metropolized-gibbs':
+            # Draw a different state from the conditional distribution with the current state excluded.
+            if P_k[state_index] >= 1.0:
+                return (state_index, False)
+            Q_k = P_k.copy()
+            Q_k[state_index] = 0.0
+            cumulative_Q_k = numpy.cumsum(Q_k)
+            proposed_state_index = min(numpy.searchsorted(cumulative_Q_k, numpy.random.rand() * cumulative_Q_k[-1], side='right'), self.nstates-1)
+            P_accept = (1.0 - P_k[state_index]) / (1.0 - P_k[proposed_state_index])
+            accepted = (P_accept >= 1.0) or (numpy.random.rand() < P_accept)
+            return (proposed_state_index, accepted)
+
+        raise ParameterException("State move scheme '%s' unknown.  Choose valid 'state_move_scheme' parameter." % self.state_move_scheme)
+
+    def _create_state_move_integrator(self, propagate=True):
+        """
+        Create a CustomIntegrator that propagates Langevin dynamics and Gibbs samples the state index on the device.
+
+        OPTIONAL ARGUMENTS
+
+        propagate (boolean) - if False, each step only performs a state move, leaving positions unchanged (default: True)
+
+        RETURNS
+
+        integrator (simtk.openmm.CustomIntegrator) - the integrator, whose global variable 'state' holds the current state index
+
+        NOTES
+
+        Dynamics use velocity Verlet with a half-step Ornstein-Uhlenbeck velocity update at the temperature of the current
+        state before and after each step.  Every 'nsteps_per_state_move' steps, log probabilities logp_k = g_k - E(x)/kT_k
+        are computed from a single potential energy evaluation and a new state is drawn from them by inverting the cumulative
+        distribution with one uniform random number, exactly as the Python 'gibbs' kernel does.  Velocities are then rescaled
+        to the temperature of the new state.
+
+        """
+
+        # Extract thermal energies of states (in kJ/mol) and the initial state.
+        kT_k = [ (kB * state.temperature) / units.kilojoules_per_mole for state in self.states ]
+        state_index = self.replica_states[0]
+
+        # Compute Langevin velocity update coefficients for a half timestep.
+        gamma_dt = (self.collision_rate * units.picoseconds) * (self.timestep / units.picoseconds)
+        a = math.exp(-gamma_dt / 2.0)
+        b = math.sqrt(1.0 - a**2)
+
+        integrator = self.mm.CustomIntegrator(self.timestep)
+
+        # Define variables.
+        integrator.addGlobalVariable('state', state_index)
+        integrator.addGlobalVariable('kT', kT_k[state_index])
+        integrator.addGlobalVariable('a', a)
+        integrator.addGlobalVariable('b', b)
+        integrator.addGlobalVariable('nsteps_per_move', self.nsteps_per_state_move)
+        integrator.addGlobalVariable('step_count', 0)
+        for (name, value) in [('logp_max', 0.0), ('Z', 0.0), ('r', 0.0), ('cumulative', 0.0), ('new_state', 0.0), ('kT_new', 0.0)]:
+            integrator.addGlobalVariable(name, value)
+        for k in range(self.nstates):
+            integrator.addGlobalVariable('kT%d' % k, kT_k[k])
+            integrator.addGlobalVariable('g%d' % k, self.log_weights[k])
+            integrator.addGlobalVariable('logp%d' % k, 0.0)
+        integrator.addPerDofVariable('x1', 0)
+
+        # Propagate dynamics, performing a state move every 'nsteps_per_move' steps.
+        if propagate:
+            integrator.addUpdateContextState()
+            integrator.addComputePerDof('v', 'a*v + b*sqrt(kT/m)*gaussian')
+            integrator.addConstrainVelocities()
+            integrator.addComputePerDof('v', 'v + 0.5*dt*f/m')
+            integrator.addComputePerDof('x', 'x + dt*v')
+            integrator.addComputePerDof('x1', 'x')
+            integrator.addConstrainPositions()
+            integrator.addComputePerDof('v', 'v + 0.5*dt*f/m + (x-x1)/dt')
+            integrator.addConstrainVelocities()
+            integrator.addComputePerDof('v', 'a*v + b*sqrt(kT/m)*gaussian')
+            integrator.addComputeGlobal('step_count', 'step_count + 1')
+            integrator.beginIfBlock('step_count >= nsteps_per_move')
+            integrator.addComputeGlobal('step_count', '0')
+
+        # Compute log probabilities of all states.
+        for k in range(self.nstates):
+            integrator.addComputeGlobal('logp%d' % k, 'g%d - energy/kT%d' % (k, k))
+        integrator.addComputeGlobal('logp_max', 'logp0')
+        for k in range(1, self.nstates):
+            integrator.addComputeGlobal('logp_max', 'max(logp_max, logp%d)' % k)
+        integrator.addComputeGlobal('Z', ' + '.join([ 'exp(logp%d - logp_max)' % k for k in range(self.nstates) ]))
+
+        # Draw new state: it is the number of cumulative probabilities not exceeding a uniform variate on [0,Z).
+        integrator.addComputeGlobal('r', 'uniform*Z')
+        integrator.addComputeGlobal('cumulative', '0')
+        integrator.addComputeGlobal('new_state', '0')
+        for k in range(self.nstates - 1):
+            integrator.addComputeGlobal('cumulative', 'cumulative + exp(logp%d - logp_max)' % k)
+            integrator.addComputeGlobal('new_state', 'new_state + step(r - cumulative)')
+
+        # Rescale velocities to the temperature of the new state.
+        integrator.addComputeGlobal('kT_new', ' + '.join([ 'kT%d*delta(new_state - %d)' % (k, k) for k in range(self.nstates) ]))
+        integrator.addComputePerDof('v', 'v*sqrt(kT_new/kT)')
+        integrator.addComputeGlobal('kT', 'kT_new')
+        integrator.addComputeGlobal('state', 'new_state')
+
+        if propagate:
+            integrator.endBlock()
+
+        return integrator
+
+    def _propagate_replica_with_state_moves(self):
+        """
+        Propagate the replica with the state move integrator, which moves the replica between states on the device.
+
+        """
+
+        # Create persistent context on first use.
+        if self._replica_context is None:
+            self._replica_integrator = self._create_state_move_integrator()
+            self._replica_context = self.mm.Context(self.states[0].system, self._replica_integrator, self.platform)
+            for (name, value) in (self.states[0].parameters or dict()).items():
+                self._replica_context.setParameter(name, value)
+            self._replica_context.setPositions(units.Quantity(self.replica_coordinates[0], units.nanometers))
+            self._replica_context.setVelocitiesToTemperature(self.states[self.replica_states[0]].temperature)
+
+        # Run dynamics with state moves.
+        initial_state_index = self.replica_states[0]
+        self._replica_integrator.step(self.nsteps_per_iteration)
+        state_index = int(round(self._replica_integrator.getGlobalVariableByName('state')))
+
+        # Store final coordinates and state.
+        openmm_state = self._replica_context.getState(getPositions=True)
+        self.replica_coordinates[0,:,:] = openmm_state.getPositions(asNumpy=True) / units.nanometers
+        self._set_replica_state(state_index)
+
+        # Accumulate the net state transition over this iteration.
+        self.Nij_proposed[initial_state_index,state_index] += 1
+        self.Nij_accepted[initial_state_index,state_index] += 1
+        self._update_swap_statistics()
+
+        return
+
+    def validate_integrator_state_moves(self, nsamples=1000):
+        """
+        Validate state moves made by the state move integrator against the Python 'gibbs' kernel for the same log weights.
+
+        OPTIONAL ARGUMENTS
+
+        nsamples (int) - number of state moves to sample on the device (default: 1000)
+
+        RETURNS
+
+        P_python (numpy array) - P_python[k] is p(k|x) for the current configuration, computed in Python
+        P_integrator (numpy array) - P_integrator[k] is the fraction of state moves on the device that selected state k
+
+        NOTES
+
+        The configuration is held fixed and only state moves are performed, so each move is an independent draw from p(k|x).
+        The two distributions should agree to within sampling error, of order sqrt(P_python / nsamples).
+
+        EXAMPLES
+
+        >>> import simtk.pyopenmm.extras.testsystems as testsystems
+        >>> [system, coordinates] = testsystems.AlanineDipeptideImplicit()
+        >>> import tempfile
+        >>> file = tempfile.NamedTemporaryFile() # temporary file for testing
+        >>> states = [ ThermodynamicState(system, temperature=T*units.kelvin) for T in [298.0, 310.0, 320.0] ]
+        >>> simulation = ExpandedEnsemble(states, coordinates, file.name, protocol={'integrator_state_moves' : True, 'number_of_equilibration_iterations' : 0})
+        >>> [P_python, P_integrator] = simulation.validate_integrator_state_moves(nsamples=2000)
+        >>> bool(abs(P_python - P_integrator).max() < 0.05)
+        True
+
+        """
+
+        if not self._initialized:
+            self._initialize()
+
+        # Compute state probabilities in Python.
+        coordinates = units.Quantity(self.replica_coordinates[0], units.nanometers)
+        u_k = numpy.array([ state.reduced_potential(coordinates, platform=self.platform) for state in self.states ], numpy.float64)
+        P_python = self._state_probabilities(self.log_weights - u_k)
+
+        # Sample states on the device with the configuration held fixed.
+        integrator = self._create_state_move_integrator(propagate=False)
+        context = self.mm.Context(self.states[0].system, integrator, self.platform)
+        for (name, value) in (self.states[0].parameters or dict()).items():
+            context.setParameter(name, value)
+        context.setPositions(coordinates)
+        counts = numpy.zeros([self.nstates], numpy.float64)
+        for sample in range(nsamples):
+            integrator.step(1)
+            counts[int(round(integrator.getGlobalVariableByName('state')))] += 1
+        P_integrator = counts / counts.sum()
+        del context, integrator
+
+        if self.verbose:
+            print "%8s %12s %12s" % ("state", "Python", "integrator")
+            for k in range(self.nstates):
+                print "%8d %12.5f %12.5f" % (k, P_python[k], P_integrator[k])
+            print "Maximum deviation %.5f (expected sampling error ~ %.5f)" % (abs(P_python - P_integrator).max(), numpy.sqrt(P_python.max() / nsamples))
+
+        return (P_python, P_integrator)
+
+    def _update_log_weights(self, log_P_k):
+        """
+        Adapt the log weights toward those giving uniform sampling of states, according to 'weight_update_scheme'.
+
+        ARGUMENTS
+
+        log_P_k (numpy float64 array) - log_P_k[k] = g_k - u_k(x) is the unnormalized log probability of state k for the
+           configuration used in the last state moves, or NaN if not computed
+
+        NOTES
+
+        In the 'wang-landau' scheme, the log weight of the current state is reduced by the gain after each iteration, and the
+        gain is multiplied by 'wang_landau_gain_factor' each time the histogram of visits since the last reduction is flat.
+
+        In the 'sams' scheme (self-adjusted mixture sampling), all log weights are reduced by gain * nstates * w_k, where w_k is
+        p(k|x) if the energies at all states are available and delta(k, current state) otherwise.  The gain is min(1/nstates, t^-beta)
+        during the initial stage, and min(1/nstates, 1/(t - t0 + t0^beta)) once the histogram first became flat at t0, which
+        gives asymptotically optimal convergence of the weights.
+
+        In both schemes, the log weights are frozen once the gain falls below 'weight_update_minimum_gain'.
+
+        """
+
+        if (self.weight_update_scheme is None) or self.weights_frozen:
+            return
+
+        state_index = self.replica_states[0]
+        self._weight_histogram[state_index] += 1
+        histogram_is_flat = (self._weight_histogram.min() > self.histogram_flatness * self._weight_histogram.mean())
+
+        if self.weight_update_scheme == 'wang-landau':
+            self.log_weights[state_index] -= self._weight_gain
+            if histogram_is_flat:
+                self._weight_gain *= self.wang_landau_gain_factor
+                self._weight_histogram[:] = 0
+                if self.verbose: print "Histogram is flat; Wang-Landau gain reduced to %.3e." % self._weight_gain
+        elif self.weight_update_scheme == 'sams':
+            # Use the Rao-Blackwellized update if the energies at all states are available.
+            if numpy.isnan(log_P_k).any():
+                w_k = numpy.zeros([self.nstates], numpy.float64)
+                w_k[state_index] = 1.0
+            else:
+                w_k = self._state_probabilities(log_P_k)
+            t = float(self.iteration + 1)
+            if (self._weight_stage_iteration is None) and histogram_is_flat:
+                self._weight_stage_iteration = self.iteration + 1
+                setattr(self.ncfile, 'sams_stage_iteration', self._weight_stage_iteration)
+                if self.verbose: print "Histogram is flat; SAMS entering asymptotic stage."
+            if self._weight_stage_iteration is None:
+                self._weight_gain = min(1.0 / self.nstates, t**(-self.sams_beta))
+            else:
+                t0 = float(self._weight_stage_iteration)
+                self._weight_gain = min(1.0 / self.nstates, 1.0 / (t - t0 + t0**self.sams_beta))
+            self.log_weights -= self._weight_gain * self.nstates * w_k
+        else:
+            raise ParameterException("Weight update scheme '%s' unknown.  Choose valid 'weight_update_scheme' parameter." % self.weight_update_scheme)
+
+        # Only differences in log weights matter.
+        self.log_weights -= self.log_weights[0]
+
+        # Freeze log weights once the gain is small enough.
+        if self._weight_gain < self.weight_update_minimum_gain:
+            self.weights_frozen = True
+            if self.verbose: print "Log weight gain %.3e is below %.3e; log weights are now frozen." % (self._weight_gain, self.weight_update_minimum_gain)
+
+        # Update log weights held by the state move integrator.
+        if self._replica_integrator is not None:
+            for k in range(self.nstates):
+                self._replica_integrator.setGlobalVariableByName('g%d' % k, self.log_weights[k])
+
+        return
+
+    def _initialize_netcdf(self):
+        """
+        Initialize NetCDF file for storage, adding variables for the log weights and their adaptation.
+
+        """
+
+        ReplicaExchange._initialize_netcdf(self)
+
+        ncvar_log_weights = self.ncfile.createVariable('log_weights', 'd', ('iteration','state'))
+        ncvar_gain        = self.ncfile.createVariable('weight_gain', 'd', ('iteration',))
+        ncvar_histogram   = self.ncfile.createVariable('weight_histogram', 'l', ('iteration','state'))
+        setattr(ncvar_log_weights, 'units', 'none')
+        setattr(ncvar_gain,        'units', 'none')
+        setattr(ncvar_histogram,   'units', 'none')
+        setattr(ncvar_log_weights, "long_name", "log_weights[iteration][state] is the log weight g_k of state 'state' used for state moves after iteration 'iteration'.")
+        setattr(ncvar_gain,        "long_name", "weight_gain[iteration] is the gain of the log weight update after iteration 'iteration', or zero if log weights are not adapted.")
+        setattr(ncvar_histogram,   "long_name", "weight_histogram[iteration][state] is the number of visits to state 'state' counted for the flat-histogram criterion after iteration 'iteration'.")
+        self.ncfile.sync()
+
+        return
+
+    def _write_iteration_netcdf(self):
+        """
+        Write positions, states, energies, and log weights of current iteration to NetCDF file.
+
+        """
+
+        self.ncfile.variables['log_weights'][self.iteration,:] = self.log_weights[:]
+        self.ncfile.variables['weight_gain'][self.iteration] = self._weight_gain
+        self.ncfile.variables['weight_histogram'][self.iteration,:] = self._weight_histogram[:]
+
+        ReplicaExchange._write_iteration_netcdf(self)
+
+        return
+
+    def _resume_from_netcdf(self):
+        """
+        Resume execution by reading current positions, energies, and log weights from a NetCDF file.
+
+        """
+
+        ReplicaExchange._resume_from_netcdf(self)
+
+        # Restore log weights and the state of their adaptation from the last iteration resumed from.
+        iteration = self.iteration - 1
+        self.log_weights[:] = self.ncfile.variables['log_weights'][iteration,:]
+        self._weight_gain = float(self.ncfile.variables['weight_gain'][iteration])
+        self._weight_histogram[:] = self.ncfile.variables['weight_histogram'][iteration,:]
+        if hasattr(self.ncfile, 'sams_stage_iteration') and (self.ncfile.sams_stage_iteration <= iteration + 1):
+            self._weight_stage_iteration = int(self.ncfile.sams_stage_iteration)
+        self.weights_frozen = (self.weight_update_scheme is not None) and (self._weight_gain < self.weight_update_minimum_gain)
+
+        return
+
+    def _set_replica_state(self, state_index):
+        """
+        Assign the replica to a state, keeping state_replicas consistent.
+
+        ARGUMENTS
+
+        state_index (int) - the new state of the replica
+
+        NOTES
+
+        With a single replica, state_replicas[k] is 0 for the current state and -1 for all other states.
+
+        """
+
+        self.replica_states[0] = state_index
+        self.state_replicas[:] = -1
+        self.state_replicas[state_index] = 0
+
+        return
+
+    def _check_state_replicas(self):
+        """
+        Check that the replica is in a valid state and state_replicas holds it only at that state.
+
+        """
+
+        state_index = self.replica_states[0]
+        if (state_index < 0) or (state_index >= self.nstates):
+            raise Exception("replica_states holds invalid state %d" % state_index)
+        expected = -numpy.ones([self.nstates], numpy.int32)
+        expected[state_index] = 0
+        if not numpy.all(self.state_replicas == expected):
+            raise Exception("state_replicas is inconsistent with replica in state %d: %s" % (state_index, str(self.state_replicas)))
+
+        return
+
+    def _mix_replicas(self):
+        """
+        Attempt to move the replica to other states according to the user-specified state move scheme.
+
+        """
+
+        # Reset storage to keep track of state moves this iteration.
+        self.Nij_proposed[:,:] = 0
+        self.Nij_accepted[:,:] = 0
+
+        # On-device state moves were made during propagation; adapt log weights for the configuration at its end.
+        if self.integrator_state_moves:
+            self._update_log_weights(self.log_weights - numpy.array(self.u_kl[0,:], numpy.float64))
+            return
+
+        if self.verbose: print "Attempting %d '%s' state moves..." % (self.nstate_moves, self.state_move_scheme)
+
+        # Compute unnormalized log probabilities of all states for the current configuration.
+        log_P_k = self.log_weights - numpy.array(self.u_kl[0,:], numpy.float64)
+
+        # Attempt state moves.
+        state_index = self.replica_states[0]
+        for move in range(self.nstate_moves):
+            (proposed_state_index, accepted) = self._sample_state(state_index, log_P_k)
+            self.Nij_proposed[state_index,proposed_state_index] += 1
+            if accepted:
+                self.Nij_accepted[state_index,proposed_state_index] += 1
+                state_index = proposed_state_index
+        self._set_replica_state(state_index)
+
+        # Check state index.
+        if self.debug:
+            self._check_state_replicas()
+
+        # Update state move statistics.
+        self._update_swap_statistics()
+
+        # Adapt log weights.
+        self._update_log_weights(log_P_k)
+
+        if self.verbose: print "Replica is now in state %d." % state_index
+
+        return
+
 #=============================================================================================
 # MAIN AND TESTS
 #=============================================================================================
@@ -63,6 +63,8 @@ import os
 import math
 import copy
 import time
+import itertools
+import collections
 
 import numpy
 import numpy.linalg
@@ -104,6 +106,186 @@ class ParameterException(Exception):
     """
     pass
     
+#=============================================================================================
+# Context cache
+#=============================================================================================
+
+class ContextCache(object):
+    """
+    Bounded least-recently-used cache of OpenMM Context objects.
+
+    DESCRIPTION
+
+    Creating a Context can be more expensive than the dynamics or energy evaluation that follows it, especially on
+    GPU platforms, where kernels must be compiled and device memory allocated.  This cache keeps one Context (and its
+    LangevinIntegrator) alive for each (System, Platform) pair, so that the temperature, collision rate, and timestep
+    can be changed in place instead of building a new Context.  When more than 'capacity' Contexts are held, the
+    least recently used one is destroyed.
+
+    Contexts are keyed by System identity, so a System that is modified in place after a Context has been created
+    for it must be explicitly invalidated with invalidate(system).  States that share a System and differ only in the
+    values of global parameters share one Context, and the parameters are changed in place with setParameter().
+
+    EXAMPLES
+
+    >>> import simtk.unit as units
+    >>> import simtk.pyopenmm.extras.testsystems as testsystems
+    >>> [system, coordinates] = testsystems.AlanineDipeptideImplicit()
+    >>> cache = ContextCache(capacity=2)
+    >>> [context, integrator] = cache.get_context(system, temperature=298.0*units.kelvin)
+    >>> [context2, integrator2] = cache.get_context(system, temperature=350.0*units.kelvin)
+    >>> context2 is context
+    True
+    >>> cache.invalidate(system)
+    >>> len(cache)
+    0
+
+    """
+
+    def __init__(self, capacity=None, mm=None):
+        """
+        Initialize an empty Context cache.
+
+        OPTIONAL ARGUMENTS
+
+        capacity (int) - maximum number of Context objects to keep alive, or None if unbounded (default: None)
+        mm (implementation of simtk.openmm) - OpenMM API implementation to use (default: simtk.openmm)
+
+        """
+
+        self.mm = mm
+        if mm is None: self.mm = simtk.openmm
+
+        self.capacity = capacity
+        self._entries = collections.OrderedDict() # _entries[key] is (system, context, integrator, parameters), most recently used last
+
+        return
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, system, platform):
+        """
+        Return the cache key for the given System and Platform.
+
+        """
+        platform_name = None
+        if platform is not None:
+            platform_name = platform.getName()
+        return (id(system), platform_name)
+
+    def get_context(self, system, platform=None, temperature=None, collision_rate=None, timestep=None, parameters=None):
+        """
+        Retrieve a Context for the given System, creating one only if none is cached.
+
+        ARGUMENTS
+
+        system (simtk.openmm.System) - the System the Context is to be bound to
+
+        OPTIONAL ARGUMENTS
+
+        platform (simtk.openmm.Platform) - the Platform to create the Context on, or None for the default Platform (default: None)
+        temperature (simtk.unit.Quantity with units compatible with kelvin) - if specified, integrator temperature is set to this value (default: None)
+        collision_rate (simtk.unit.Quantity with units compatible with 1/picoseconds) - if specified, integrator collision rate is set to this value (default: None)
+        timestep (simtk.unit.Quantity with units compatible with femtoseconds) - if specified, integrator timestep is set to this value (default: None)
+        parameters (dict) - if specified, each global parameter of the Context named by a key is set to its value; global
+           parameters not listed are reset to their default values in the System (default: None)
+
+        RETURNS
+
+        context (simtk.openmm.Context) - the cached Context
+        integrator (simtk.openmm.LangevinIntegrator) - the integrator bound to the Context
+
+        """
+
+        key = self._key(system, platform)
+        if key in self._entries:
+            # Mark entry as most recently used.
+            entry = self._entries.pop(key)
+            self._entries[key] = entry
+            [system, context, integrator, context_parameters] = entry
+        else:
+            # Create integrator and context, using defaults for any parameters not specified.
+            integrator = self.mm.LangevinIntegrator(300.0 * units.kelvin, 91.0 / units.picosecond, 1.0 * units.femtosecond)
+            if platform is not None:
+                context = self.mm.Context(system, integrator, platform)
+            else:
+                context = self.mm.Context(system, integrator)
+            # Record default values of global parameters, which the Context starts with.
+            context_parameters = self._default_parameters(system)
+            # We hold a reference to the System so that its id() cannot be reused while it is cached.
+            self._entries[key] = (system, context, integrator, context_parameters)
+            # Evict least recently used contexts.
+            while (self.capacity is not None) and (len(self._entries) > self.capacity):
+                self._entries.popitem(last=False)
+
+        # Update integrator parameters in place.
+        if temperature is not None:
+            integrator.setTemperature(temperature)
+        if collision_rate is not None:
+            integrator.setFriction(collision_rate)
+        if timestep is not None:
+            integrator.setStepSize(timestep)
+
+        # Update global parameters in place, resetting any not specified to their defaults so no values leak between states.
+        if (parameters is not None) or (context_parameters['modified']):
+            requested_parameters = dict(context_parameters['defaults'])
+            requested_parameters.update(parameters or dict())
+            for (name, value) in requested_parameters.items():
+                if context_parameters['values'].get(name) != value:
+                    context.setParameter(name, value)
+                    context_parameters['values'][name] = value
+            context_parameters['modified'] = (context_parameters['values'] != context_parameters['defaults'])
+
+        return [context, integrator]
+
+    def _default_parameters(self, system):
+        """
+        Collect the default values of global parameters of all Forces in a System.
+
+        ARGUMENTS
+
+        system (simtk.openmm.System) - the System
+
+        RETURNS
+
+        context_parameters (dict) - 'defaults' and 'values' map each global parameter name to its default value, and
+           'modified' is False, as for a newly created Context
+
+        """
+
+        defaults = dict()
+        for force_index in range(system.getNumForces()):
+            force = system.getForce(force_index)
+            if hasattr(force, 'getNumGlobalParameters'):
+                for parameter_index in range(force.getNumGlobalParameters()):
+                    defaults[force.getGlobalParameterName(parameter_index)] = force.getGlobalParameterDefaultValue(parameter_index)
+
+        return { 'defaults' : defaults, 'values' : dict(defaults), 'modified' : False }
+
+    def invalidate(self, system=None):
+        """
+        Destroy cached Contexts for the given System, or all cached Contexts if no System is specified.
+
+        OPTIONAL ARGUMENTS
+
+        system (simtk.openmm.System) - System whose Contexts are to be destroyed, or None to destroy all Contexts (default: None)
+
+        NOTES
+
+        This must be called if a System is modified after a Context has been created for it.
+
+        """
+
+        if system is None:
+            self._entries.clear()
+        else:
+            for key in self._entries.keys():
+                if key[0] == id(system):
+                    del self._entries[key]
+
+        return
+
 #=============================================================================================
 # Thermodynamic state description
 #=============================================================================================
@@ -127,10 +309,27 @@ class ThermodynamicState(object):
 
     Note that the pressure is only relevant for periodic systems.
 
+    Specify a state by the values of global parameters of a shared System, such as the strength of a restraint.
+
+    >>> force = simtk.openmm.CustomExternalForce('K * (x^2 + y^2 + z^2)')
+    >>> force.addGlobalParameter('K', 0.0)
+    >>> force.addParticle(0, [])
+    >>> force_index = system.addForce(force)
+    >>> states = [ ThermodynamicState(system=system, temperature=298.0*units.kelvin, parameters={'K' : K}) for K in [0.0, 10.0, 100.0] ]
+
     NOTES
 
     This state object cannot describe states obeying non-Boltzamnn statistics, such as Tsallis statistics.
 
+    Context objects used to compute reduced potentials are cached in a bounded least-recently-used cache shared by all
+    ThermodynamicState objects and keyed by System identity and Platform, so that states sharing a System also share
+    a Context.  If a System is modified after its reduced potential has been computed, the cache must be invalidated
+    with ThermodynamicState.invalidate_context_cache(system).
+
+    States can share one System and differ only in the values of global parameters of its Forces.  The parameters are set
+    in the shared Context with setParameter() whenever the state is used, so a ladder of many such states needs neither a
+    System nor a Context per state.
+
     TODO
 
     Implement a more fundamental ProbabilityState as a base class?
@@ -141,8 +340,12 @@ class ThermodynamicState(object):
     temperature = None     # the temperature
     pressure = None        # the pressure, or None if not isobaric
     pH = None              # the pH, or None if not constant-pH
+    parameters = None      # dict of values of global parameters of the System, or None
 
-    def __init__(self, system=None, temperature=None, pressure=None, pH=None):
+    context_cache_capacity = 8 # maximum number of Context objects cached for energy evaluation
+    _context_caches = dict()   # _context_caches[mm] is the ContextCache used for energy evaluation with OpenMM implementation mm
+
+    def __init__(self, system=None, temperature=None, pressure=None, pH=None, parameters=None):
         """
         Initialize the thermodynamic state.
 
@@ -152,6 +355,7 @@ class ThermodynamicState(object):
         temperature (simtk.unit.Quantity compatible with 'kelvin') - the temperature for a system with constant temperature (default: None)
         pressure (simtk.unit.Quantity compatible with 'atmospheres') - the pressure for constant-pressure systems (default: None)
         pH (float) - the pH for systems under constant pH conditions
+        parameters (dict) - values of global parameters of the System's Forces that define this state, keyed by parameter name (default: None)
 
         NOTES
 
@@ -170,6 +374,8 @@ class ThermodynamicState(object):
             self.pressure = pressure
         if pH is not None:
             raise NotImplementedException("Constant pH simulation not implemented yet.")
+        if parameters is not None:
+            self.parameters = dict(parameters)
 
         return
 
@@ -231,44 +437,134 @@ class ThermodynamicState(object):
         
         """
 
+        # Evaluate as a batch of one configuration.
+        box_vectors_list = None
+        if box_vectors is not None:
+            box_vectors_list = [box_vectors]
+        reduced_potential = self.reduced_potentials([coordinates], box_vectors_list, mm=mm, platform=platform)[0]
+
+        return reduced_potential
+
+    def reduced_potentials(self, coordinates_list, box_vectors_list=None, mm=None, platform=None):
+        """
+        Compute the reduced potentials for many configurations in this thermodynamic state.
+
+        ARGUMENTS
+
+        coordinates_list (list of simtk.unit.Quantity of Nx3 numpy.array) - coordinates_list[i][n,k] is kth coordinate of particle n of configuration i
+
+        OPTIONAL ARGUMENTS
+
+        box_vectors_list (list) - box_vectors_list[i] are the periodic box vectors of configuration i (default: None)
+
+        RETURNS
+
+        u (numpy.array of float64) - u[i] is the unitless reduced potential of configuration i (in units of kT)
+
+        EXAMPLES
+
+        Compute the reduced potentials of several configurations of a Lennard-Jones cluster.
+
+        >>> import simtk.unit as units
+        >>> import simtk.pyopenmm.extras.testsystems as testsystems
+        >>> [system, coordinates] = testsystems.LennardJonesCluster()
+        >>> state = ThermodynamicState(system=system, temperature=298.0*units.kelvin)
+        >>> potentials = state.reduced_potentials([coordinates, coordinates])
+
+        NOTES
+
+        A single cached Context is used for all configurations, and the unit conversions needed to form the reduced
+        potential are carried out once for the whole array rather than once per configuration.
+        See reduced_potential() for the definition of the reduced potential.
+
+        """
+
         # Select OpenMM implementation if not specified.
         if mm is None: mm = simtk.openmm
 
         # If pressure is specified, ensure box vectors have been provided.
-        if (self.pressure is not None) and (box_vectors is None):
+        if (self.pressure is not None) and (box_vectors_list is None):
             raise ParameterException("box_vectors must be specified if constant-pressure ensemble.")
 
-        # Set up a dummy integrator -- parameters are irrelevant since we're not doing dynamics.
-        collision_rate = 90.0 / units.picosecond
-        timestep = 1.0 * units.femtosecond
-        integrator = mm.LangevinIntegrator(self.temperature, collision_rate, timestep)
-        
-        # Create an OpenMM Context.
-        if platform is not None:
-            context = mm.Context(self.system, integrator, platform)
-        else:
-            context = mm.Context(self.system, integrator)
+        # Retrieve a cached OpenMM Context.
+        context = self._get_context(mm, platform)
 
-        # Set coordinates.
-        context.setPositions(coordinates)
+        # Compute potential energies (in kJ/mol) and box volumes (in nm^3) of all configurations.
+        nconfigurations = len(coordinates_list)
+        potential_energies = numpy.zeros([nconfigurations], numpy.float64)
+        volumes = numpy.zeros([nconfigurations], numpy.float64)
+        for index in range(nconfigurations):
+            # Set coordinates.
+            context.setPositions(coordinates_list[index])
+            # Set periodic box vectors.
+            if box_vectors_list is not None:
+                context.setPeriodicBoxVectors(*box_vectors_list[index])
+                volumes[index] = self._volume(box_vectors_list[index]) / units.nanometers**3
+            # Retrieve potential energy.
+            openmm_state = context.getState(getEnergy=True)
+            potential_energies[index] = openmm_state.getPotentialEnergy() / units.kilojoules_per_mole
+
+        # Compute inverse temperature (in mol/kJ).
+        beta = 1.0 / (kB * self.temperature / units.kilojoules_per_mole)
+
+        # Compute reduced potentials.
+        reduced_potentials = beta * potential_energies
+        if self.pressure is not None:
+            pressure = self.pressure * units.nanometers**3 * units.AVOGADRO_CONSTANT_NA / units.kilojoules_per_mole # pressure (in kJ/mol/nm^3)
+            reduced_potentials += beta * pressure * volumes
 
-        # Set periodic box vectors.
-        if box_vectors is not None:
-            context.setPeriodicBoxVectors(*box_vectors)
+        return reduced_potentials
 
-        # Retrieve potential energy.
-        openmm_state = context.getState(getEnergy=True)
-        potential_energy = openmm_state.getPotentialEnergy()
-        
-        # Compute inverse temperature.
-        beta = 1.0 / (kB * self.temperature)
+    def _get_context(self, mm, platform):
+        """
+        Retrieve a cached Context for energy evaluation of this state's System, creating one only if necessary.
 
-        # Compute reduced potential.
-        reduced_potential = beta * potential_energy
-        if self.pressure is not None:
-            reduced_potential += beta * self.pressure * self._volume(box_vectors) * units.AVOGADRO_CONSTANT_NA
+        ARGUMENTS
 
-        return reduced_potential
+        mm (implementation of simtk.openmm) - OpenMM API implementation to use
+        platform (simtk.openmm.Platform) - Platform to use, or None for the default Platform
+
+        RETURNS
+
+        context (simtk.openmm.Context) - a Context bound to this state's System, with global parameters set to this state's values
+
+        """
+
+        if mm not in ThermodynamicState._context_caches:
+            ThermodynamicState._context_caches[mm] = ContextCache(capacity=ThermodynamicState.context_cache_capacity, mm=mm)
+        [context, integrator] = ThermodynamicState._context_caches[mm].get_context(self.system, platform, parameters=self.parameters)
+
+        return context
+
+    @classmethod
+    def invalidate_context_cache(cls, system=None):
+        """
+        Destroy cached Contexts used for energy evaluation.
+
+        OPTIONAL ARGUMENTS
+
+        system (simtk.openmm.System) - System whose Contexts are to be destroyed, or None to destroy all cached Contexts (default: None)
+
+        NOTES
+
+        This must be called if a System is modified after a reduced potential has been computed for it.
+
+        EXAMPLES
+
+        >>> import simtk.unit as units
+        >>> import simtk.pyopenmm.extras.testsystems as testsystems
+        >>> [system, coordinates] = testsystems.LennardJonesCluster()
+        >>> state = ThermodynamicState(system=system, temperature=298.0*units.kelvin)
+        >>> potential = state.reduced_potential(coordinates)
+        >>> system.getForce(0).setParticleParameters(0, 0.0, 1.0, 1.0)
+        >>> ThermodynamicState.invalidate_context_cache(system)
+
+        """
+
+        for cache in cls._context_caches.values():
+            cache.invalidate(system)
+
+        return
 
     def is_compatible_with(self, state):
         """
@@ -304,6 +600,8 @@ class ThermodynamicState(object):
             r += ", temperature = %s" % str(self.temperature)
         if self.pressure is not None:
             r += ", pressure = %s" % str(self.pressure)
+        if self.parameters is not None:
+            r += ", parameters = %s" % str(self.parameters)
         r += ">"
 
         return r
@@ -329,6 +627,95 @@ class ThermodynamicState(object):
         volume = numpy.linalg.det(A) * a.unit**3
         return volume
     
+#=============================================================================================
+# State graphs
+#=============================================================================================
+
+def state_graph_from_edges(nstates, istates, jstates):
+    """
+    Build a symmetric state adjacency graph in compressed sparse row (CSR) form from a list of edges.
+
+    ARGUMENTS
+
+    nstates (int) - number of states
+    istates, jstates (lists or numpy arrays of int) - edge k connects states istates[k] and jstates[k]
+
+    RETURNS
+
+    state_graph (tuple of numpy arrays) - (indptr, indices), where the neighbors of state k are indices[indptr[k]:indptr[k+1]]
+
+    EXAMPLES
+
+    A chain of four states.
+
+    >>> (indptr, indices) = state_graph_from_edges(4, [0, 1, 2], [1, 2, 3])
+    >>> indptr
+    array([0, 1, 3, 5, 6])
+    >>> indices
+    array([1, 0, 2, 1, 3, 2])
+
+    """
+
+    istates = numpy.array(istates, numpy.int64)
+    jstates = numpy.array(jstates, numpy.int64)
+
+    # Symmetrize and remove self-loops and duplicate edges.
+    rows = numpy.concatenate([istates, jstates])
+    columns = numpy.concatenate([jstates, istates])
+    keys = numpy.unique((rows * nstates + columns)[rows != columns]) # sorted by row, then column
+    (rows, indices) = (keys // nstates, keys % nstates)
+
+    # Compress.
+    indptr = numpy.zeros([nstates+1], numpy.int64)
+    indptr[1:] = numpy.cumsum(numpy.bincount(rows, minlength=nstates))
+
+    return (indptr, indices)
+
+def grid_state_graph(shape, periodic=False):
+    """
+    Build the state adjacency graph of a multidimensional grid of states, connecting nearest neighbors along each axis.
+
+    ARGUMENTS
+
+    shape (tuple of int) - number of grid points along each axis; state indices enumerate the grid in C (row-major) order
+
+    OPTIONAL ARGUMENTS
+
+    periodic (boolean) - if True, the grid wraps around along each axis (default: False)
+
+    RETURNS
+
+    state_graph (tuple of numpy arrays) - (indptr, indices) in compressed sparse row form, as for state_graph_from_edges()
+
+    EXAMPLES
+
+    A temperature x Hamiltonian ladder of 3 x 2 states.
+
+    >>> (indptr, indices) = grid_state_graph((3, 2))
+    >>> indices[indptr[2]:indptr[3]]
+    array([0, 3, 4])
+
+    """
+
+    nstates = int(numpy.prod(shape))
+    grid = numpy.arange(nstates).reshape(shape)
+
+    istates = list()
+    jstates = list()
+    for axis in range(len(shape)):
+        neighbors = numpy.roll(grid, -1, axis=axis)
+        if periodic:
+            istates.append(grid.ravel())
+            jstates.append(neighbors.ravel())
+        else:
+            # Exclude the wrapped-around last slice along this axis.
+            interior = [slice(None)] * len(shape)
+            interior[axis] = slice(0, shape[axis]-1)
+            istates.append(grid[tuple(interior)].ravel())
+            jstates.append(neighbors[tuple(interior)].ravel())
+
+    return state_graph_from_edges(nstates, numpy.concatenate(istates), numpy.concatenate(jstates))
+
 #=============================================================================================
 # Replica-exchange simulation
 #=============================================================================================
@@ -365,7 +752,24 @@ class ReplicaExchange(object):
     * number_of_equilibration_iterations (dimensionless) - number of equilibration iterations before begininng exhanges (default: 25)
     * equilibration_timestep (units: time) - timestep for use in equilibration (default: 2 fs)
     * verbose (boolean) - show information on run progress (default: False)
-    * replica_mixing_scheme (string) - scheme used to swap replicas: 'swap-all' or 'swap-neighbors' (default: 'swap-all')
+    * debug (boolean) - perform internal consistency checks, such as of the state-to-replica index after mixing (default: False)
+    * replica_mixing_scheme (string) - scheme used to swap replicas: 'swap-all', 'swap-neighbors', 'swap-graph', 'swap-candidates', or
+      'gibbs-blocks' (default: 'swap-all')
+    * state_graph (tuple of numpy arrays) - (indptr, indices) state adjacency graph in compressed sparse row form for the 'swap-graph'
+      scheme (see state_graph_from_edges() and grid_state_graph()), or None for a chain of states (default: None)
+    * mixing_block_size (dimensionless) - number of neighboring states per block for the 'gibbs-blocks' scheme, at most 8 (default: 6)
+    * candidate_list_size (dimensionless) - number of likely swap partners listed per state for the 'swap-candidates' scheme,
+      or None to use about log2 of the number of states (default: None)
+    * candidate_list_interval (dimensionless) - candidate lists are rebuilt from current energies every this many iterations (default: 10)
+    * max_contexts (dimensionless) - maximum number of OpenMM Context objects kept alive for propagation, or None if unbounded (default: 16)
+    * full_energy_interval (dimensionless) - the full energy matrix is computed every this many iterations; on other iterations, only the
+      entries read by the replica mixing scheme are computed and the rest are stored as NaN (default: 1)
+    * positions_storage_interval (dimensionless) - replica positions are written to the store file every this many iterations (default: 1)
+    * mixing_statistics_interval (dimensionless) - state mixing statistics are shown every this many iterations when verbose (default: 10)
+    * resident_coordinates (boolean) - if True, coordinates of each replica stay on the node that propagates it, and are only gathered on
+      the root node on iterations when positions are written to storage; only the replica state assignments are broadcast (default: False)
+    * load_balancing (boolean) - if True, replicas are assigned to nodes each iteration by longest-expected-first scheduling using the
+      measured propagation cost of each state; otherwise replicas are assigned to nodes in a fixed round-robin fashion (default: True)
     
     TODO
 
@@ -373,7 +777,6 @@ class ReplicaExchange(object):
     * Allow parallel resource to be used, if available (likely via Parallel Python).
     * Add support for and autodetection of other NetCDF4 interfaces.
     * Add HDF5 support.
-    * Cache Context objects to avoid overhead?
 
     EXAMPLES
 
@@ -469,13 +872,27 @@ class ReplicaExchange(object):
         self.platform = None
         self.energy_platform = None        
         self.replica_mixing_scheme = 'swap-all' # mix all replicas thoroughly
+        self.mixing_block_size = 6 # number of states per block for 'gibbs-blocks' mixing
+        self.candidate_list_size = None # number of swap partners per state for 'swap-candidates' mixing, or None for ~log2(nstates)
+        self.candidate_list_interval = 10 # rebuild candidate lists every 10 iterations
+        self.state_graph = None # state adjacency graph for 'swap-graph' mixing, or None for a chain
+        self.max_contexts = 16 # maximum number of Context objects kept alive for propagation
+        self.full_energy_interval = 1 # compute the full energy matrix every iteration
+        self.positions_storage_interval = 1 # write positions to the store file every iteration
+        self.mixing_statistics_interval = 10 # show state mixing statistics every 10 iterations
+        self.resident_coordinates = False # share coordinates of all replicas with all nodes after propagation
+        self.load_balancing = True # assign replicas to nodes by expected propagation cost
         self.comm = comm # MPI communicator (None if not to be run in parallel)
 
         # To allow for parameters to be modified after object creation, class is not initialized until a call to self._initialize().
         self._initialized = False
 
+        # Subclasses whose reduced potentials only depend on the potential energy can capture it at the end of propagation.
+        self._capture_potential_energies = False
+
         # Set verbosity.
         self.verbose = False
+        self.debug = False
         self.show_energies = True
         self.show_mixing_statistics = True
         
@@ -556,6 +973,9 @@ class ReplicaExchange(object):
             if self.verbose and self.show_energies:
                 self._show_energies()
 
+            # Accumulate state transition statistics.
+            self._accumulate_state_transitions()
+
             # Write to storage file.
             self._write_iteration_netcdf()
             
@@ -563,7 +983,7 @@ class ReplicaExchange(object):
             self.iteration += 1
 
             # Show mixing statistics.
-            if self.verbose:
+            if self.verbose and (self.iteration % self.mixing_statistics_interval == 0):
                 self._show_mixing_statistics()
 
 
@@ -582,7 +1002,6 @@ class ReplicaExchange(object):
             raise Error
 
         # Select OpenMM Platform.
-        # TODO: Store contexts persistently?        
         if self.platform is None:
             # Find fastest platform.
             fastest_speed = 0.0
@@ -599,6 +1018,9 @@ class ReplicaExchange(object):
         if self.energy_platform is None:
             self.energy_platform = simtk.openmm.Platform.getPlatformByName("Reference")                        
 
+        # Create persistent Context cache for propagation, bounded to avoid exhausting device memory.
+        self._context_cache = ContextCache(capacity=self.max_contexts, mm=self.mm)
+
         # Determine number of alchemical states.
         self.nstates = len(self.states)
 
@@ -606,25 +1028,41 @@ class ReplicaExchange(object):
         self.natoms = self.states[0].system.getNumParticles()
   
         # Allocate storage.
-        self.replica_coordinates = list() # self.replica_coordinates[i] is the configuration currently held in replica i
+        self.replica_coordinates = numpy.zeros([self.nstates, self.natoms, 3], numpy.float64) # replica_coordinates[i,:,:] is the configuration (in nm) currently held in replica i
         self.replica_states     = numpy.zeros([self.nstates], numpy.int32) # replica_states[i] is the state that replica i is currently at
+        self.state_replicas     = numpy.zeros([self.nstates], numpy.int32) # state_replicas[k] is the replica currently at state k (inverse of replica_states)
         self.u_kl               = numpy.zeros([self.nstates, self.nstates], numpy.float32)        
-        self.swap_Pij_accepted  = numpy.zeros([self.nstates, self.nstates], numpy.float32)
+        self.replica_potential_energies = numpy.nan * numpy.ones([self.nstates], numpy.float64) # replica_potential_energies[i] is the potential energy (in kJ/mol) of replica i captured at the end of propagation on this node, or NaN
+        self.swap_Pij_accepted  = numpy.zeros([self.nstates, self.nstates], numpy.float64) # swap_Pij_accepted[i][j] is the cumulative estimate of the probability of a swap from state i to state j
         self.Nij_proposed       = numpy.zeros([self.nstates,self.nstates], numpy.int64) # Nij_proposed[i][j] is the number of swaps proposed between states i and j, prior of 1
         self.Nij_accepted       = numpy.zeros([self.nstates,self.nstates], numpy.int64) # Nij_proposed[i][j] is the number of swaps proposed between states i and j, prior of 1
+        self.Nij_proposed_cumulative = numpy.zeros([self.nstates,self.nstates], numpy.int64) # Nij_proposed_cumulative[i][j] is the number of swaps proposed between states i and j over all iterations
+        self.Nij_accepted_cumulative = numpy.zeros([self.nstates,self.nstates], numpy.int64) # Nij_accepted_cumulative[i][j] is the number of swaps accepted between states i and j over all iterations
+        self.Nij_transitions    = numpy.zeros([self.nstates,self.nstates], numpy.int64) # Nij_transitions[i][j] is the number of times a replica in state i was found in state j on the next iteration
+        self._previous_replica_states = None # replica states at the previous stored iteration
+        self._block_permutations = dict() # _block_permutations[b] is an array of all permutations of b states, for 'gibbs-blocks' mixing
+        self._candidate_pairs = None # candidate state pairs for 'swap-candidates' mixing
+        self._candidate_pairs_iteration = None # iteration at which candidate pairs were last rebuilt
+        self._state_graph_colors = None # state graph edges partitioned into classes of disjoint pairs, for 'swap-graph' mixing
 
         # Distribute coordinate information to replicas in a round-robin fashion.
-        self.replica_coordinates = [ copy.deepcopy(self.provided_coordinates[replica_index % len(self.provided_coordinates)]) for replica_index in range(self.nstates) ]
-        #self.replica_coordinates = [ self.provided_coordinates[replica_index % len(self.provided_coordinates)] for replica_index in range(self.nstates) ]
+        for replica_index in range(self.nstates):
+            self.replica_coordinates[replica_index,:,:] = self.provided_coordinates[replica_index % len(self.provided_coordinates)] / units.nanometers
         
         # Assign initial replica states.
         for replica_index in range(self.nstates):
             self.replica_states[replica_index] = replica_index
+        self.state_replicas[self.replica_states] = numpy.arange(self.nstates)
 
         # Turn off verbosity if not master node.
         if self.comm is not None:
             if self.comm.rank != 0: self.verbose = False
 
+        # Assign replicas to nodes in a round-robin fashion, and initialize estimates of propagation cost (wall-clock seconds) for each state.
+        if self.comm is not None:
+            self.replica_owners = numpy.arange(self.nstates, dtype=numpy.int32) % self.comm.size # replica_owners[i] is the rank of the node propagating replica i
+            self.state_costs = numpy.nan * numpy.ones([self.nstates], numpy.float64) # state_costs[k] is the running estimate of the propagation time for state k, or NaN if not yet measured
+
         # Check if netcdf file extists.
         if os.path.exists(self.store_filename) and (os.path.getsize(self.store_filename) > 0):
             # Resume from NetCDF file.
@@ -653,6 +1091,7 @@ class ReplicaExchange(object):
             self._initialize_netcdf()
 
             # Store initial state.
+            self._accumulate_state_transitions()
             self._write_iteration_netcdf()
   
         # Signal that the class has been initialized.
@@ -672,6 +1111,9 @@ class ReplicaExchange(object):
 
         self.ncfile.close()
 
+        # Release cached Context objects.
+        self._context_cache.invalidate()
+
         return
 
     def _propagate_replicas(self):
@@ -695,22 +1137,19 @@ class ReplicaExchange(object):
                 # Retrieve state.
                 state_index = self.replica_states[replica_index] # index of thermodynamic state that current replica is assigned to
                 state = self.states[state_index] # thermodynamic state
-                # Create integrator and context.
-                integrator = self.mm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
-                context = self.mm.Context(state.system, integrator, self.platform)                        
+                # Retrieve persistent context, updating integrator parameters in place.
+                [context, integrator] = self._context_cache.get_context(state.system, self.platform, parameters=state.parameters, temperature=state.temperature, collision_rate=self.collision_rate, timestep=self.timestep)
                 # Set coordinates.
-                coordinates = self.replica_coordinates[replica_index]            
-                context.setPositions(coordinates)
+                context.setPositions(units.Quantity(self.replica_coordinates[replica_index], units.nanometers))
                 # Assign Maxwell-Boltzmann velocities.
                 context.setVelocitiesToTemperature(state.temperature)
                 # Run dynamics.
                 integrator.step(self.nsteps_per_iteration)
-                # Store final coordinates
-                openmm_state = context.getState(getPositions=True)
-                self.replica_coordinates[replica_index] = openmm_state.getPositions(asNumpy=True)
-                # Clean up.
-                del context
-                del integrator
+                # Store final coordinates, and potential energy if requested.
+                openmm_state = context.getState(getPositions=True, getEnergy=self._capture_potential_energies)
+                self.replica_coordinates[replica_index,:,:] = openmm_state.getPositions(asNumpy=True) / units.nanometers
+                if self._capture_potential_energies:
+                    self.replica_potential_energies[replica_index] = openmm_state.getPotentialEnergy() / units.kilojoules_per_mole
 
             end_time = time.time()
             elapsed_time = end_time - start_time
@@ -721,57 +1160,227 @@ class ReplicaExchange(object):
             # Parallel version
             print "Parallel _propagate_replicas: rank %d / %d" % (self.comm.rank, self.comm.size)
 
-            # Share state information with all replicas.
+            # Assign replicas to nodes.
+            old_owners = self.replica_owners.copy()
+            if (self.comm.rank == 0) and self.load_balancing:
+                self._schedule_replicas()
+
+            # Share state information and replica assignments with all replicas.
             if self.comm.rank == 0: print "Sharing state information..."
             start_time = time.time()
             if self.comm.rank != 0: self.replica_states = None
-            self.replica_states = self.comm.bcast(self.replica_states, root=0)
+            [self.replica_states, self.replica_owners] = self.comm.bcast([self.replica_states, self.replica_owners], root=0)
+            self.state_replicas[self.replica_states] = numpy.arange(self.nstates)
             end_time = time.time()
             if self.comm.rank == 0: print "Sharing state information: elapsed time %.3f s" % (end_time - start_time)
 
+            # Move resident coordinates of replicas that have been reassigned to another node.
+            if self.resident_coordinates:
+                self._migrate_coordinates(old_owners)
+
             # Run just this node's share of replicas.
             if self.comm.rank == 0: print "Running trajectories..."
             start_time = time.time()
-            for replica_index in range(self.comm.rank, self.nstates, self.comm.size):
+            replica_times = list() # replica_times[n] is (state_index, elapsed_time) for the nth replica propagated on this node
+            for replica_index in self._local_replicas():
                 print "node %d / %d : running replica %d / %d" % (self.comm.rank, self.comm.size, replica_index, self.nstates)
+                replica_start_time = time.time()
                 # Retrieve state.
                 state_index = self.replica_states[replica_index] # index of thermodynamic state that current replica is assigned to
                 state = self.states[state_index] # thermodynamic state
-                # Create integrator and context.
-                integrator = self.mm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
-                context = self.mm.Context(state.system, integrator, self.platform)                        
+                # Retrieve persistent context, updating integrator parameters in place.
+                [context, integrator] = self._context_cache.get_context(state.system, self.platform, parameters=state.parameters, temperature=state.temperature, collision_rate=self.collision_rate, timestep=self.timestep)
                 # Set coordinates.
-                coordinates = self.replica_coordinates[replica_index]            
-                context.setPositions(coordinates)
+                context.setPositions(units.Quantity(self.replica_coordinates[replica_index], units.nanometers))
                 # Assign Maxwell-Boltzmann velocities.
                 context.setVelocitiesToTemperature(state.temperature)
                 # Run dynamics.
                 integrator.step(self.nsteps_per_iteration)
-                # Store final coordinates
-                openmm_state = context.getState(getPositions=True)
-                self.replica_coordinates[replica_index] = openmm_state.getPositions(asNumpy=True)
-                # Clean up.
-                del context
-                del integrator
+                # Store final coordinates, and potential energy if requested.
+                openmm_state = context.getState(getPositions=True, getEnergy=self._capture_potential_energies)
+                self.replica_coordinates[replica_index,:,:] = openmm_state.getPositions(asNumpy=True) / units.nanometers
+                if self._capture_potential_energies:
+                    self.replica_potential_energies[replica_index] = openmm_state.getPotentialEnergy() / units.kilojoules_per_mole
+                replica_times.append((state_index, time.time() - replica_start_time))
             end_time = time.time()
-            self.comm.barrier()
+            # Collect timing information on the root node.
+            timings = self.comm.gather((end_time - start_time, replica_times), root=0)
             if self.comm.rank == 0: print "Running trajectories: elapsed time %.3f s" % (end_time - start_time)
+            if self.comm.rank == 0: self._update_state_costs(timings)
 
-            # Send configurations back to root node.
-            if self.comm.rank == 0: print "Synchronizing trajectories..."
-            start_time = time.time()
+            # If coordinates are resident on the nodes that propagate them, they are only collected when written to storage.
+            if self.resident_coordinates: return
 
-            data = list()
-            for index in range(self.comm.rank, self.nstates, self.comm.size):
-                data.append(self.replica_coordinates[index] / units.nanometers)
-            gather = self.comm.allgather(data)
-            for replica_index in range(self.nstates):
-                source = replica_index % self.comm.size # node with trajectory data
-                index = replica_index // self.comm.size # index within trajectory batch
-                self.replica_coordinates[replica_index] = units.Quantity(gather[source][index], units.nanometers)
+            # Send configurations back to all nodes.
+            self._share_coordinates()
 
-            end_time = time.time()
-            if self.comm.rank == 0: print "Synchronizing trajectories: elapsed time %.3f s" % (end_time - start_time)
+        return
+
+    def _share_coordinates(self):
+        """
+        Send the coordinates of each node's replicas to all nodes.
+
+        """
+
+        if self.comm.rank == 0: print "Synchronizing trajectories..."
+        start_time = time.time()
+
+        local_replicas = self._local_replicas()
+        gather = self.comm.allgather((local_replicas, self.replica_coordinates[local_replicas,:,:]))
+        for (replica_indices, x) in gather:
+            self.replica_coordinates[replica_indices,:,:] = x
+
+        end_time = time.time()
+        if self.comm.rank == 0: print "Synchronizing trajectories: elapsed time %.3f s" % (end_time - start_time)
+
+        return
+
+    def _local_replicas(self):
+        """
+        Return the indices of the replicas this node is responsible for.
+
+        RETURNS
+
+        replica_indices (numpy.array of int) - indices of replicas propagated and evaluated by this node (all replicas if not run in parallel)
+
+        """
+
+        if self.comm is None:
+            return numpy.arange(self.nstates)
+
+        return numpy.where(self.replica_owners == self.comm.rank)[0]
+
+    def _schedule_replicas(self):
+        """
+        Assign replicas to nodes so as to balance the expected propagation time of each node.
+
+        NOTES
+
+        Replicas are assigned in order of decreasing expected cost (longest-expected-first), each to the node with the
+        least expected load so far, with ties resolved in favor of the node that currently holds the replica so that
+        resident coordinates need not be moved.  The expected cost of a replica is the running estimate of the propagation
+        time of the state it is assigned to; states that have not yet been timed are assumed to have the mean cost.
+
+        """
+
+        # Determine expected cost of each replica.
+        costs = self.state_costs[self.replica_states]
+        measured = numpy.logical_not(numpy.isnan(costs))
+        if measured.any():
+            costs[numpy.logical_not(measured)] = costs[measured].mean()
+        else:
+            costs[:] = 1.0
+
+        # Assign most expensive replicas first, each to the least loaded node.
+        loads = numpy.zeros([self.comm.size], numpy.float64)
+        replica_owners = numpy.zeros([self.nstates], numpy.int32)
+        for replica_index in numpy.argsort(-costs, kind='mergesort'):
+            rank = numpy.argmin(loads)
+            current_rank = self.replica_owners[replica_index]
+            if loads[current_rank] <= loads[rank]: rank = current_rank
+            replica_owners[replica_index] = rank
+            loads[rank] += costs[replica_index]
+        self.replica_owners = replica_owners
+
+        return
+
+    def _update_state_costs(self, timings):
+        """
+        Update running estimates of per-state propagation cost and report node utilization.
+
+        ARGUMENTS
+
+        timings (list) - timings[rank] is (busy_time, replica_times) for each node, where replica_times is a list of (state_index, elapsed_time)
+
+        """
+
+        # Update exponentially-weighted running estimates of propagation time for each state.
+        smoothing = 0.5 # weight given to most recent measurement
+        for (busy_time, replica_times) in timings:
+            for (state_index, elapsed_time) in replica_times:
+                if numpy.isnan(self.state_costs[state_index]):
+                    self.state_costs[state_index] = elapsed_time
+                else:
+                    self.state_costs[state_index] = (1.0 - smoothing) * self.state_costs[state_index] + smoothing * elapsed_time
+
+        # Report utilization of each node, relative to the slowest node.
+        busy_times = numpy.array([ busy_time for (busy_time, replica_times) in timings ], numpy.float64)
+        utilization = busy_times / busy_times.max()
+        if self.verbose:
+            print "Node utilization: mean %.1f %%, min %.1f %%" % (utilization.mean() * 100.0, utilization.min() * 100.0)
+            for rank in range(self.comm.size):
+                print "node %4d : %3d replicas, busy %8.3f s, utilization %5.1f %%" % (rank, len(timings[rank][1]), busy_times[rank], utilization[rank] * 100.0)
+
+        return
+
+    def _migrate_coordinates(self, old_owners):
+        """
+        Send resident coordinates of replicas that have been assigned to a different node to their new node.
+
+        ARGUMENTS
+
+        old_owners (numpy.array of int) - old_owners[i] is the rank of the node that held replica i before reassignment
+
+        """
+
+        # Determine which of this node's replicas have been reassigned.
+        outgoing = list()
+        for rank in range(self.comm.size):
+            replica_indices = numpy.where((old_owners == self.comm.rank) & (self.replica_owners == rank) & (rank != self.comm.rank))[0]
+            outgoing.append((replica_indices, self.replica_coordinates[replica_indices,:,:]))
+
+        # Exchange coordinates with all other nodes.
+        incoming = self.comm.alltoall(outgoing)
+        for (replica_indices, x) in incoming:
+            self.replica_coordinates[replica_indices,:,:] = x
+
+        return
+
+    def _gather_coordinates(self):
+        """
+        Collect coordinates of all replicas onto the root node.
+
+        NOTES
+
+        This is only needed when coordinates are resident on the nodes that propagate them (see 'resident_coordinates').
+
+        """
+
+        if self.comm.rank == 0: print "Collecting coordinates on root node..."
+        start_time = time.time()
+
+        local_replicas = self._local_replicas()
+        gather = self.comm.gather((local_replicas, self.replica_coordinates[local_replicas,:,:]), root=0)
+        if self.comm.rank == 0:
+            for (replica_indices, x) in gather:
+                self.replica_coordinates[replica_indices,:,:] = x
+
+        end_time = time.time()
+        if self.comm.rank == 0: print "Collecting coordinates on root node: elapsed time %.3f s" % (end_time - start_time)
+
+        return
+
+    def _gather_energies(self, replica_indices):
+        """
+        Collect rows of the energy matrix computed on each node onto the root node.
+
+        ARGUMENTS
+
+        replica_indices (numpy.array of int) - indices of replicas whose rows of u_kl were computed on this node
+
+        NOTES
+
+        Only the root node, which mixes replicas and writes to storage, receives the complete energy matrix.
+
+        """
+
+        if self.comm is None:
+            return
+
+        gather = self.comm.gather((replica_indices, self.u_kl[replica_indices,:]), root=0)
+        if self.comm.rank == 0:
+            for (indices, rows) in gather:
+                self.u_kl[indices,:] = rows
 
         return
 
@@ -779,6 +1388,12 @@ class ReplicaExchange(object):
         """
         Minimize and equilibrate all replicas.
 
+        NOTES
+
+        In parallel runs, each node minimizes and equilibrates only its own replicas.  Unless coordinates are resident on the
+        nodes that propagate them, the resulting coordinates are then shared with all nodes, so that the stored positions
+        match the energies computed from them.
+
         TODO
 
         * Allow NPT dynamics during equilibration, for constant-pressure states.
@@ -788,53 +1403,48 @@ class ReplicaExchange(object):
         # Minimize
         if self.minimize:
             if self.verbose: print "Minimizing all replicas..."
-            for replica_index in range(self.nstates):
+            for replica_index in self._local_replicas():
                 # Retrieve thermodynamic state.
                 state_index = self.replica_states[replica_index] # index of thermodynamic state that current replica is assigned to
                 state = self.states[state_index] # thermodynamic state
-                # Retrieve coordinates.
-                coordinates = self.replica_coordinates[replica_index]
-                # Create integrator and context.
-                integrator = self.mm.VerletIntegrator(self.equilibration_timestep)
-                context = self.mm.Context(state.system, integrator, self.platform)                        
+                # Retrieve persistent context.
+                [context, integrator] = self._context_cache.get_context(state.system, self.platform, parameters=state.parameters)
                 # Set coordinates.
-                coordinates = self.replica_coordinates[replica_index]            
-                context.setPositions(coordinates)
+                context.setPositions(units.Quantity(self.replica_coordinates[replica_index], units.nanometers))
                 # Minimize.
                 tolerance = 1.0 * units.kilocalories_per_mole / units.nanometer
                 maximum_evaluations = 1000
-                openmm.LocalEnergyMinimizer.minimize(context, tolerance, maximum_evaluations)
+                self.mm.LocalEnergyMinimizer.minimize(context, tolerance, maximum_evaluations)
                 # Store final coordinates
                 openmm_state = context.getState(getPositions=True)
-                self.replica_coordinates[replica_index] = openmm_state.getPositions(asNumpy=True)
-                # Clean up.
-                del context
-                del integrator
+                self.replica_coordinates[replica_index,:,:] = openmm_state.getPositions(asNumpy=True) / units.nanometers
 
         # Equilibrate    
         for iteration in range(self.number_of_equilibration_iterations):
             if self.verbose: print "equilibration iteration %d / %d" % (iteration, self.number_of_equilibration_iterations)
-            for replica_index in range(self.nstates):
+            for replica_index in self._local_replicas():
                 if self.verbose: print "replica %d / %d" % (replica_index, self.nstates)
                 # Retrieve thermodynamic state.
                 state_index = self.replica_states[replica_index] # index of thermodynamic state that current replica is assigned to
                 state = self.states[state_index] # thermodynamic state
-                # Create integrator and context.
-                integrator = self.mm.LangevinIntegrator(state.temperature, self.collision_rate, self.equilibration_timestep)
-                context = self.mm.Context(state.system, integrator, self.platform)                        
+                # Retrieve persistent context, updating integrator parameters in place.
+                [context, integrator] = self._context_cache.get_context(state.system, self.platform, parameters=state.parameters, temperature=state.temperature, collision_rate=self.collision_rate, timestep=self.equilibration_timestep)
                 # Set coordinates.
-                coordinates = self.replica_coordinates[replica_index]            
-                context.setPositions(coordinates)
+                context.setPositions(units.Quantity(self.replica_coordinates[replica_index], units.nanometers))
                 # Assign Maxwell-Boltzmann velocities.
                 context.setVelocitiesToTemperature(state.temperature)
                 # Run dynamics.
                 integrator.step(self.nsteps_per_iteration)
                 # Store final coordinates
                 openmm_state = context.getState(getPositions=True)
-                self.replica_coordinates[replica_index] = openmm_state.getPositions(asNumpy=True)
-                # Clean up.
-                del context
-                del integrator
+                self.replica_coordinates[replica_index,:,:] = openmm_state.getPositions(asNumpy=True) / units.nanometers
+
+        # Potential energies captured during propagation no longer correspond to the replica coordinates.
+        self.replica_potential_energies[:] = numpy.nan
+
+        # Share equilibrated coordinates with all nodes.
+        if (self.comm is not None) and not self.resident_coordinates:
+            self._share_coordinates()
 
         return
 
@@ -842,24 +1452,152 @@ class ReplicaExchange(object):
         """
         Compute energies of all replicas at all states.
 
+        NOTES
+
+        Unless this is an iteration on which the full energy matrix is requested (see 'full_energy_interval'), only the
+        entries that will be read by the replica mixing scheme are computed, and all other entries are set to NaN.
+
+        In parallel runs, each node computes the rows of the energy matrix for the replicas it propagated, and only these
+        rows are sent to the root node.
+
         TODO
 
         * We have to re-order Context initialization if we have variable box volume
-        * Parallel implementation
         
         """
 
         start_time = time.time()
         
+        # Determine which energies need to be computed.
+        required = None
+        if (self.full_energy_interval is not None) and (self.iteration % self.full_energy_interval != 0):
+            required = self._required_energies()
+
+        # Determine which replicas this node computes energies for.
+        local_replicas = self._local_replicas()
+
         if self.verbose: print "Computing energies..."
-        for state_index in range(self.nstates):
-            for replica_index in range(self.nstates):
-                self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_coordinates[replica_index], platform=self.energy_platform)
-                
+        if required is None:
+            nenergies = self.nstates**2
+            coordinates_list = [ units.Quantity(self.replica_coordinates[replica_index], units.nanometers) for replica_index in local_replicas ]
+            for state_index in range(self.nstates):
+                # Evaluate all local replicas at this state, filling one column of u_kl.
+                self.u_kl[local_replicas,state_index] = self.states[state_index].reduced_potentials(coordinates_list, platform=self.energy_platform)
+        else:
+            nenergies = required.sum()
+            self.u_kl[local_replicas,:] = numpy.nan
+            for state_index in range(self.nstates):
+                # Evaluate only the local replicas whose energy at this state is required.
+                replica_indices = local_replicas[required[local_replicas,state_index]]
+                if len(replica_indices) == 0: continue
+                coordinates_list = [ units.Quantity(self.replica_coordinates[replica_index], units.nanometers) for replica_index in replica_indices ]
+                self.u_kl[replica_indices,state_index] = self.states[state_index].reduced_potentials(coordinates_list, platform=self.energy_platform)
+
+        # Collect energy matrix on root node.
+        self._gather_energies(local_replicas)
+
         end_time = time.time()
         elapsed_time = end_time - start_time
-        time_per_energy= elapsed_time / float(self.nstates)**2 
-        if self.verbose: print "Time to compute all energies %.3f s (%.3f per energy calculation).\n" % (elapsed_time, time_per_energy)
+        time_per_energy= elapsed_time / float(nenergies)
+        if self.verbose: print "Time to compute %d energies %.3f s (%.3f per energy calculation).\n" % (nenergies, elapsed_time, time_per_energy)
+
+        return
+
+    def _required_energies(self):
+        """
+        Determine which entries of the energy matrix will be read by the replica mixing scheme.
+
+        RETURNS
+
+        required (numpy.array of bool, or None) - required[i,j] is True if the reduced potential of replica i at state j
+           will be read by the next mixing step, or None if all entries are needed
+
+        NOTES
+
+        For 'swap-neighbors', each replica needs only its own state and the two states adjacent to it, so roughly 3N
+        energies are required instead of N^2.  For 'gibbs-blocks', a replica can move up to b-1 states in each of the two
+        sweeps, so states within 2(b-1) of its own are required.  All other schemes require the full matrix.
+
+        """
+
+        if self.replica_mixing_scheme in ['swap-neighbors', 'gibbs-blocks']:
+            if self.replica_mixing_scheme == 'swap-neighbors':
+                max_offset = 1
+            else:
+                max_offset = 2 * (self.mixing_block_size - 1)
+            required = numpy.zeros([self.nstates, self.nstates], numpy.bool_)
+            replica_indices = numpy.arange(self.nstates)
+            for offset in range(-max_offset, max_offset+1):
+                state_indices = self.replica_states + offset
+                valid = (state_indices >= 0) & (state_indices < self.nstates)
+                required[replica_indices[valid], state_indices[valid]] = True
+            return required
+
+        return None
+
+    def _attempt_swaps(self, istates, jstates, u_kl, uniforms=None):
+        """
+        Attempt simultaneous Metropolis swaps between disjoint pairs of states.
+
+        ARGUMENTS
+
+        istates (numpy int array) - first state of each pair
+        jstates (numpy int array) - second state of each pair
+        u_kl (numpy float64 array) - u_kl[replica,state] is the reduced potential of the configuration of replica in state
+
+        OPTIONAL ARGUMENTS
+
+        uniforms (numpy float64 array) - uniform random numbers on [0,1) to use for acceptance, one per pair (default: drawn here)
+
+        RETURNS
+
+        proposed (numpy bool array) - proposed[k] is True if pair k was proposed (swaps involving NaN energies are not)
+        accepted (numpy bool array) - accepted[k] is True if the swap of pair k was accepted
+
+        NOTES
+
+        No state may appear more than once in istates and jstates combined.  Swaps of disjoint pairs commute, so attempting
+        them all at once is equivalent to attempting them one after another.  Both replica_states and state_replicas are updated.
+
+        """
+
+        # Determine which replicas these states correspond to.
+        i = self.state_replicas[istates]
+        j = self.state_replicas[jstates]
+
+        # Compute log probability of swap, rejecting swap attempts if any energies are nan.
+        log_P_accept = - (u_kl[i,jstates] + u_kl[j,istates]) + (u_kl[i,istates] + u_kl[j,jstates])
+        proposed = ~numpy.isnan(log_P_accept)
+        log_P_accept[~proposed] = -numpy.inf
+
+        # Accept or reject.
+        if uniforms is None:
+            uniforms = numpy.random.rand(len(istates))
+        accepted = (uniforms < numpy.exp(numpy.minimum(log_P_accept, 0.0)))
+
+        # Swap states in accepted replica slots.
+        (i, j, istates, jstates) = (i[accepted], j[accepted], istates[accepted], jstates[accepted])
+        self.replica_states[i] = jstates
+        self.replica_states[j] = istates
+        self.state_replicas[istates] = j
+        self.state_replicas[jstates] = i
+
+        return (proposed, accepted)
+
+    def _record_swaps(self, istates, jstates, proposed, accepted):
+        """
+        Accumulate statistics of proposed and accepted swaps into Nij_proposed and Nij_accepted.
+
+        ARGUMENTS
+
+        istates, jstates (numpy int arrays) - states of each pair for which a swap was attempted
+        proposed, accepted (numpy bool arrays) - whether each swap was proposed and accepted, as returned by _attempt_swaps()
+
+        """
+
+        for (Nij, mask) in [(self.Nij_proposed, proposed), (self.Nij_accepted, accepted)]:
+            numpy.add.at(Nij, (istates[mask], jstates[mask]), 1)
+            numpy.add.at(Nij, (jstates[mask], istates[mask]), 1)
 
         return
 
@@ -867,6 +1605,12 @@ class ReplicaExchange(object):
         """
         Attempt exchanges between all replicas to enhance mixing.
 
+        NOTES
+
+        Swaps are attempted in rounds.  Each round pairs up all states by a random permutation and attempts the resulting
+        disjoint swaps at once with _attempt_swaps(), so every attempt is a Metropolis swap between a uniformly chosen pair
+        of states, as if attempted one at a time.  Random permutations and uniforms are drawn in bulk for blocks of rounds.
+
         TODO
 
         * Adjust nswap_attempts based on how many we can afford to do and not have mixing take a substantial fraction of iteration time.
@@ -875,115 +1619,303 @@ class ReplicaExchange(object):
 
         # Determine number of swaps to attempt to ensure thorough mixing.
         # TODO: Replace this with analytical result computed to guarantee sufficient mixing.
-        nswap_attempts = self.nstates**5 # number of swaps to attempt (ideal, but too slow!)
-        nswap_attempts = self.nstates**3 # best compromise for pure Python?
+        nswap_attempts = self.nstates**3 # number of swaps to attempt
+        npairs = self.nstates / 2 # number of disjoint pairs attempted per round
+        if npairs == 0:
+            return
+        nrounds = (nswap_attempts + npairs - 1) / npairs # number of rounds of swap attempts
         
-        if self.verbose: print "Will attempt to swap all pairs of replicas, using a total of %d attempts." % nswap_attempts
+        if self.verbose: print "Will attempt to swap all pairs of replicas, using a total of %d attempts." % (nrounds * npairs)
 
-        # Attempt swaps to mix replicas.
-        for swap_attempt in range(nswap_attempts):
-            # Choose replicas to attempt to swap.
-            i = numpy.random.randint(self.nstates) # Choose replica i uniformly from set of replicas.
-            j = numpy.random.randint(self.nstates) # Choose replica j uniformly from set of replicas.
+        # Stage energies.
+        u_kl = numpy.array(self.u_kl, numpy.float64)
 
-            # Determine which states these resplicas correspond to.
-            istate = self.replica_states[i] # state in replica slot i
-            jstate = self.replica_states[j] # state in replica slot j
+        # Attempt swaps to mix replicas, drawing random numbers for blocks of rounds at a time to bound memory use.
+        start_time = time.time()
+        nrounds_per_block = max(1, 2**20 / self.nstates)
+        for first_round in range(0, nrounds, nrounds_per_block):
+            nblock = min(nrounds_per_block, nrounds - first_round)
 
-            # Reject swap attempt if any energies are nan.
-            if (numpy.isnan(self.u_kl[i,jstate]) or numpy.isnan(self.u_kl[j,istate]) or numpy.isnan(self.u_kl[i,istate]) or numpy.isnan(self.u_kl[j,jstate])):
-                continue
+            # Choose pairs of states to attempt to swap from random permutations of all states.
+            pairings = numpy.argsort(numpy.random.rand(nblock, self.nstates), axis=1)
+            istates = pairings[:,0:2*npairs:2]
+            jstates = pairings[:,1:2*npairs:2]
+            uniforms = numpy.random.rand(nblock, npairs)
 
-            # Compute log probability of swap.
-            log_P_accept = - (self.u_kl[i,jstate] + self.u_kl[j,istate]) + (self.u_kl[i,istate] + self.u_kl[j,jstate])
+            # Attempt swaps.
+            proposed = numpy.zeros([nblock, npairs], numpy.bool_)
+            accepted = numpy.zeros([nblock, npairs], numpy.bool_)
+            for round_index in range(nblock):
+                (proposed[round_index,:], accepted[round_index,:]) = self._attempt_swaps(istates[round_index,:], jstates[round_index,:], u_kl, uniforms[round_index,:])
 
-            #print "replica (%3d,%3d) states (%3d,%3d) energies (%8.1f,%8.1f) %8.1f -> (%8.1f,%8.1f) %8.1f : log_P_accept %8.1f" % (i,j,istate,jstate,self.u_kl[i,istate],self.u_kl[j,jstate],self.u_kl[i,istate]+self.u_kl[j,jstate],self.u_kl[i,jstate],self.u_kl[j,istate],self.u_kl[i,jstate]+self.u_kl[j,istate],log_P_accept)
+            # Accumulate statistics.
+            self._record_swaps(istates, jstates, proposed, accepted)
+        elapsed_time = time.time() - start_time
 
-            # Record that this move has been proposed.
-            self.Nij_proposed[istate,jstate] += 1
-            self.Nij_proposed[jstate,istate] += 1
+        if self.verbose: print "%d swap attempts in %.3f s (%.0f attempts/s)" % (nrounds * npairs, elapsed_time, (nrounds * npairs) / max(elapsed_time, 1.0e-6))
 
-            # Accept or reject.
-            if (log_P_accept >= 0.0 or (numpy.random.rand() < math.exp(log_P_accept))):
-                # Swap states in replica slots i and j.
-                (self.replica_states[i], self.replica_states[j]) = (self.replica_states[j], self.replica_states[i])
-                # Accumulate statistics
-                self.Nij_accepted[istate,jstate] += 1
-                self.Nij_accepted[jstate,istate] += 1
+        return
+
+    def _build_candidate_pairs(self, u_kl):
+        """
+        Build the symmetric set of candidate state pairs for 'swap-candidates' mixing from the current energies.
+
+        ARGUMENTS
+
+        u_kl (numpy float64 array) - u_kl[replica,state] is the reduced potential of the configuration of replica in state, with no NaN entries
+
+        RETURNS
+
+        istates, jstates (numpy int arrays) - candidate pairs, with istates[k] < jstates[k]
+
+        NOTES
+
+        Each state lists the 'candidate_list_size' other states (default: about log2 of the number of states) with the best
+        estimated phase-space overlap, plus its two neighbors in state index so that the candidate graph stays connected.  A
+        pair is a candidate if either state lists the other.
+
+        Overlap between states k and l is ranked by the variance of u_l(x) - u_k(x) over all current configurations, which is
+        small when swaps between k and l are likely to be accepted.  This depends only on the set of rows of u_kl, and not on
+        which replica holds which state, so the candidate pairs do not depend on the current state assignment.
+
+        To avoid forming all N^2 pairwise variances for N states, each state is only compared with the 2m states nearest in
+        state index and m further states drawn at random, where m is the number of candidates per state.  The random draws do
+        not depend on the state assignment either.  A rebuild therefore costs O(N^2 m) operations, proportional to the size of
+        u_kl, and O(N m) memory beyond u_kl itself.
+
+        """
+
+        # Determine number of candidates per state.
+        ncandidates = self.candidate_list_size
+        if ncandidates is None:
+            ncandidates = int(math.ceil(math.log(self.nstates, 2)))
+        ncandidates = max(1, min(ncandidates, self.nstates - 1))
+
+        # Choose the partners each state is compared with: a window of neighbors in state index, and random states.
+        states = numpy.arange(self.nstates)
+        offsets = numpy.concatenate([numpy.arange(-ncandidates, 0), numpy.arange(1, ncandidates+1)])
+        partners = states[:,numpy.newaxis] + offsets[numpy.newaxis,:]
+        partners[(partners < 0) | (partners >= self.nstates)] = -1
+        partners = numpy.concatenate([partners, numpy.random.randint(0, self.nstates, size=[self.nstates, ncandidates])], axis=1)
+        partners[partners == states[:,numpy.newaxis]] = -1
+        partners.sort(axis=1)
+        partners[:,1:][partners[:,1:] == partners[:,:-1]] = -1
+
+        # Compute variances of reduced potential differences to each partner over all configurations, one column of partners at a time.
+        du_kl = u_kl - u_kl.mean(0)[numpy.newaxis,:]
+        difference_variance = numpy.inf * numpy.ones(partners.shape, numpy.float64)
+        for column in range(partners.shape[1]):
+            valid = (partners[:,column] >= 0)
+            difference = du_kl[:,partners[valid,column]] - du_kl[:,valid]
+            difference_variance[valid,column] = (difference**2).mean(0)
+
+        # Select partners of each state with the best overlap, and neighbors in state index.
+        selected = numpy.argpartition(difference_variance, ncandidates-1, axis=1)[:,0:ncandidates]
+        candidates = partners[states[:,numpy.newaxis],selected]
+        istates = numpy.concatenate([numpy.repeat(states, ncandidates), states[0:-1]])
+        jstates = numpy.concatenate([candidates.ravel(), states[1:]])
+        keep = (jstates >= 0)
+        (istates, jstates) = (istates[keep], jstates[keep])
+
+        # Symmetrize, and remove duplicate pairs.
+        keys = numpy.unique(numpy.minimum(istates, jstates) * self.nstates + numpy.maximum(istates, jstates))
+        (istates, jstates) = (keys // self.nstates, keys % self.nstates)
+
+        return (istates, jstates)
+
+    def _mix_candidate_replicas(self):
+        """
+        Attempt exchanges between pairs of states drawn from sparse candidate lists of likely swap partners.
+
+        NOTES
+
+        The candidate pairs are rebuilt by _build_candidate_pairs() every 'candidate_list_interval' iterations and are fixed in
+        between.  They are only rebuilt when the full energy matrix is available, and until then neighboring states are used.
+        Each round picks a random set of disjoint candidate pairs (a pair is picked if its random priority is the lowest of all
+        candidate pairs touching either of its states) and attempts those swaps with _attempt_swaps().
+
+        Neither the candidate pairs nor the pairs picked depend on which replicas hold which states.  The proposal is therefore
+        symmetric in the state assignment, including on iterations when the candidates are rebuilt, and Metropolis acceptance
+        preserves detailed balance.
+
+        About four swaps are attempted per candidate pair, so mixing itself costs O(N log N) for N states.  Each rebuild of the
+        candidate pairs costs O(N^2 log N), proportional to the size of the energy matrix, amortized over 'candidate_list_interval'
+        iterations.
+
+        """
+
+        if self.nstates < 2:
+            return
+
+        # Stage energies.
+        u_kl = numpy.array(self.u_kl, numpy.float64)
+
+        # Refresh candidate pairs periodically, from full energy matrices only, since which entries are computed otherwise depends on the state assignment.
+        if (self._candidate_pairs is None) or (self.iteration - self._candidate_pairs_iteration >= self.candidate_list_interval):
+            if not numpy.isnan(u_kl).any():
+                self._candidate_pairs = self._build_candidate_pairs(u_kl)
+                self._candidate_pairs_iteration = self.iteration
+        if self._candidate_pairs is not None:
+            (istates, jstates) = self._candidate_pairs
+        else:
+            (istates, jstates) = (numpy.arange(self.nstates-1), numpy.arange(1, self.nstates))
+        npairs = len(istates)
+
+        # Determine number of swaps to attempt.
+        nswap_attempts = 4 * npairs
+
+        if self.verbose: print "Will attempt to swap %d candidate pairs of states, using a total of %d attempts." % (npairs, nswap_attempts)
+
+        # Attempt swaps, drawing random priorities for blocks of rounds at a time to bound memory use.
+        start_time = time.time()
+        nattempted = 0
+        nrounds_per_block = max(1, min(64, 2**20 / npairs))
+        while nattempted < nswap_attempts:
+            # Pick disjoint pairs in each round: a pair is picked if its priority is the lowest of any pair touching either of its states.
+            priorities = numpy.random.rand(nrounds_per_block, npairs)
+            round_offsets = (self.nstates * numpy.arange(nrounds_per_block))[:,numpy.newaxis]
+            state_priorities = 2.0 * numpy.ones([nrounds_per_block * self.nstates], numpy.float64)
+            numpy.minimum.at(state_priorities, (round_offsets + istates).ravel(), priorities.ravel())
+            numpy.minimum.at(state_priorities, (round_offsets + jstates).ravel(), priorities.ravel())
+            state_priorities = state_priorities.reshape([nrounds_per_block, self.nstates])
+            picked = (priorities == state_priorities[:,istates]) & (priorities == state_priorities[:,jstates])
+
+            for round_index in range(nrounds_per_block):
+                if nattempted >= nswap_attempts:
+                    break
+                (round_istates, round_jstates) = (istates[picked[round_index,:]], jstates[picked[round_index,:]])
+                (proposed, accepted) = self._attempt_swaps(round_istates, round_jstates, u_kl)
+                self._record_swaps(round_istates, round_jstates, proposed, accepted)
+                nattempted += len(round_istates)
+        elapsed_time = time.time() - start_time
+
+        if self.verbose: print "%d swap attempts in %.3f s (%.0f attempts/s)" % (nattempted, elapsed_time, nattempted / max(elapsed_time, 1.0e-6))
 
         return
 
-    def _mix_all_replicas_weave(self):
+    def _mix_replica_blocks(self):
         """
-        Attempt exchanges between all replicas to enhance mixing.
-        Acceleration by 'weave' from scipy is used to speed up mixing by ~ 400x.
-        
+        Sample exactly from the distribution of state permutations within blocks of neighboring states (block Gibbs sampling).
+
+        NOTES
+
+        States are partitioned into contiguous blocks of up to 'mixing_block_size' states.  Within each block, all b!
+        assignments of the block's replicas to the block's states are enumerated and one is drawn from its exact Boltzmann
+        probability using log-sum-exp.  Two sweeps are made per call, the second with blocks offset by half a block, so that
+        replicas can cross block boundaries.
+
         """
 
-        # Determine number of swaps to attempt to ensure thorough mixing.
-        # TODO: Replace this with analytical result computed to guarantee sufficient mixing.
-        nswap_attempts = self.nstates**3 # number of swaps to attempt (ideal, but too slow!)
-        # Handled in C code below.
-        
-        if self.verbose: print "Will attempt to swap all pairs of replicas using weave-accelerated code, using a total of %d attempts." % nswap_attempts
-
-        from scipy import weave
-
-        # TODO: Replace drand48 with numpy random generator.
-        code = """
-        // Determine number of swap attempts.
-        // TODO: Replace this with analytical result computed to guarantee sufficient mixing.        
-        long nswap_attempts = nstates*nstates*nstates; 
-
-        // Attempt swaps.
-        for(long swap_attempt = 0; swap_attempt < nswap_attempts; swap_attempt++) {
-            // Choose replicas to attempt to swap.
-            int i = (long)(drand48() * nstates); 
-            int j = (long)(drand48() * nstates);
-
-            // Determine which states these resplicas correspond to.            
-            int istate = REPLICA_STATES1(i); // state in replica slot i
-            int jstate = REPLICA_STATES1(j); // state in replica slot j
-
-            // Reject swap attempt if any energies are nan.
-            if ((std::isnan(U_KL2(i,jstate)) || std::isnan(U_KL2(j,istate)) || std::isnan(U_KL2(i,istate)) || std::isnan(U_KL2(j,jstate))))
-               continue;
-
-            // Compute log probability of swap.
-            double log_P_accept = - (U_KL2(i,jstate) + U_KL2(j,istate)) + (U_KL2(i,istate) + U_KL2(j,jstate));
-
-            // Record that this move has been proposed.
-            NIJ_PROPOSED2(istate,jstate) += 1;
-            NIJ_PROPOSED2(jstate,istate) += 1;
-
-            // Accept or reject.
-            if (log_P_accept >= 0.0 || (drand48() < exp(log_P_accept))) {
-                // Swap states in replica slots i and j.
-                int tmp = REPLICA_STATES1(i);
-                REPLICA_STATES1(i) = REPLICA_STATES1(j);
-                REPLICA_STATES1(j) = tmp;
-                // Accumulate statistics
-                NIJ_ACCEPTED2(istate,jstate) += 1;
-                NIJ_ACCEPTED2(jstate,istate) += 1;
-            }
-
-        }
-        """
-
-        # Stage input temporarily.
-        nstates = self.nstates
-        replica_states = self.replica_states
-        u_kl = self.u_kl
-        Nij_proposed = self.Nij_proposed
-        Nij_accepted = self.Nij_accepted
-
-        # Execute inline C code with weave.
-        info = weave.inline(code, ['nstates', 'replica_states', 'u_kl', 'Nij_proposed', 'Nij_accepted'], headers=['<math.h>', '<stdlib.h>'], verbose=2)
-
-        # Store results.
-        self.replica_states = replica_states
-        self.Nij_proposed = Nij_proposed
-        self.Nij_accepted = Nij_accepted
+        block_size = self.mixing_block_size
+        if (block_size < 2) or (block_size > 8):
+            raise ParameterException("'mixing_block_size' must be between 2 and 8 (got %d)." % block_size)
+
+        if self.verbose: print "Will sample state permutations exactly within blocks of %d states." % block_size
+
+        # Stage energies.
+        u_kl = numpy.array(self.u_kl, numpy.float64)
+
+        for offset in [0, block_size / 2]:
+            # Partition states into blocks; the first and last blocks may be smaller.
+            boundaries = [0] + range(offset if offset > 0 else block_size, self.nstates, block_size) + [self.nstates]
+            for (first_state, last_state) in zip(boundaries[:-1], boundaries[1:]):
+                nblock = last_state - first_state
+                if nblock < 2:
+                    continue
+
+                # Enumerate all permutations of this block size, reusing them for later blocks.
+                if nblock not in self._block_permutations:
+                    self._block_permutations[nblock] = numpy.array(list(itertools.permutations(range(nblock))), numpy.int32)
+                permutations = self._block_permutations[nblock]
+
+                # Compute log weight of each assignment of the block's replicas to the block's states.
+                states = numpy.arange(first_state, last_state)
+                replicas = self.state_replicas[states]
+                u_block = u_kl[numpy.ix_(replicas, states)] # u_block[k,l] is the reduced potential of replica k of the block in state l of the block
+                log_weights = - u_block[numpy.arange(nblock), permutations].sum(1)
+                log_weights[numpy.isnan(log_weights)] = -numpy.inf
+                if not numpy.isfinite(log_weights.max()):
+                    continue
+
+                # Draw a permutation from its exact probability.
+                weights = numpy.exp(log_weights - log_weights.max())
+                cumulative_weights = numpy.cumsum(weights)
+                index = numpy.searchsorted(cumulative_weights, numpy.random.rand() * cumulative_weights[-1], side='right')
+                new_states = states[permutations[min(index, len(permutations)-1),:]]
+
+                # Accumulate statistics, counting each replica's move from its old to its new state.
+                moved = (new_states != states)
+                numpy.add.at(self.Nij_proposed, (states, new_states), 1)
+                numpy.add.at(self.Nij_accepted, (states[moved], new_states[moved]), 1)
+
+                # Assign states to replicas.
+                self.replica_states[replicas] = new_states
+                self.state_replicas[new_states] = replicas
+
+        return
+
+    def _color_state_graph(self):
+        """
+        Partition the edges of the state adjacency graph into classes of disjoint state pairs by greedy edge coloring.
+
+        RETURNS
+
+        color_classes (list of tuples of numpy int arrays) - (istates, jstates) of the edges of each color; no state appears
+           more than once within a color
+
+        """
+
+        (indptr, indices) = self.state_graph
+        if len(indptr) != self.nstates + 1:
+            raise ParameterException("'state_graph' has %d rows, but there are %d states." % (len(indptr) - 1, self.nstates))
+
+        # Extract each undirected edge once.
+        rows = numpy.repeat(numpy.arange(self.nstates), numpy.diff(indptr))
+        upper = (rows < indices)
+        (istates, jstates) = (rows[upper], numpy.array(indices)[upper])
+
+        # Assign each edge the lowest color not yet used by an edge touching either of its states.
+        state_colors = [ set() for state in range(self.nstates) ]
+        colors = numpy.zeros([len(istates)], numpy.int32)
+        for (edge, (istate, jstate)) in enumerate(zip(istates, jstates)):
+            color = 0
+            while (color in state_colors[istate]) or (color in state_colors[jstate]):
+                color += 1
+            colors[edge] = color
+            state_colors[istate].add(color)
+            state_colors[jstate].add(color)
+
+        color_classes = [ (istates[colors == color], jstates[colors == color]) for color in range(colors.max() + 1) ] if len(colors) > 0 else []
+
+        return color_classes
+
+    def _mix_graph_replicas(self):
+        """
+        Attempt exchanges between states adjacent in the state graph.
+
+        NOTES
+
+        The edges of 'state_graph' are colored once so that edges of the same color share no state.  Each call visits all
+        color classes in random order and attempts all swaps of a class at once with _attempt_swaps(), so every edge is
+        attempted once per iteration.  If 'state_graph' is None, a chain of states is used, as for 'swap-neighbors'.
+
+        """
+
+        if self.state_graph is None:
+            self.state_graph = state_graph_from_edges(self.nstates, numpy.arange(self.nstates-1), numpy.arange(1,self.nstates))
+        if self._state_graph_colors is None:
+            self._state_graph_colors = self._color_state_graph()
+
+        if self.verbose: print "Will attempt to swap replicas along %d edges of the state graph in %d color classes." % (sum([ len(istates) for (istates, jstates) in self._state_graph_colors ]), len(self._state_graph_colors))
+
+        # Stage energies.
+        u_kl = numpy.array(self.u_kl, numpy.float64)
+
+        # Attempt swaps for each color class in random order.
+        for color in numpy.random.permutation(len(self._state_graph_colors)):
+            (istates, jstates) = self._state_graph_colors[color]
+            (proposed, accepted) = self._attempt_swaps(istates, jstates, u_kl)
+            self._record_swaps(istates, jstates, proposed, accepted)
 
         return
 
@@ -1001,11 +1933,8 @@ class ReplicaExchange(object):
             jstate = istate + 1 # second state to attempt to swap with i
 
             # Determine which replicas these states correspond to.
-            i = None
-            j = None
-            for index in range(self.nstates):
-                if self.replica_states[index] == istate: i = index
-                if self.replica_states[index] == jstate: j = index                
+            i = self.state_replicas[istate]
+            j = self.state_replicas[jstate]
 
             # Reject swap attempt if any energies are nan.
             if (numpy.isnan(self.u_kl[i,jstate]) or numpy.isnan(self.u_kl[j,istate]) or numpy.isnan(self.u_kl[i,istate]) or numpy.isnan(self.u_kl[j,jstate])):
@@ -1024,6 +1953,7 @@ class ReplicaExchange(object):
             if (log_P_accept >= 0.0 or (numpy.random.rand() < math.exp(log_P_accept))):
                 # Swap states in replica slots i and j.
                 (self.replica_states[i], self.replica_states[j]) = (self.replica_states[j], self.replica_states[i])
+                (self.state_replicas[istate], self.state_replicas[jstate]) = (j, i)
                 # Accumulate statistics
                 self.Nij_accepted[istate,jstate] += 1
                 self.Nij_accepted[jstate,istate] += 1
@@ -1051,34 +1981,40 @@ class ReplicaExchange(object):
         if self.replica_mixing_scheme == 'swap-neighbors':
             self._mix_neighboring_replicas()        
         elif self.replica_mixing_scheme == 'swap-all':
-            # Try to use weave-accelerated mixing code if possible, otherwise fall back to Python-accelerated code.            
-            try:
-                self._mix_all_replicas_weave()            
-            except:
-                self._mix_all_replicas()
+            self._mix_all_replicas()
+        elif self.replica_mixing_scheme == 'swap-graph':
+            self._mix_graph_replicas()
+        elif self.replica_mixing_scheme == 'swap-candidates':
+            self._mix_candidate_replicas()
+        elif self.replica_mixing_scheme == 'gibbs-blocks':
+            self._mix_replica_blocks()
         else:
             raise ParameterException("Replica mixing scheme '%s' unknown.  Choose valid 'replica_mixing_scheme' parameter." % self.replica_mixing_scheme)
         end_time = time.time()
 
+        # Check that the state-to-replica index is still the inverse of replica_states.
+        if self.debug:
+            self._check_state_replicas()
+
         # Determine fraction of swaps accepted this iteration.        
         nswaps_attempted = self.Nij_proposed.sum()
         nswaps_accepted = self.Nij_accepted.sum()
-        swap_fraction_accepted = float(nswaps_accepted) / float(nswaps_attempted);
+        swap_fraction_accepted = float(nswaps_accepted) / float(max(nswaps_attempted, 1))
         if self.verbose: print "Accepted %d / %d attempted swaps (%.1f %%)" % (nswaps_accepted, nswaps_attempted, swap_fraction_accepted * 100.0)
 
+        # Accumulate swap statistics over all iterations.
+        self.Nij_proposed_cumulative += self.Nij_proposed
+        self.Nij_accepted_cumulative += self.Nij_accepted
+
         # Estimate cumulative transition probabilities between all states.
-        Nij_accepted = self.ncfile.variables['accepted'][:,:,:].sum(0) + self.Nij_accepted
-        Nij_proposed = self.ncfile.variables['proposed'][:,:,:].sum(0) + self.Nij_proposed
-        swap_Pij_accepted = numpy.zeros([self.nstates,self.nstates], numpy.float64)
-        for istate in range(self.nstates):
-            Ni = Nij_proposed[istate,:].sum()
-            if (Ni == 0):
-                swap_Pij_accepted[istate,istate] = 1.0
-            else:
-                swap_Pij_accepted[istate,istate] = 1.0 - float(Nij_accepted[istate,:].sum() - Nij_accepted[istate,istate]) / float(Ni)
-                for jstate in range(self.nstates):
-                    if istate != jstate:
-                        swap_Pij_accepted[istate,jstate] = float(Nij_accepted[istate,jstate]) / float(Ni)
+        Ni = self.Nij_proposed_cumulative.sum(1).astype(numpy.float64) # Ni[i] is the number of swaps proposed from state i
+        proposed = (Ni > 0)
+        self.swap_Pij_accepted[:,:] = 0.0
+        self.swap_Pij_accepted[proposed,:] = self.Nij_accepted_cumulative[proposed,:] / Ni[proposed,numpy.newaxis]
+        diagonal = numpy.ones([self.nstates], numpy.float64)
+        Nii_accepted = numpy.diag(self.Nij_accepted_cumulative)
+        diagonal[proposed] = 1.0 - (self.Nij_accepted_cumulative[proposed,:].sum(1) - Nii_accepted[proposed]) / Ni[proposed]
+        self.swap_Pij_accepted[numpy.arange(self.nstates),numpy.arange(self.nstates)] = diagonal
 
         # Report on mixing.
         if self.verbose:
@@ -1086,10 +2022,40 @@ class ReplicaExchange(object):
                 
         return
 
+    def _check_state_replicas(self):
+        """
+        Check that replica_states is a permutation of states and state_replicas is its inverse.
+
+        """
+
+        if not numpy.all(numpy.sort(self.replica_states) == numpy.arange(self.nstates)):
+            raise Exception("replica_states is not a permutation of states: %s" % str(self.replica_states))
+        if not numpy.all(self.replica_states[self.state_replicas] == numpy.arange(self.nstates)):
+            raise Exception("state_replicas is not the inverse of replica_states: %s vs %s" % (str(self.state_replicas), str(self.replica_states)))
+
+        return
+
+    def _accumulate_state_transitions(self):
+        """
+        Accumulate the state transitions made by all replicas since the previous iteration into Nij_transitions.
+
+        """
+
+        if self._previous_replica_states is not None:
+            numpy.add.at(self.Nij_transitions, (self._previous_replica_states, self.replica_states), 1)
+        self._previous_replica_states = self.replica_states.copy()
+
+        return
+
     def _show_mixing_statistics(self):
         """
         Print summary of mixing statistics.
 
+        NOTES
+
+        Transition counts are accumulated every iteration by _accumulate_state_transitions(), so this can be called on demand;
+        the run loop calls it every 'mixing_statistics_interval' iterations since the eigenvalue estimate costs O(nstates^3).
+
         """
 
         # Don't print anything until we've accumulated some statistics.
@@ -1097,16 +2063,10 @@ class ReplicaExchange(object):
             return
         
         # Compute statistics of transitions.
-        Nij = numpy.zeros([self.nstates,self.nstates], numpy.float64)
-        for iteration in range(self.iteration - 1):
-            for ireplica in range(self.nstates):
-                istate = self.ncfile.variables['states'][iteration,ireplica]
-                jstate = self.ncfile.variables['states'][iteration+1,ireplica]
-                Nij[istate,jstate] += 0.5
-                Nij[jstate,istate] += 0.5
-        Tij = numpy.zeros([self.nstates,self.nstates], numpy.float64)
-        for istate in range(self.nstates):
-            Tij[istate,:] = Nij[istate,:] / Nij[istate,:].sum()
+        Nij = 0.5 * (self.Nij_transitions + self.Nij_transitions.T).astype(numpy.float64)
+        Ni = Nij.sum(1)
+        Tij = numpy.eye(self.nstates) # states never visited are left as absorbing
+        Tij[Ni > 0,:] = Nij[Ni > 0,:] / Ni[Ni > 0,numpy.newaxis]
 
         if self.show_mixing_statistics:
             # Print observed transition probabilities.
@@ -1178,7 +2138,7 @@ class ReplicaExchange(object):
         # Define long (human-readable) names for variables.
         setattr(ncvar_positions, "long_name", "positions[iteration][replica][atom][spatial] is position of coordinate 'spatial' of atom 'atom' from replica 'replica' for iteration 'iteration'.")
         setattr(ncvar_states,    "long_name", "states[iteration][replica] is the state index (0..nstates-1) of replica 'replica' of iteration 'iteration'.")
-        setattr(ncvar_energies,  "long_name", "energies[iteration][replica][state] is the reduced (unitless) energy of replica 'replica' from iteration 'iteration' evaluated at state 'state'.")
+        setattr(ncvar_energies,  "long_name", "energies[iteration][replica][state] is the reduced (unitless) energy of replica 'replica' from iteration 'iteration' evaluated at state 'state', or NaN if not computed.")
         setattr(ncvar_proposed,  "long_name", "proposed[iteration][i][j] is the number of proposed transitions between states i and j from iteration 'iteration-1'.")
         setattr(ncvar_accepted,  "long_name", "accepted[iteration][i][j] is the number of proposed transitions between states i and j from iteration 'iteration-1'.")
 
@@ -1198,15 +2158,19 @@ class ReplicaExchange(object):
 
         start_time = time.time()
         
+        # Determine whether positions are to be written this iteration.
+        store_positions = (self.iteration % self.positions_storage_interval == 0)
+
         if self.comm is not None:
+            # Collect resident coordinates on master node if they are to be written.
+            if store_positions and self.resident_coordinates:
+                self._gather_coordinates()
             # Only master node writes in parallel runs
             if self.comm.rank != 0: return
 
         # Store replica positions.
-        for replica_index in range(self.nstates):
-            coordinates = self.replica_coordinates[replica_index]
-            x = coordinates / units.nanometers
-            self.ncfile.variables['positions'][self.iteration,replica_index,:,:] = x[:,:]
+        if store_positions:
+            self.ncfile.variables['positions'][self.iteration,:,:,:] = self.replica_coordinates
             
         # TODO: Store box vectors
 
@@ -1244,21 +2208,33 @@ class ReplicaExchange(object):
         # Get current dimensions.
         self.iteration = ncfile.variables['energies'].shape[0] - 1
         self.nstates = ncfile.variables['energies'].shape[1]
-        self.natoms = ncfile.variables['energies'].shape[2]
+        self.natoms = ncfile.variables['positions'].shape[2]
+
+        # Resume from the last iteration for which positions were stored (see 'positions_storage_interval').
+        # Later iterations will be overwritten.
+        while (self.iteration > 0) and not self._positions_stored(ncfile, self.iteration):
+            self.iteration -= 1
 
         # Restore positions.
-        self.replica_coordinates = list()
-        for replica_index in range(self.nstates):
-            x = ncfile.variables['positions'][self.iteration,replica_index,:,:].astype(numpy.float64).copy()
-            coordinates = units.Quantity(x, units.nanometers)
-            self.replica_coordinates.append(coordinates)
+        self.replica_coordinates[:,:,:] = ncfile.variables['positions'][self.iteration,:,:,:]
 
         # Restore state information.
         self.replica_states = ncfile.variables['states'][self.iteration,:].copy()
+        self.state_replicas[self.replica_states] = numpy.arange(self.nstates)
 
         # Restore energies.
         self.u_kl = ncfile.variables['energies'][self.iteration,:,:].copy()
 
+        # Restore cumulative swap statistics.
+        self.Nij_proposed_cumulative[:,:] = ncfile.variables['proposed'][0:self.iteration+1,:,:].sum(0)
+        self.Nij_accepted_cumulative[:,:] = ncfile.variables['accepted'][0:self.iteration+1,:,:].sum(0)
+
+        # Restore state transition statistics.
+        states = numpy.array(ncfile.variables['states'][0:self.iteration+1,:], numpy.int32)
+        self.Nij_transitions[:,:] = 0
+        numpy.add.at(self.Nij_transitions, (states[:-1,:].ravel(), states[1:,:].ravel()), 1)
+        self._previous_replica_states = self.replica_states.copy()
+
         # Close NetCDF file.
         ncfile.close()        
 
@@ -1274,6 +2250,27 @@ class ReplicaExchange(object):
         
         return
 
+    def _positions_stored(self, ncfile, iteration):
+        """
+        Determine whether replica positions were written to the NetCDF file for the given iteration.
+
+        ARGUMENTS
+
+        ncfile (netCDF4.Dataset) - the NetCDF file handle
+        iteration (int) - the iteration to check
+
+        RETURNS
+
+        stored (boolean) - True if positions were stored for this iteration
+
+        """
+
+        x = ncfile.variables['positions'][iteration,0,0,0]
+        if numpy.ma.is_masked(x) or (x == netcdf.default_fillvals['f4']):
+            return False
+
+        return True
+
     def _show_energies(self):
         """
         Show energies (in units of kT) for all replicas at all states.
@@ -1366,11 +2363,17 @@ class ParallelTempering(ReplicaExchange):
         else:
             raise ValueError("Either 'temperatures' or 'Tmin', 'Tmax', and 'ntemps' must be provided.")
         
-        states = [ ThermodynamicState(system=system, temperature=self.temperatures[i]) for i in range(ntemps) ]
+        states = [ ThermodynamicState(system=system, temperature=self.temperatures[i]) for i in range(len(self.temperatures)) ]
 
         # Initialize replica-exchange simlulation.
         ReplicaExchange.__init__(self, states, coordinates, store_filename, protocol=protocol, mm=mm, comm=comm)
 
+        # Reduced potentials are beta_k * U(x), so capture U(x) at the end of propagation.
+        self._capture_potential_energies = True
+
+        # Inverse temperatures beta_k (in mol/kJ).
+        self._betas = numpy.array([ units.kilojoules_per_mole / (kB * temperature) for temperature in self.temperatures ], numpy.float64)
+
         # Override title.
         self.title = 'Parallel tempering simulation created using ParallelTempering class of repex.py on %s' % time.asctime(time.localtime())
         
@@ -1383,37 +2386,30 @@ class ParallelTempering(ReplicaExchange):
         NOTES
 
         Because only the temperatures differ among replicas, we replace the generic O(N^2) replica-exchange implementation with an O(N) implementation.
-
-        TODO
-
-        * Parallel implementation of energy calculation.
+        The potential energy of each replica is captured at the end of propagation, so normally no further energy evaluations are
+        needed, and the rows of the energy matrix are the outer product u_kl = U_k beta_l.  Potential energies that were not captured
+        (after minimization, equilibration, or resuming) are evaluated with a cached Context.
+        In parallel runs, each node computes the rows for its own replicas, which are then collected on the root node.
         
         """
 
         start_time = time.time()
         if self.verbose: print "Computing energies..."
 
-        # Create an integrator and context.
-        state = self.states[0]
-        integrator = self.mm.VerletIntegrator(self.timestep)
-        context = self.mm.Context(state.system, integrator, self.platform)
-        
-        # Compute reduced potentials for all configurations in all states.
-        for replica_index in range(self.nstates):
-            # Set coordinates.
-            context.setPositions(self.replica_coordinates[replica_index])
-            # Compute potential energy.
-            openmm_state = context.getState(getEnergy=True)            
-            potential_energy = openmm_state.getPotentialEnergy()           
-            # Compute energies at this state for all replicas.
-            for state_index in range(self.nstates):
-                # Compute reduced potential
-                beta = 1.0 / (kB * self.states[state_index].temperature)
-                self.u_kl[replica_index,state_index] = beta * potential_energy
+        # Evaluate any potential energies of this node's replicas not captured during propagation.
+        local_replicas = self._local_replicas()
+        for replica_index in local_replicas[numpy.isnan(self.replica_potential_energies[local_replicas])]:
+            state = self.states[self.replica_states[replica_index]]
+            [context, integrator] = self._context_cache.get_context(state.system, self.platform, parameters=state.parameters)
+            context.setPositions(units.Quantity(self.replica_coordinates[replica_index], units.nanometers))
+            openmm_state = context.getState(getEnergy=True)
+            self.replica_potential_energies[replica_index] = openmm_state.getPotentialEnergy() / units.kilojoules_per_mole
+
+        # Compute reduced potentials for this node's configurations in all states.
+        self.u_kl[local_replicas,:] = numpy.outer(self.replica_potential_energies[local_replicas], self._betas)
 
-        # Clean up.
-        del context
-        del integrator
+        # Collect energy matrix on root node.
+        self._gather_energies(local_replicas)
 
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -1435,6 +2431,9 @@ class HamiltonianExchange(ReplicaExchange):
     This class provides an implementation of a Hamiltonian exchange simulation based on the ReplicaExchange facility.
     It provides several convenience classes and efficiency improvements, and should be preferentially used for Hamiltonian
     exchange simulations over ReplicaExchange when possible.
+
+    States can be given as one System per state, or as a single System together with the values of its global parameters
+    for each state, in which case all states share one Context on each node.
     
     EXAMPLES
     
@@ -1458,7 +2457,7 @@ class HamiltonianExchange(ReplicaExchange):
     
     """
 
-    def __init__(self, reference_state, systems, coordinates, store_filename, protocol=None, mm=None, comm=None):
+    def __init__(self, reference_state, systems, coordinates, store_filename, protocol=None, mm=None, comm=None, parameters=None):
         """
         Initialize a Hamiltonian exchange simulation object.
 
@@ -1473,15 +2472,22 @@ class HamiltonianExchange(ReplicaExchange):
 
         protocol (dict) - Optional protocol to use for specifying simulation protocol as a dict. Provided keywords will be matched to object variables to replace defaults.
         comm - MPI communicator to run in parallel (default: None)
+        parameters (list of dict) - parameters[l] are the values of global parameters defining state l; if specified, 'systems' may be a single System shared by all states (default: None)
 
         """
-        # Create thermodynamic states from systems.        
+        # A single System may be shared by states that differ only in global parameters.
+        if (parameters is not None) and (type(systems) not in [type(list()), type(tuple())]):
+            systems = [ systems for state_parameters in parameters ]
+        if parameters is None:
+            parameters = [ None for system in systems ]
+        if len(parameters) != len(systems):
+            raise ParameterException("'parameters' must have one entry per System.")
+
+        # Create thermodynamic states from systems, each with the thermodynamic parameters of the reference state.
         states = list()
-        for system in systems:
-            #state = copy.deepcopy(reference_state) # TODO: Use deep copy once this works
-            state = reference_state
+        for (system, state_parameters) in zip(systems, parameters):
             #state.system = copy.deepcopy(system) # TODO: Use deep copy once this works
-            state.system = system
+            state = ThermodynamicState(system=system, temperature=reference_state.temperature, pressure=reference_state.pressure, parameters=state_parameters)
             states.append(state)
 
         # Initialize replica-exchange simlulation.
@@ -0,0 +1,337 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Replay replica mixing schemes offline from energies stored by a replica-exchange simulation.
+
+DESCRIPTION
+
+The reduced potentials energies[iteration,replica,state] stored in a repex.py NetCDF file are read, and only the replica
+mixing step of ReplicaExchange is replayed over them with each requested 'replica_mixing_scheme'.  For each scheme, the
+cumulative swap acceptance matrix, the relaxation time of the empirical state transition matrix, the average round-trip
+time between the first and last states, and the replay speed (iterations/s) are reported.
+
+The configurations of each replica are taken as they were sampled in the original simulation, so the replay ignores the
+effect that a different sequence of state assignments would have had on the dynamics.  It is intended for comparing and
+tuning mixing schemes cheaply, not as a substitute for production simulations.
+
+The replay runs the same mixing code as the simulation, so its cost per iteration is that of the scheme.  Rounds of swaps
+depend on each other and are attempted one numpy call at a time.  'swap-all' attempts nstates**3 swaps in rounds of
+nstates/2, which is about 2 nstates**2 calls to _attempt_swaps() per iteration (800 for 20 states, 20,000 for 100 states).
+It therefore replays at roughly tens of iterations per second for 20 states, and far more slowly for larger ladders.  The
+sparse schemes ('swap-neighbors', 'swap-graph', 'swap-candidates', 'gibbs-blocks') make O(nstates) or fewer swap
+attempts per iteration and replay much faster.  The measured rate is printed for each scheme.
+
+EXAMPLES
+
+Compare neighbor swaps, graph swaps, and exact block Gibbs sampling on a stored parallel tempering run:
+
+% python replay-mixing-schemes.py data/parallel-tempering-allswap.nc swap-neighbors swap-graph gibbs-blocks
+
+COPYRIGHT
+
+@author John D. Chodera <jchodera@gmail.com>
+
+This source file is released under the GNU General Public License.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import sys
+import time
+
+import numpy
+import numpy.linalg
+
+import netCDF4 as netcdf # netcdf4-python is used in place of scipy.io.netcdf for now
+
+import repex
+
+#=============================================================================================
+# SOURCE CONTROL
+#=============================================================================================
+
+__version__ = "$Id: $"
+
+#=============================================================================================
+# Mixing replay
+#=============================================================================================
+
+class MixingReplay(repex.ReplicaExchange):
+    """
+    Replay of the replica mixing step of ReplicaExchange over stored energies.
+
+    Only the state needed by ReplicaExchange._mix_replicas() is set up; no OpenMM objects or store file are created.
+
+    EXAMPLES
+
+    Replay neighbor swaps over random energies for three states.
+
+    >>> energies = numpy.random.randn(10, 3, 3)
+    >>> replay = MixingReplay(energies, 'swap-neighbors')
+    >>> states = replay.replay()
+    >>> states.shape
+    (10, 3)
+
+    """
+
+    def __init__(self, energies, replica_mixing_scheme, protocol=None):
+        """
+        Set up a replay of the given mixing scheme.
+
+        ARGUMENTS
+
+        energies (numpy array) - energies[iteration,replica,state] is the reduced potential of replica at state, or NaN if not computed
+        replica_mixing_scheme (string) - any scheme accepted by ReplicaExchange 'replica_mixing_scheme'
+
+        OPTIONAL ARGUMENTS
+
+        protocol (dict) - mixing parameters (such as 'mixing_block_size' or 'state_graph') to replace defaults
+
+        """
+
+        self.energies = energies
+        [self.niterations, self.nstates, nstates] = energies.shape
+
+        # Mixing parameters, with the same defaults as ReplicaExchange.
+        self.replica_mixing_scheme = replica_mixing_scheme
+        self.mixing_block_size = 6
+        self.candidate_list_size = None
+        self.candidate_list_interval = 10
+        self.state_graph = None
+        self.verbose = False
+        self.debug = False
+        if protocol is not None:
+            for key in protocol.keys():
+                if key in vars(self).keys():
+                    vars(self)[key] = protocol[key]
+
+        # Mixing state, allocated as in ReplicaExchange._initialize().
+        self.iteration = 0
+        self.u_kl = numpy.zeros([self.nstates, self.nstates], numpy.float64)
+        self.replica_states = numpy.arange(self.nstates).astype(numpy.int32)
+        self.state_replicas = numpy.arange(self.nstates).astype(numpy.int32)
+        self.swap_Pij_accepted = numpy.zeros([self.nstates, self.nstates], numpy.float64)
+        self.Nij_proposed = numpy.zeros([self.nstates,self.nstates], numpy.int64)
+        self.Nij_accepted = numpy.zeros([self.nstates,self.nstates], numpy.int64)
+        self.Nij_proposed_cumulative = numpy.zeros([self.nstates,self.nstates], numpy.int64)
+        self.Nij_accepted_cumulative = numpy.zeros([self.nstates,self.nstates], numpy.int64)
+        self._block_permutations = dict()
+        self._candidate_pairs = None
+        self._candidate_pairs_iteration = None
+        self._state_graph_colors = None
+
+        return
+
+    def replay(self):
+        """
+        Replay the mixing step over all stored iterations.
+
+        RETURNS
+
+        states (numpy int32 array) - states[iteration,replica] is the state of replica after mixing at iteration
+
+        """
+
+        states = numpy.zeros([self.niterations, self.nstates], numpy.int32)
+        for iteration in range(self.niterations):
+            self.iteration = iteration
+            self.u_kl[:,:] = self.energies[iteration,:,:]
+            self._mix_replicas()
+            states[iteration,:] = self.replica_states[:]
+
+        return states
+
+#=============================================================================================
+# SUBROUTINES
+#=============================================================================================
+
+def read_energies(store_filename):
+    """
+    Read stored reduced potentials from a repex.py NetCDF file.
+
+    ARGUMENTS
+
+    store_filename (string) - name of NetCDF file written by ReplicaExchange
+
+    RETURNS
+
+    energies (numpy float64 array) - energies[iteration,replica,state] is the reduced potential, or NaN if not computed
+
+    """
+
+    ncfile = netcdf.Dataset(store_filename, 'r')
+    energies = numpy.ma.filled(numpy.ma.asarray(ncfile.variables['energies'][:,:,:], numpy.float64), numpy.nan)
+    ncfile.close()
+
+    return energies
+
+def show_acceptance_matrix(Pij):
+    """
+    Print a swap acceptance or transition probability matrix.
+
+    ARGUMENTS
+
+    Pij (numpy array) - Pij[i,j] is the probability of a transition from state i to state j
+
+    """
+
+    PRINT_CUTOFF = 0.001 # Cutoff for displaying fraction of accepted swaps.
+    nstates = Pij.shape[0]
+    print "%6s" % "",
+    for jstate in range(nstates):
+        print "%6d" % jstate,
+    print ""
+    for istate in range(nstates):
+        print "%-6d" % istate,
+        for jstate in range(nstates):
+            P = Pij[istate,jstate]
+            if (P >= PRINT_CUTOFF):
+                print "%6.3f" % P,
+            else:
+                print "%6s" % "",
+        print ""
+
+    return
+
+def compute_relaxation_time(states):
+    """
+    Estimate the relaxation time of the symmetrized empirical state transition matrix.
+
+    ARGUMENTS
+
+    states (numpy int array) - states[iteration,replica] is the state of replica at iteration
+
+    RETURNS
+
+    tau (float) - relaxation time in iterations, 1/(1-mu2) for second largest eigenvalue mu2, or inf if the chain is decomposable
+
+    """
+
+    nstates = states.shape[1]
+    Nij = numpy.zeros([nstates,nstates], numpy.float64)
+    numpy.add.at(Nij, (states[:-1,:].ravel(), states[1:,:].ravel()), 1.0)
+    Nij = 0.5 * (Nij + Nij.T)
+    Ni = Nij.sum(1)
+    Tij = numpy.eye(nstates)
+    Tij[Ni > 0,:] = Nij[Ni > 0,:] / Ni[Ni > 0,numpy.newaxis]
+
+    mu = numpy.linalg.eigvals(Tij).real
+    mu = -numpy.sort(-mu) # sort in descending order
+    if (mu[1] >= 1.0):
+        return numpy.inf
+
+    return 1.0 / (1.0 - mu[1])
+
+def compute_round_trip_times(states):
+    """
+    Compute the times replicas take to travel from the first state to the last state and back.
+
+    ARGUMENTS
+
+    states (numpy int array) - states[iteration,replica] is the state of replica at iteration
+
+    RETURNS
+
+    round_trip_times (numpy float64 array) - duration (in iterations) of every completed round trip of every replica
+
+    """
+
+    nstates = states.shape[1]
+    round_trip_times = list()
+    for replica in range(nstates):
+        # Find iterations at which this replica is at either end of the state range.
+        iterations = numpy.nonzero((states[:,replica] == 0) | (states[:,replica] == nstates-1))[0]
+        endpoints = states[iterations,replica]
+        # Keep only arrivals at the opposite end from the previous visit.
+        arrivals = numpy.ones(endpoints.shape, numpy.bool_)
+        arrivals[1:] = (endpoints[1:] != endpoints[:-1])
+        arrival_iterations = iterations[arrivals]
+        # A round trip spans two consecutive arrivals.
+        round_trip_times.append(arrival_iterations[2:] - arrival_iterations[:-2])
+
+    return numpy.concatenate(round_trip_times).astype(numpy.float64)
+
+def replay_scheme(energies, replica_mixing_scheme, protocol=None, show_matrix=True):
+    """
+    Replay one mixing scheme over stored energies and print a summary.
+
+    ARGUMENTS
+
+    energies (numpy array) - energies[iteration,replica,state] is the reduced potential of replica at state
+    replica_mixing_scheme (string) - mixing scheme to replay
+
+    OPTIONAL ARGUMENTS
+
+    protocol (dict) - mixing parameters to replace defaults (default: None)
+    show_matrix (boolean) - if True, print the cumulative swap acceptance matrix (default: True)
+
+    """
+
+    print "Replaying '%s' mixing..." % replica_mixing_scheme
+    replay = MixingReplay(energies, replica_mixing_scheme, protocol=protocol)
+
+    start_time = time.time()
+    states = replay.replay()
+    elapsed_time = time.time() - start_time
+
+    if show_matrix:
+        print "Cumulative swap acceptance matrix:"
+        show_acceptance_matrix(replay.swap_Pij_accepted)
+
+    nswaps_attempted = replay.Nij_proposed_cumulative.sum()
+    nswaps_accepted = replay.Nij_accepted_cumulative.sum()
+    print "Accepted %d / %d attempted swaps (%.1f %%)" % (nswaps_accepted, nswaps_attempted, 100.0 * nswaps_accepted / max(nswaps_attempted, 1))
+    print "State relaxation time is ~ %.1f iterations" % compute_relaxation_time(states)
+    round_trip_times = compute_round_trip_times(states)
+    if round_trip_times.size > 0:
+        print "Average round-trip time is %.1f +- %.1f iterations (%d round trips)" % (round_trip_times.mean(), round_trip_times.std() / numpy.sqrt(round_trip_times.size), round_trip_times.size)
+    else:
+        print "No round trips completed."
+    print "Replayed %d iterations in %.3f s (%.1f iterations/s)" % (replay.niterations, elapsed_time, replay.niterations / max(elapsed_time, 1.0e-6))
+    print ""
+
+    return
+
+#=============================================================================================
+# MAIN AND TESTS
+#=============================================================================================
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print "usage: %s store.nc [replica_mixing_scheme ...]" % sys.argv[0]
+        sys.exit(1)
+
+    store_filename = sys.argv[1]
+    schemes = sys.argv[2:]
+    if len(schemes) == 0:
+        schemes = ['swap-neighbors', 'swap-graph', 'swap-candidates', 'gibbs-blocks', 'swap-all']
+
+    # Read stored energies.
+    energies = read_energies(store_filename)
+    [niterations, nreplicas, nstates] = energies.shape
+    print "%d iterations, %d states" % (niterations, nstates)
+    print ""
+
+    # Replay each mixing scheme.
+    for replica_mixing_scheme in schemes:
+        replay_scheme(energies, replica_mixing_scheme)